@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+# DHCPd throughput and latency, run from the top of the source tree, ie:
+#   PYTHONPATH=. benchmark/dhcpd_bench.py --macs 5000 --static 0.5 --pool-size 2000
+#
+# inprocess calls HandleDhcpDiscover/HandleDhcpRequest directly, the socket set up is skipped, so it only measures
+# the pools, option building and the packet queues.  socket runs DHCPd in a forked process ( the same as the
+# processes mode of bin/dhcpd ) and sends real packets, needs root for ports 67/68.  With --client-interface ( ie: one
+# end of a veth pair, DHCPd listening on the other ) packets are broadcast the same as real clients, otherwise DHCPd
+# listens on lo and the packets have ciaddr set, so the replies are unicast back to 127.0.0.1
+#
+# each round every mac sends a Discover then a Request, the first round does the allocating, the later
+# rounds are renewals.  Macs past the static entries and the dynamic addresses don't get an answer.
+
+import sys
+import time
+import logging
+import json
+import socket
+import struct
+import random
+import asyncio
+import argparse
+import tracemalloc
+from functools import partial
+
+from pydhcplib.dhcp_packet import DhcpPacket
+
+from subcontractor.dhcpd import DHCPd
+from subcontractor.dhcpd_process import DHCPdProcess
+from subcontractor.dynamic_pool import DynamicPool
+from subcontractor.static_pool import StaticPool
+
+from stub_contractor import StubContractor, macAddress
+
+DHCP_DISCOVER = 1
+DHCP_REQUEST = 3
+
+CLIENT_TYPES = ( 'bios', 'uefi', 'ipxe' )
+PARAMETER_REQUEST_LIST = [ 1, 3, 6, 12, 15, 26, 28, 67 ]  # 67 is the bootfile_name
+
+
+def buildPacket( message_type, mac, xid, client_type, ciaddr=None, broadcast=True ):
+  chaddr = bytes.fromhex( mac.replace( ':', '' ) )
+  packet = struct.pack( '!BBBBIHH4s4s4s4s16s64s128s', 1, 1, 6, 0, xid, 0, 0x8000 if broadcast else 0,
+                        socket.inet_aton( ciaddr or '0.0.0.0' ), bytes( 4 ), bytes( 4 ), bytes( 4 ), chaddr, bytes( 64 ), bytes( 128 ) )
+  option_list = [ ( 53, [ message_type ] ), ( 55, PARAMETER_REQUEST_LIST ) ]
+  option_list.append( ( 93, [ 0, 7 ] if client_type == 'uefi' else [ 0, 0 ] ) )
+  if client_type == 'ipxe':
+    option_list.append( ( 77, list( b'iPXE' ) ) )
+
+  packet += bytes( [ 99, 130, 83, 99 ] )
+  for code, value in option_list:
+    packet += bytes( [ code, len( value ) ] + value )
+
+  return packet + bytes( [ 255 ] )
+
+
+def clientType( index, client_mix ):
+  return client_mix[ index % len( client_mix ) ]
+
+
+def percentile( value_list, percent ):
+  if not value_list:
+    return None
+
+  return value_list[ min( int( len( value_list ) * percent / 100 ), len( value_list ) - 1 ) ]
+
+
+# the same as bin/dhcpd does with contractor
+async def loadPools( dhcpd, contractor, new_pool, static_pool ):
+  dhcpd.add_pool( static_pool, '__static__' )
+  static_pool.update( await contractor.getDHCPdStaticPools() )
+  await dhcpd.update_dynamic_pools( await contractor.getDHCPdDynamidPools(), new_pool )
+
+
+class BenchDHCPd( DHCPd ):
+  # pydhcplib's DhcpServer sets up it's socket with these, inprocess does not need one
+  def CreateSocket( self ):
+    pass
+
+  def BindToAddress( self ):
+    pass
+
+  def EnableBroadcast( self ):
+    pass
+
+  def EnableReuseaddr( self ):
+    pass
+
+  async def GetNextDhcpPacket( self, timeout=None ):
+    await asyncio.sleep( 0.1 )
+
+  def SendDhcpPacket( self, request, reply ):
+    self.reply_count += 1
+    self.latency_list.append( time.perf_counter() - self.start_map[ id( request ) ] )
+
+  async def _queue( self, handler, request, message_type ):
+    async def _handler( request ):
+      try:
+        await handler( request )
+      finally:
+        self.done( request )
+
+    drop_count = self.drop_count
+    await super()._queue( _handler, request, message_type )
+    if self.drop_count != drop_count:
+      self.done( request )
+
+
+async def runInprocess( args, contractor, client_mix ):
+  dhcpd = BenchDHCPd( 'lo', '127.0.0.1', '127.0.0.1', args.workers, args.queue_size )
+  dhcpd.reply_count = 0
+  dhcpd.latency_list = []
+  dhcpd.start_map = {}
+  await loadPools( dhcpd, contractor, partial( DynamicPool, args.lease_time, None, None, 'console' ), StaticPool( args.lease_time ) )
+
+  window = asyncio.Semaphore( args.concurrency )
+
+  def _done( request ):
+    del dhcpd.start_map[ id( request ) ]
+    window.release()
+
+  dhcpd.done = _done
+  server_task = asyncio.create_task( dhcpd.run() )
+  await asyncio.sleep( 0 )
+
+  result_list = []
+  for number in range( args.rounds ):
+    # decode up front, so only DHCPd is measured
+    packet_list = []
+    for index in range( args.macs ):
+      for message_type, handler in ( ( DHCP_DISCOVER, dhcpd.HandleDhcpDiscover ), ( DHCP_REQUEST, dhcpd.HandleDhcpRequest ) ):
+        packet = DhcpPacket()
+        packet.DecodePacket( buildPacket( message_type, macAddress( index ), random.getrandbits( 32 ), clientType( index, client_mix ) ) )
+        packet_list.append( ( handler, packet ) )
+
+    dhcpd.reply_count = 0
+    dhcpd.latency_list = []
+    drop_count = dhcpd.drop_count
+    if args.allocations:
+      tracemalloc.start()
+    block_count = sys.getallocatedblocks()
+
+    start = time.perf_counter()
+    for handler, packet in packet_list:
+      await window.acquire()
+      dhcpd.start_map[ id( packet ) ] = time.perf_counter()
+      await handler( packet )
+
+    for _ in range( args.concurrency ):  # wait for the stragglers
+      await window.acquire()
+    elapsed = time.perf_counter() - start
+    for _ in range( args.concurrency ):
+      window.release()
+
+    result = { 'round': number + 1, 'packets': len( packet_list ), 'replies': dhcpd.reply_count, 'dropped': dhcpd.drop_count - drop_count, 'elapsed': elapsed, 'latency_list': dhcpd.latency_list }
+    result[ 'blocks_per_packet' ] = ( sys.getallocatedblocks() - block_count ) / len( packet_list )
+    if args.allocations:
+      result[ 'peak_bytes' ] = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+    result_list.append( result )
+
+  dhcpd.stop()
+  await server_task
+  return result_list
+
+
+async def runSocket( args, contractor, client_mix ):
+  if args.client_interface is not None:
+    server_address = args.server_address
+    broadcast = True
+  else:
+    server_address = '127.0.0.1'
+    broadcast = False
+
+  static_map = await contractor.getDHCPdStaticPools()
+  worker = DHCPdProcess( 0, 1, ( args.interface, server_address, server_address, args.workers, args.queue_size ), args.lease_time, partial( DynamicPool, args.lease_time, None, None, 'console' ) )
+  worker.start()
+  worker.send( ( 'dynamic', await contractor.getDHCPdDynamidPools() ) )
+  worker.send( ( 'static', static_map ) )
+  await asyncio.sleep( 1 )  # let it bind and load the pools
+
+  client = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+  client.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+  client.setsockopt( socket.SOL_SOCKET, socket.SO_BROADCAST, 1 )
+  if args.client_interface is not None:
+    client.setsockopt( socket.SOL_SOCKET, socket.SO_BINDTODEVICE, args.client_interface.encode() )
+    client.bind( ( '', 68 ) )
+    destination = ( '255.255.255.255', 67 )
+  else:
+    client.bind( ( '127.0.0.1', 68 ) )
+    destination = ( '127.0.0.1', 67 )
+  client.setblocking( False )
+
+  loop = asyncio.get_running_loop()
+  window = asyncio.Semaphore( args.concurrency )
+  pending_map = {}  # key is xid, value is ( sent time, timeout handle )
+  state = { 'replies': 0, 'latency_list': [] }
+
+  def _timeout( xid ):
+    if pending_map.pop( xid, None ) is not None:
+      window.release()
+
+  def _recv():
+    while True:
+      try:
+        data = client.recv( 4096 )
+      except BlockingIOError:
+        return
+
+      if len( data ) < 8 or data[0] != 2:  # not a reply
+        continue
+
+      xid = struct.unpack_from( '!I', data, 4 )[0]
+      try:
+        ( sent, handle ) = pending_map.pop( xid )
+      except KeyError:  # allready timed out
+        continue
+
+      handle.cancel()
+      state[ 'replies' ] += 1
+      state[ 'latency_list' ].append( time.perf_counter() - sent )
+      window.release()
+
+  loop.add_reader( client.fileno(), _recv )
+
+  result_list = []
+  for number in range( args.rounds ):
+    state[ 'replies' ] = 0
+    state[ 'latency_list' ] = []
+    packet_list = []
+    for index in range( args.macs ):
+      for message_type in ( DHCP_DISCOVER, DHCP_REQUEST ):
+        xid = random.getrandbits( 32 )
+        packet_list.append( ( xid, buildPacket( message_type, macAddress( index ), xid, clientType( index, client_mix ), None if broadcast else '127.0.0.1', broadcast ) ) )
+
+    start = time.perf_counter()
+    for xid, packet in packet_list:
+      await window.acquire()
+      pending_map[ xid ] = ( time.perf_counter(), loop.call_later( args.timeout, _timeout, xid ) )
+      client.sendto( packet, destination )
+
+    for _ in range( args.concurrency ):
+      await window.acquire()
+    elapsed = time.perf_counter() - start
+    for _ in range( args.concurrency ):
+      window.release()
+
+    result_list.append( { 'round': number + 1, 'packets': len( packet_list ), 'replies': state[ 'replies' ], 'elapsed': elapsed, 'latency_list': state[ 'latency_list' ] } )
+
+  loop.remove_reader( client.fileno() )
+  client.close()
+  worker.stop()
+  return result_list
+
+
+def report( result_list, as_json ):
+  output_list = []
+  for result in result_list:
+    latency_list = sorted( result.pop( 'latency_list' ) )
+    result[ 'packets_per_second' ] = result[ 'packets' ] / result[ 'elapsed' ]
+    result[ 'p50_ms' ] = percentile( latency_list, 50 ) * 1000 if latency_list else None
+    result[ 'p99_ms' ] = percentile( latency_list, 99 ) * 1000 if latency_list else None
+    output_list.append( result )
+
+  if as_json:
+    print( json.dumps( output_list, indent=2 ) )
+    return
+
+  for result in output_list:
+    line = 'round {0}: {1} packets, {2} replies in {3:.3f}s, {4:.0f} packets/sec'.format( result[ 'round' ], result[ 'packets' ], result[ 'replies' ], result[ 'elapsed' ], result[ 'packets_per_second' ] )
+    if result[ 'p50_ms' ] is not None:
+      line += ', latency p50 {0:.3f}ms p99 {1:.3f}ms'.format( result[ 'p50_ms' ], result[ 'p99_ms' ] )
+    if 'dropped' in result:
+      line += ', {0} dropped'.format( result[ 'dropped' ] )
+    if 'blocks_per_packet' in result:
+      line += ', {0:.2f} retained blocks/packet'.format( result[ 'blocks_per_packet' ] )
+    if 'peak_bytes' in result:
+      line += ', {0:.0f} KiB peak traced'.format( result[ 'peak_bytes' ] / 1024 )
+    print( line )
+
+
+def main():
+  parser = argparse.ArgumentParser( description='DHCPd benchmark' )
+  parser.add_argument( '--mode', help='inprocess or socket', choices=( 'inprocess', 'socket' ), default='inprocess' )
+  parser.add_argument( '--macs', help='number of clients', type=int, default=1000 )
+  parser.add_argument( '--static', help='fraction of the clients that have static entries', type=float, default=0.5 )
+  parser.add_argument( '--pools', help='number of dynamic pools', type=int, default=1 )
+  parser.add_argument( '--pool-size', help='addresses in each dynamic pool', type=int, default=1000 )
+  parser.add_argument( '--clients', help='mix of client types, comma seperated, from {0}'.format( ', '.join( CLIENT_TYPES ) ), default='bios,uefi,ipxe' )
+  parser.add_argument( '--rounds', help='number of times each client does Discover/Request', type=int, default=3 )
+  parser.add_argument( '--concurrency', help='packets waiting for an answer at a time', type=int, default=64 )
+  parser.add_argument( '--workers', help='DHCPd workers', type=int, default=4 )
+  parser.add_argument( '--queue-size', help='DHCPd worker queue size', type=int, default=256 )
+  parser.add_argument( '--lease-time', help='lease time in seconds', type=int, default=600 )
+  parser.add_argument( '--allocations', help='trace memory allocations ( inprocess only, slows things down )', action='store_true' )
+  parser.add_argument( '--interface', help='interface DHCPd listens on ( socket only )', default='lo' )
+  parser.add_argument( '--server-address', help='address of --interface ( socket with --client-interface only )', default='0.0.0.0' )
+  parser.add_argument( '--client-interface', help='interface to send from, ie: the other end of a veth pair ( socket only )', default=None )
+  parser.add_argument( '--timeout', help='seconds to wait for a reply ( socket only )', type=float, default=1.0 )
+  parser.add_argument( '--json', help='output json', action='store_true' )
+  parser.add_argument( '-d', '--debug', help='show DHCPd\'s logging', action='store_true' )
+  args = parser.parse_args()
+
+  logging.basicConfig( level=logging.DEBUG if args.debug else logging.ERROR )
+
+  client_mix = [ item.strip() for item in args.clients.split( ',' ) ]
+  for item in client_mix:
+    if item not in CLIENT_TYPES:
+      parser.error( 'unknown client type "{0}"'.format( item ) )
+
+  contractor = StubContractor( static_count=int( args.macs * args.static ), pool_count=args.pools, pool_size=args.pool_size )
+
+  if args.mode == 'inprocess':
+    result_list = asyncio.run( runInprocess( args, contractor, client_mix ) )
+  else:
+    result_list = asyncio.run( runSocket( args, contractor, client_mix ) )
+
+  report( result_list, args.json )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# runs bin/subcontractor's main loop and Handler against StubJobContractor and made up plugin modules, to see how
+# max_concurent_jobs, max_job_request_size, poll_interval, long_poll and the module limits play out without a
+# contractor, run from the top of the source tree, ie:
+#   PYTHONPATH=. benchmark/dispatch_sim.py --scenario-file my_scenarios.json
+#
+# a scenario file is a json list of scenarios, anything left out comes from DEFAULT_SCENARIO, ie:
+#   [ { "name": "more jobs", "max_concurent_jobs": 80, "modules": { "fast": { "limit": 40, "rate": 30, "latency": [ "exponential", 0.5 ] } } } ]
+#
+# module latency is one of [ "constant", <seconds> ], [ "uniform", <min>, <max> ], [ "exponential", <mean> ],
+# [ "lognormal", <median>, <sigma> ].  rate is new jobs per second, backlog is jobs waiting at the start.
+# blocking modules sleep in the executor ( like most real plugins ), otherwise the function is a coroutine.
+
+import os
+import sys
+import json
+import math
+import time
+import types
+import random
+import asyncio
+import logging
+import argparse
+import importlib.util
+import importlib.machinery
+
+from subcontractor.handler import Handler
+
+from stub_contractor import StubJobContractor
+
+DEFAULT_SCENARIO = {
+                     'name': 'default',
+                     'duration': 30,  # seconds
+                     'max_concurent_jobs': 40,
+                     'max_job_request_size': 10,
+                     'poll_interval': 5,
+                     'job_delay': 1,
+                     'long_poll': 0,
+                     'result_window': 0.5,
+                     'result_batch_size': 20,
+                     'rpc_latency': 0.02,  # seconds for each call to contractor
+                     'backlog': 0,
+                     'modules': {
+                                  'fast': { 'limit': 20, 'rate': 10, 'latency': [ 'lognormal', 0.2, 0.5 ], 'executor': 'thread', 'blocking': True },
+                                  'slow': { 'limit': 10, 'rate': 1, 'latency': [ 'uniform', 2, 8 ], 'executor': 'thread', 'blocking': True }
+                                }
+                   }
+
+DEFAULT_SCENARIO_LIST = [
+                          DEFAULT_SCENARIO,
+                          { 'name': 'long poll', 'long_poll': 20 },
+                          { 'name': 'bigger requests', 'max_job_request_size': 40 }
+                        ]
+
+BIN_SUBCONTRACTOR = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'bin', 'subcontractor' )
+
+
+def latencySampler( latency ):
+  ( kind, *value_list ) = latency
+  if kind == 'constant':
+    return lambda: value_list[0]
+  if kind == 'uniform':
+    return lambda: random.uniform( value_list[0], value_list[1] )
+  if kind == 'exponential':
+    return lambda: random.expovariate( 1 / value_list[0] )
+  if kind == 'lognormal':
+    return lambda: random.lognormvariate( math.log( value_list[0] ), value_list[1] )
+
+  raise ValueError( 'Unknown latency distribution "{0}"'.format( kind ) )
+
+
+# a plugin module, registered in sys.modules so Handler.registerModule can import it, forked process executors inherit it
+def makeModule( name, latency, blocking ):
+  sample = latencySampler( latency )
+
+  def work( paramaters ):
+    started = time.time()
+    time.sleep( sample() )
+    return dict( paramaters, started=started, finished=time.time() )
+
+  async def async_work( paramaters ):
+    started = time.time()
+    await asyncio.sleep( sample() )
+    return dict( paramaters, started=started, finished=time.time() )
+
+  module = types.ModuleType( 'dispatch_sim_{0}'.format( name ) )
+  module.MODULE_NAME = name
+  module.MODULE_FUNCTIONS = { 'work': work if blocking else async_work }
+  sys.modules[ module.__name__ ] = module
+  return module.__name__
+
+
+def loadMain():
+  loader = importlib.machinery.SourceFileLoader( 'subcontractor_main', BIN_SUBCONTRACTOR )
+  module = importlib.util.module_from_spec( importlib.util.spec_from_loader( loader.name, loader ) )
+  loader.exec_module( module )
+  return module.Main
+
+
+def percentile( value_list, percent ):
+  if not value_list:
+    return None
+
+  value_list = sorted( value_list )
+  return value_list[ min( int( len( value_list ) * percent / 100 ), len( value_list ) - 1 ) ]
+
+
+async def runScenario( Main, scenario ):
+  module_map = scenario[ 'modules' ]
+  contractor = StubJobContractor( dict( [ ( name, module[ 'rate' ] ) for name, module in module_map.items() ] ), scenario[ 'backlog' ], scenario[ 'rpc_latency' ] )
+
+  # what Main.config does, without a config file or contractor
+  main = Main()
+  main.contractor = contractor
+  main.poll_interval = scenario[ 'poll_interval' ]
+  main.max_job_request_size = scenario[ 'max_job_request_size' ]
+  main.long_poll = scenario[ 'long_poll' ]
+  main.shutdown_timeout = 0.1
+  main.handler = Handler( contractor )
+  main.handler.setLimits( job_delay=scenario[ 'job_delay' ], max_concurent_jobs=scenario[ 'max_concurent_jobs' ], result_window=scenario[ 'result_window' ], result_batch_size=scenario[ 'result_batch_size' ], job_timeout=None )
+  for name, module in module_map.items():
+    main.handler.registerModule( makeModule( name, module[ 'latency' ], module.get( 'blocking', True ) ), module[ 'limit' ], module.get( 'executor', 'thread' ) )
+  contractor.setModuleList( main.handler.module_list )
+
+  handler = main.handler
+  total_slots = sum( handler.limit_map.values() )
+  sample_list = []  # ( busy module slots / total module slots, jobs / max_concurent_jobs )
+
+  async def _sample():
+    while True:
+      busy = sum( handler.running_map.values() )
+      sample_list.append( ( busy / total_slots, len( handler.task_map ) / handler.max_concurent_jobs ) )
+      await asyncio.sleep( 0.1 )
+
+  generate_task = asyncio.create_task( contractor.generate() )
+  sample_task = asyncio.create_task( _sample() )
+  start = time.time()
+  main_task = asyncio.create_task( main.main() )
+  await asyncio.sleep( scenario[ 'duration' ] )
+  main.stop()
+  generate_task.cancel()
+  sample_task.cancel()
+  await main_task
+  elapsed = time.time() - start
+
+  completed_list = [ ( data, received ) for data, received in contractor.result_list if received - start <= scenario[ 'duration' ] ]
+  contractor_wait_list = [ data[ 'dispatched' ] - data[ 'created' ] for data, _ in completed_list ]
+  handler_wait_list = [ data[ 'started' ] - data[ 'dispatched' ] for data, _ in completed_list ]
+  turnaround_list = [ received - data[ 'created' ] for data, received in completed_list ]
+
+  result = {
+             'name': scenario[ 'name' ],
+             'elapsed': elapsed,
+             'created': contractor.last_job_id,
+             'completed': len( completed_list ),
+             'errors': contractor.error_count,
+             'left_queued': contractor.queued,
+             'jobs_per_second': len( completed_list ) / scenario[ 'duration' ],
+             'contractor_wait_p50': percentile( contractor_wait_list, 50 ),
+             'contractor_wait_p99': percentile( contractor_wait_list, 99 ),
+             'handler_wait_p50': percentile( handler_wait_list, 50 ),
+             'handler_wait_p99': percentile( handler_wait_list, 99 ),
+             'turnaround_p50': percentile( turnaround_list, 50 ),
+             'turnaround_p99': percentile( turnaround_list, 99 ),
+             'module_slot_utilization': sum( [ sample[0] for sample in sample_list ] ) / len( sample_list ) if sample_list else None,
+             'job_slot_utilization': sum( [ sample[1] for sample in sample_list ] ) / len( sample_list ) if sample_list else None,
+             'rpc_counts': contractor.rpc_count_map
+           }
+  return result
+
+
+def _seconds( value ):
+  return '-' if value is None else '{0:.3f}s'.format( value )
+
+
+def report( result_list, as_json ):
+  if as_json:
+    print( json.dumps( result_list, indent=2 ) )
+    return
+
+  for result in result_list:
+    print( '-- {0} --'.format( result[ 'name' ] ) )
+    print( '  jobs: {0} created, {1} completed ( {2:.2f}/sec ), {3} errors, {4} still queued at contractor'.format( result[ 'created' ], result[ 'completed' ], result[ 'jobs_per_second' ], result[ 'errors' ], result[ 'left_queued' ] ) )
+    print( '  waiting at contractor: p50 {0} p99 {1}'.format( _seconds( result[ 'contractor_wait_p50' ] ), _seconds( result[ 'contractor_wait_p99' ] ) ) )
+    print( '  waiting for a slot:    p50 {0} p99 {1}'.format( _seconds( result[ 'handler_wait_p50' ] ), _seconds( result[ 'handler_wait_p99' ] ) ) )
+    print( '  created to result:     p50 {0} p99 {1}'.format( _seconds( result[ 'turnaround_p50' ] ), _seconds( result[ 'turnaround_p99' ] ) ) )
+    print( '  utilization: module slots {0:.1%}, max_concurent_jobs {1:.1%}'.format( result[ 'module_slot_utilization' ] or 0, result[ 'job_slot_utilization' ] or 0 ) )
+    print( '  contractor calls: {0}'.format( ', '.join( [ '{0} {1}'.format( name, count ) for name, count in sorted( result[ 'rpc_counts' ].items() ) ] ) ) )
+
+
+def main():
+  parser = argparse.ArgumentParser( description='subcontractor job dispatch simulation' )
+  parser.add_argument( '-s', '--scenario-file', help='json file with a list of scenarios, defaults to a few built in ones', default=None )
+  parser.add_argument( '--duration', help='override the duration of every scenario, in seconds', type=float, default=None )
+  parser.add_argument( '--json', help='output json', action='store_true' )
+  parser.add_argument( '-d', '--debug', help='show subcontractor\'s logging', action='store_true' )
+  args = parser.parse_args()
+
+  logging.basicConfig( level=logging.DEBUG if args.debug else logging.ERROR )
+
+  if args.scenario_file is not None:
+    scenario_list = json.load( open( args.scenario_file, 'r' ) )
+  else:
+    scenario_list = DEFAULT_SCENARIO_LIST
+
+  Main = loadMain()
+  result_list = []
+  for scenario in scenario_list:
+    scenario = dict( DEFAULT_SCENARIO, **scenario )
+    if args.duration is not None:
+      scenario[ 'duration' ] = args.duration
+
+    result_list.append( asyncio.run( runScenario( Main, scenario ) ) )
+
+  report( result_list, args.json )
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,144 @@
+import time
+import random
+import asyncio
+import ipaddress
+from collections import deque
+
+
+def macAddress( index ):
+  return '02:{0:02x}:{1:02x}:{2:02x}:{3:02x}:{4:02x}'.format( ( index >> 32 ) & 0xFF, ( index >> 24 ) & 0xFF, ( index >> 16 ) & 0xFF, ( index >> 8 ) & 0xFF, index & 0xFF )
+
+
+# stands in for subcontractor.contractor.Contractor, with synthetic data, so the benchmarks don't need a contractor
+# static_count macs get static entries, the dynamic pools are pool_count pools of pool_size addresses
+class StubContractor():
+  def __init__( self, static_count=0, pool_count=1, pool_size=100 ):
+    super().__init__()
+    self.static_count = static_count
+    self.pool_count = pool_count
+    self.pool_size = pool_size
+
+  async def getDHCPdDynamidPools( self ):
+    result = []
+    for pool in range( self.pool_count ):
+      network = ipaddress.IPv4Network( '10.{0}.0.0/16'.format( 100 + pool ) )
+      address_list = [ str( network[ i + 10 ] ) for i in range( self.pool_size ) ]
+      result.append( { 'name': 'dynamic_{0}'.format( pool ), 'gateway': str( network[ 1 ] ), 'netmask': str( network.netmask ), 'dns_server': str( network[ 2 ] ), 'domain_name': 'dynamic{0}.test'.format( pool ), 'address_list': address_list } )
+
+    return result
+
+  async def getDHCPdStaticPools( self ):
+    network = ipaddress.IPv4Network( '10.1.0.0/16' )
+    result = {}
+    for index in range( self.static_count ):
+      result[ macAddress( index ) ] = { 'ip_address': str( network[ index + 10 ] ), 'netmask': str( network.netmask ), 'gateway': str( network[ 1 ] ), 'dns_server': str( network[ 2 ] ),
+                                        'host_name': 'host{0}'.format( index ), 'domain_name': 'static.test', 'console': 'console', 'mtu': 1500 }
+
+    return result
+
+  async def getDHCPdStaticPoolChanges( self, revision ):
+    return None
+
+  def close( self ):
+    pass
+
+
+# stands in for Contractor's job dispatching, jobs for each module arrive at rate_map[ module ] jobs a second ( poisson ),
+# plus backlog jobs per module at the start.  Counts the calls, and keeps the results so the waits can be worked out
+class StubJobContractor():
+  def __init__( self, rate_map, backlog=0, rpc_latency=0.0 ):
+    super().__init__()
+    self.rate_map = rate_map
+    self.rpc_latency = rpc_latency
+    self.long_poll = True
+    self.bulk_results = True
+    self.module_list = []
+    self.queue_map = dict( [ ( module, deque() ) for module in rate_map ] )
+    self.rpc_count_map = {}
+    self.result_list = []  # ( data, received ), data is what the job returned
+    self.error_count = 0
+    self.last_job_id = 0
+    self.job_event = asyncio.Event()  # set when jobs arrive, for long polling
+    for module in rate_map:
+      for _ in range( backlog ):
+        self._newJob( module )
+
+  def _newJob( self, module ):
+    self.last_job_id += 1
+    self.queue_map[ module ].append( { 'job_id': self.last_job_id, 'cookie': 'cookie{0}'.format( self.last_job_id ), 'module': module, 'function': 'work', 'paramaters': { 'created': time.time() } } )
+    self.job_event.set()
+
+  async def _arrivals( self, module ):
+    while True:
+      await asyncio.sleep( random.expovariate( self.rate_map[ module ] ) )
+      self._newJob( module )
+
+  async def generate( self ):  # run as a task, cancel to stop
+    await asyncio.gather( *[ self._arrivals( module ) for module, rate in self.rate_map.items() if rate > 0 ] )
+
+  async def _rpc( self, name ):
+    self.rpc_count_map[ name ] = self.rpc_count_map.get( name, 0 ) + 1
+    if self.rpc_latency:
+      await asyncio.sleep( self.rpc_latency )
+
+  @property
+  def queued( self ):
+    return sum( [ len( queue ) for queue in self.queue_map.values() ] )
+
+  def setModuleList( self, module_list ):
+    self.module_list = module_list
+
+  def _takeJobs( self, max_jobs, module_list ):  # round robin over the modules, like contractor spreading the work
+    job_list = []
+    queue_list = [ self.queue_map[ module ] for module in module_list if module in self.queue_map ]
+    while len( job_list ) < max_jobs and any( queue_list ):
+      for queue in queue_list:
+        if queue and len( job_list ) < max_jobs:
+          job = queue.popleft()
+          job[ 'paramaters' ][ 'dispatched' ] = time.time()
+          job_list.append( job )
+
+    return job_list
+
+  async def getJobs( self, max_jobs, wait=0, module_list=None ):
+    await self._rpc( 'getJobs' )
+    if module_list is None:
+      module_list = self.module_list
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+    while True:
+      job_list = self._takeJobs( max_jobs, module_list )
+      if job_list or loop.time() >= deadline:
+        return job_list
+
+      self.job_event.clear()
+      try:
+        await asyncio.wait_for( self.job_event.wait(), deadline - loop.time() )
+      except asyncio.TimeoutError:
+        pass
+
+  def _result( self, entry ):
+    if 'msg' in entry:
+      self.error_count += 1
+    else:
+      self.result_list.append( ( entry[ 'data' ], time.time() ) )
+
+  async def jobResults( self, job_id, data, cookie ):
+    await self._rpc( 'jobResults' )
+    self._result( { 'job_id': job_id, 'data': data } )
+    return 'Accepted'
+
+  async def jobError( self, job_id, msg, cookie ):
+    await self._rpc( 'jobError' )
+    self._result( { 'job_id': job_id, 'msg': msg } )
+
+  async def submitResults( self, entry_list ):
+    await self._rpc( 'submitResults' )
+    for entry in entry_list:
+      self._result( entry )
+
+    return [ 'Accepted' ] * len( entry_list )
+
+  def close( self ):
+    pass
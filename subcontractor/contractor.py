@@ -1,28 +1,87 @@
+import ssl
+import json
+import errno
+import base64
 import logging
+import asyncio
+import threading
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit, unquote
+from urllib.request import _parse_proxy
 
-from cinp.client import CInP, NotFound, InvalidSession
+from cinp.client import CInP, NotFound, InvalidRequest, DetailedInvalidRequest, InvalidSession, NotAuthorized, ServerError, ResponseError, Timeout
+
+from subcontractor.metrics import REGISTRY, Histogram, Counter
+from subcontractor.profiler import span
 
 CONTRACTOR_API_VERSION = '1.0'
 SUBCONTRACTOR_USERNAME = 'subcontractor'
 SUBCONTRACTOR_PASSWORD = 'subcontractor'
 
+RETRY_DELAY_MIN = 0.5
+RETRY_DELAY_MAX = 30
+REQUEST_TIMEOUT = 30  # seconds, the same as cinp's
+LONG_POLL_MARGIN = 10  # seconds on top of the long poll wait, before the request times out
+
+CINP_VERSION = '1.0'
+USER_AGENT = 'subcontractor CInP client'
+
+
+class ConnectionFailed( ResponseError ):  # connection refused, reset or the network is unreachable, retried like Timeout, the same as cinp's DEFAULT_RETRY_ON
+  pass
+
 
 class Contractor():
   def relogin( func ):
-    def wrapper( self, *args, **kwargs ):
+    @wraps( func )
+    async def wrapper( self, *args, **kwargs ):
       try:
-        return func( self, *args, **kwargs )
+        return await func( self, *args, **kwargs )
       except InvalidSession:
         logging.debug( 'contractor: got invalid session, re-logging in and re-trying' )
-        self.logout()
-        self.login()
-        return func( self, *args, **kwargs )
+        await self._relogin()
+        return await func( self, *args, **kwargs )
     return wrapper
 
-  def __init__( self, site, host, root_path, proxy, stop_event ):
+  def __init__( self, site, host, root_path, proxy, stop_event, pool_size=4 ):
     super().__init__()
+    if host[-1] == '/':
+      raise ValueError( 'host must not end with "/"' )
+
     self.module_list = []
+    self.bulk_results = True
+    self.long_poll = True
+    self.static_pool_revisions = True
     self.site = '{0}Site/Site:{1}:'.format( root_path, site )
+    self.host = host
+    self.stop_event = stop_event
+    self.token = None
+    self.login_lock = asyncio.Lock()
+    url = urlsplit( host )
+    self.https = url.scheme == 'https'
+    self.netloc = url.netloc
+    self.proxy = None
+    self.proxy_headers = {}
+    if proxy:  # with or without a scheme, and user:password, like cinp's ProxyHandler
+      ( _, user, password, self.proxy ) = _parse_proxy( proxy )
+      if user is not None:
+        self.proxy_headers[ 'Proxy-Authorization' ] = 'Basic {0}'.format( base64.b64encode( '{0}:{1}'.format( unquote( user ), unquote( password or '' ) ).encode() ).decode() )
+
+    self.ssl_context = ssl.create_default_context()
+    # the calls are made in a pool of threads, so they never block the event loop, the connections to contractor are
+    # kept open ( HTTP/1.1 keep-alive ) and re-used, so a new connection is not made for every call
+    self.executor = ThreadPoolExecutor( max_workers=pool_size, thread_name_prefix='contractor' )
+    self.connection_lock = threading.Lock()
+    self.idle_list = []  # open connections not in use, at most pool_size as that is how many threads can use them
+    self.closed = False
+    self.request_map = {}  # key is the method, ie: "Dispatch(getJobs)", value is a Histogram of how long the calls took
+    self.retry_counter = Counter()  # by method
+    self.error_counter = Counter()  # by ( method, exception name )
+    REGISTRY.register( 'contractor_request_seconds', 'histogram', 'time for each call to contractor, including failed calls', ( 'method', ), lambda: dict( [ ( ( method, ), histogram ) for method, histogram in self.request_map.items() ] ) )
+    REGISTRY.register( 'contractor_retries_total', 'counter', 'calls to contractor retried after a timeout or connection error', ( 'method', ), lambda: self.retry_counter.value_map )
+    REGISTRY.register( 'contractor_errors_total', 'counter', 'calls to contractor that failed', ( 'method', 'error' ), lambda: self.error_counter.value_map )
     self.cinp = CInP( host=host, root_path=root_path, proxy=proxy, retry_event=stop_event )
 
     root, _ = self.cinp.describe( '/api/v1/', retry_count=30 )  # very tollerant for the initial describe, let things settle
@@ -43,6 +102,163 @@ class Contractor():
     self.cinp.setAuth()
     self.token = None
 
+  async def _relogin( self ):
+    token = self.token
+    async with self.login_lock:
+      if self.token != token:  # somebody else allready got a new session while we waited
+        return
+
+      loop = asyncio.get_running_loop()
+      await loop.run_in_executor( self.executor, self.logout )
+      await loop.run_in_executor( self.executor, self.login )
+
+  def _connect( self ):
+    if self.https:
+      if self.proxy is not None:
+        connection = HTTPSConnection( self.proxy, timeout=REQUEST_TIMEOUT, context=self.ssl_context )
+        connection.set_tunnel( self.netloc, headers=self.proxy_headers )
+      else:
+        connection = HTTPSConnection( self.netloc, timeout=REQUEST_TIMEOUT, context=self.ssl_context )
+
+    else:
+      connection = HTTPConnection( self.proxy or self.netloc, timeout=REQUEST_TIMEOUT )
+
+    return connection
+
+  def _getConnection( self ):  # returns ( connection, if it was used before )
+    with self.connection_lock:
+      if self.idle_list:
+        return ( self.idle_list.pop(), True )
+
+    return ( self._connect(), False )
+
+  def _putConnection( self, connection ):
+    with self.connection_lock:
+      if not self.closed:
+        self.idle_list.append( connection )
+        return
+
+    connection.close()
+
+  # only call from a pool thread, a CInP CALL on one of the kept open connections, the responses are handled the same
+  # as cinp's client.  retries are done in _request so they do not tie up the thread
+  def _call( self, uri, data, timeout ):
+    headers = { 'Content-Type': 'application/json;charset=utf-8', 'Accepts': 'application/json', 'Accept-Charset': 'utf-8', 'CInP-Version': CINP_VERSION, 'User-Agent': USER_AGENT }
+    token = self.token
+    if token is not None:
+      headers[ 'Auth-Id' ] = SUBCONTRACTOR_USERNAME
+      headers[ 'Auth-Token' ] = token
+
+    if self.https or self.proxy is None:
+      path = uri
+    else:  # plain http through the proxy
+      path = '{0}{1}'.format( self.host, uri )
+      headers.update( self.proxy_headers )
+
+    body = json.dumps( data ).encode( 'utf-8' )
+    for retry in ( True, False ):
+      ( connection, reused ) = self._getConnection()
+      connection.timeout = timeout  # the timeout is per call, a re-used connection has the last one
+      if connection.sock is not None:
+        connection.sock.settimeout( timeout )
+
+      try:
+        connection.request( 'CALL', path, body=body, headers=headers )
+        resp = connection.getresponse()
+        buff = resp.read()
+      except TimeoutError:
+        connection.close()
+        raise Timeout( 'Request Timeout after {0} seconds'.format( timeout ) )
+      except ( OSError, HTTPException ) as e:
+        connection.close()
+        if reused and retry:  # contractor closed the connection while it was idle, try again with a new one
+          continue
+
+        if isinstance( e, ConnectionError ) or getattr( e, 'errno', None ) == errno.ENETUNREACH:
+          raise ConnectionFailed( 'Connection to "{0}" failed "{1}"'.format( self.host, e ) )
+
+        raise ResponseError( 'Socket Error "{0}"'.format( e ) )
+
+      break
+
+    if resp.will_close:
+      connection.close()
+    else:
+      self._putConnection( connection )
+
+    if resp.status == 401:
+      logging.warning( 'contractor: Invalid Session' )
+      raise InvalidSession()
+
+    if resp.status == 403:
+      logging.warning( 'contractor: Not Authorized' )
+      raise NotAuthorized()
+
+    if resp.status == 404:
+      logging.warning( 'contractor: Not Found' )
+      raise NotFound()
+
+    if resp.status not in ( 200, 400, 500 ):
+      raise ResponseError( 'Unexpected HTTP Code "{0}" for CALL'.format( resp.status ) )
+
+    buff = buff.decode( 'utf-8' ).strip()
+    try:
+      data = json.loads( buff ) if buff else None
+    except ValueError:
+      if resp.status == 200:  # the other two can have non json bodies
+        raise ResponseError( 'Unable to parse response "{0}"'.format( buff[ 0:200 ] ) )
+      data = None
+
+    if resp.status == 400:
+      if isinstance( data, dict ) and 'message' in data:
+        raise DetailedInvalidRequest( data )
+
+      raise InvalidRequest( buff[ 0:200 ] )
+
+    if resp.status == 500:
+      if isinstance( data, dict ) and 'message' in data:
+        raise ServerError( 'Server Error "{0}"'.format( data[ 'message' ] ) )
+
+      raise ServerError( 'Server Error: "{0}"'.format( buff[ 0:200 ] ) )
+
+    return data
+
+  # retry_timeout=False only retries the connection errors, a timed out long poll is not worth repeating
+  async def _request( self, uri, data, retry_count=0, timeout=REQUEST_TIMEOUT, retry_timeout=True ):
+    loop = asyncio.get_running_loop()
+    method = uri.rsplit( '/', 1 )[ -1 ]
+    try:
+      histogram = self.request_map[ method ]
+    except KeyError:
+      histogram = self.request_map[ method ] = Histogram()
+
+    delay = RETRY_DELAY_MIN
+    while True:
+      start = loop.time()
+      try:
+        with span( 'contractor', method ):
+          return await loop.run_in_executor( self.executor, self._call, uri, data, timeout )
+      except ( Timeout, ConnectionFailed ) as e:
+        self.error_counter.inc( ( method, type( e ).__name__ ) )
+        if retry_count < 1 or self.stop_event.is_set() or ( isinstance( e, Timeout ) and not retry_timeout ):
+          raise
+        error = e
+      except Exception as e:
+        self.error_counter.inc( ( method, type( e ).__name__ ) )
+        raise
+      finally:
+        histogram.observe( loop.time() - start )
+
+      retry_count -= 1
+      self.retry_counter.inc( ( method, ) )
+      logging.debug( 'contractor: "{0}" calling "{1}", retrying in "{2}"...'.format( error, uri, delay ) )
+      try:
+        await asyncio.wait_for( self.stop_event.wait(), delay )
+      except asyncio.TimeoutError:
+        pass
+
+      delay = min( delay * 2, RETRY_DELAY_MAX )
+
   def setModuleList( self, module_list ):
     self.module_list = module_list
 
@@ -52,27 +268,89 @@ class Contractor():
     except NotFound:
       return None
 
+  # wait is how long contractor may hold the request waiting for jobs (long polling), 0 returns right away, the
+  # request times out after wait + LONG_POLL_MARGIN seconds
+  # module_list limits the request to those modules, defaults to all the modules set with setModuleList
   @relogin
-  def getJobs( self, max_jobs ):
-    logging.debug( 'contractor: asking for "{0}" more jobs'.format( max_jobs ) )
-    return self.cinp.call( '/api/v1/SubContractor/Dispatch(getJobs)', { 'site': self.site, 'module_list': self.module_list, 'max_jobs': max_jobs } )
+  async def getJobs( self, max_jobs, wait=0, module_list=None ):
+    if module_list is None:
+      module_list = self.module_list
+
+    logging.debug( 'contractor: asking for "{0}" more jobs for "{1}"'.format( max_jobs, module_list ) )
+    paramaters = { 'site': self.site, 'module_list': module_list, 'max_jobs': max_jobs }
+    if wait and self.long_poll:
+      try:
+        return await self._request( '/api/v1/SubContractor/Dispatch(getJobs)', dict( paramaters, wait=wait ), retry_count=10, timeout=wait + LONG_POLL_MARGIN, retry_timeout=False )
+      except InvalidRequest:
+        logging.info( 'contractor: long polling for jobs not supported, falling back to polling' )
+        self.long_poll = False
+
+    return await self._request( '/api/v1/SubContractor/Dispatch(getJobs)', paramaters, retry_count=10 )
 
   @relogin
-  def jobResults( self, job_id, data, cookie ):
+  async def jobResults( self, job_id, data, cookie ):
     logging.debug( 'contractor: sending results for job "{0}"'.format( job_id ) )
-    return self.cinp.call( '/api/v1/SubContractor/Dispatch(jobResults)', { 'job_id': job_id, 'cookie': cookie, 'data': data }, retry_count=20 )
+    return await self._request( '/api/v1/SubContractor/Dispatch(jobResults)', { 'job_id': job_id, 'cookie': cookie, 'data': data }, retry_count=20 )
 
   @relogin
-  def jobError( self, job_id, msg, cookie ):
+  async def jobError( self, job_id, msg, cookie ):
     logging.debug( 'contractor: sending error for job "{0}"'.format( job_id ) )
-    self.cinp.call( '/api/v1/SubContractor/Dispatch(jobError)', { 'job_id': job_id, 'cookie': cookie, 'msg': msg }, retry_count=20 )
+    await self._request( '/api/v1/SubContractor/Dispatch(jobError)', { 'job_id': job_id, 'cookie': cookie, 'msg': msg }, retry_count=20 )
+
+  async def _submitResult( self, entry ):
+    if 'msg' in entry:
+      await self.jobError( entry[ 'job_id' ], entry[ 'msg' ], entry[ 'cookie' ] )
+      return 'Accepted'
+
+    return await self.jobResults( entry[ 'job_id' ], entry[ 'data' ], entry[ 'cookie' ] )
+
+  # entry_list is a list of { 'job_id', 'cookie' and 'data' or 'msg' }, returns a list of the responses in the same order,
+  # failed per job submissions are returned as the exception
+  @relogin
+  async def submitResults( self, entry_list ):
+    if self.bulk_results:
+      logging.debug( 'contractor: sending results for "{0}" jobs'.format( len( entry_list ) ) )
+      try:
+        response_map = await self._request( '/api/v1/SubContractor/Dispatch(jobResultList)', { 'result_list': entry_list }, retry_count=20 )
+      except ( NotFound, InvalidRequest ):
+        logging.info( 'contractor: bulk job results not supported, falling back to per job results' )
+        self.bulk_results = False
+      else:
+        return [ response_map.get( str( entry[ 'job_id' ] ), 'Error' ) for entry in entry_list ]
+
+    return await asyncio.gather( *[ self._submitResult( entry ) for entry in entry_list ], return_exceptions=True )
 
   @relogin
-  def getDHCPdDynamidPools( self ):
+  async def getDHCPdDynamidPools( self ):
     logging.debug( 'contractor: getting dynamic pools' )
-    return self.cinp.call( '/api/v1/SubContractor/DHCPd(getDynamicPools)', { 'site': self.site }, retry_count=20 )
+    return await self._request( '/api/v1/SubContractor/DHCPd(getDynamicPools)', { 'site': self.site }, retry_count=20 )
 
   @relogin
-  def getDHCPdStaticPools( self ):
+  async def getDHCPdStaticPools( self ):
     logging.debug( 'contractor: getting static assignments by mac' )
-    return self.cinp.call( '/api/v1/SubContractor/DHCPd(getStaticPools)', { 'site': self.site }, retry_count=20 )
+    return await self._request( '/api/v1/SubContractor/DHCPd(getStaticPools)', { 'site': self.site }, retry_count=20 )
+
+  # returns { 'revision': <revision>, 'full': <bool>, 'entry_map': { mac: entry }, 'removed_list': [ mac ] }, if full is true entry_map is
+  # everything, otherwise only what changed since revision, revision None for everything.  returns None if contractor does not support revisions
+  @relogin
+  async def getDHCPdStaticPoolChanges( self, revision ):
+    if not self.static_pool_revisions:
+      return None
+
+    logging.debug( 'contractor: getting static assignment changes since "{0}"'.format( revision ) )
+    try:
+      return await self._request( '/api/v1/SubContractor/DHCPd(getStaticPoolChanges)', { 'site': self.site, 'revision': revision }, retry_count=20 )
+    except ( NotFound, InvalidRequest ):
+      logging.info( 'contractor: static pool revisions not supported, falling back to getting everything' )
+      self.static_pool_revisions = False
+      return None
+
+  def close( self ):
+    self.executor.shutdown( wait=False )
+    with self.connection_lock:
+      self.closed = True
+      connection_list = self.idle_list
+      self.idle_list = []
+
+    for connection in connection_list:
+      connection.close()
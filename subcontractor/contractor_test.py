@@ -0,0 +1,313 @@
+import json
+import time
+import socket
+import asyncio
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip( 'cinp.client' )
+
+from cinp.client import NotFound, InvalidRequest, InvalidSession, ServerError, ResponseError, Timeout
+
+from subcontractor import contractor
+from subcontractor.contractor import Contractor, ConnectionFailed
+from subcontractor.results import ResultCoalescer
+
+
+class FakeCInP():  # the describe and login Contractor does with cinp
+  login_count = 0
+
+  def __init__( self, *args, **kwargs ):
+    super().__init__()
+
+  def describe( self, uri, retry_count=0 ):
+    return ( { 'api-version': contractor.CONTRACTOR_API_VERSION }, None )
+
+  def setAuth( self, username=None, token=None ):
+    pass
+
+  def call( self, uri, data, retry_count=0 ):
+    if uri == '/api/v1/Auth/User(login)':
+      time.sleep( 0.1 )
+      FakeCInP.login_count += 1
+      return 'token{0}'.format( FakeCInP.login_count )
+
+    assert uri == '/api/v1/Auth/User(logout)'
+
+
+# answers the CALLs in the order they are set in call_list, ( uri, ( http status, value ) ), by uri so calls made at the same
+# time to different uris can arrive in any order, ( http status, value ) can also be a function of the request data that returns it
+class FakeServer():
+  def __init__( self ):
+    super().__init__()
+    self.call_list = []
+    self.request_list = []  # ( uri, data, auth token, client port )
+    self.slow_count = 0  # how many of the next CALLs to answer slowly, after 0.3 seconds
+    self.drop = False  # close the connection after answering, without telling the client
+    server = self
+
+    class _Handler( BaseHTTPRequestHandler ):
+      protocol_version = 'HTTP/1.1'
+
+      def do_CALL( self ):
+        data = json.loads( self.rfile.read( int( self.headers[ 'Content-Length' ] ) ) )
+        server.request_list.append( ( self.path, data, self.headers[ 'Auth-Token' ], self.client_address[1] ) )
+        ( uri, response ) = server.call_list.pop( next( ( i for i, ( uri, _ ) in enumerate( server.call_list ) if uri == self.path ), 0 ) )
+        ( status, value ) = response( data ) if callable( response ) else response
+        if server.slow_count:
+          server.slow_count -= 1
+          time.sleep( 0.3 )
+
+        assert self.path == uri
+        body = value if isinstance( value, bytes ) else json.dumps( value ).encode()
+        self.send_response( status )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        self.end_headers()
+        self.wfile.write( body )
+        if server.drop:
+          self.close_connection = True
+
+      def log_message( self, *args ):
+        pass
+
+    self.server = ThreadingHTTPServer( ( '127.0.0.1', 0 ), _Handler )
+    self.host = 'http://127.0.0.1:{0}'.format( self.server.server_address[1] )
+    threading.Thread( target=self.server.serve_forever, args=( 0.05, ), daemon=True ).start()
+
+  def close( self ):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+@pytest.fixture
+def server():
+  server = FakeServer()
+  yield server
+  server.close()
+  assert server.call_list == []
+
+
+def _client( monkeypatch, host ):
+  monkeypatch.setattr( contractor, 'CInP', FakeCInP )
+  monkeypatch.setattr( contractor, 'RETRY_DELAY_MIN', 0.01 )
+  monkeypatch.setattr( contractor, 'RETRY_DELAY_MAX', 0.04 )
+  FakeCInP.login_count = 0
+  return Contractor( 'site1', host, '/api/v1/', None, asyncio.Event() )
+
+
+@pytest.fixture
+def client( monkeypatch, server ):
+  client = _client( monkeypatch, server.host )
+  yield client
+  client.close()
+
+
+def _deadHost():
+  sock = socket.socket()
+  sock.bind( ( '127.0.0.1', 0 ) )
+  port = sock.getsockname()[1]
+  sock.close()
+  return 'http://127.0.0.1:{0}'.format( port )
+
+
+def test_keep_alive( client, server ):
+  server.call_list = [ ( '/api/v1/test(call)', ( 200, { 'value': i } ) ) for i in range( 3 ) ]
+
+  async def main():
+    for i in range( 3 ):
+      assert await client._request( '/api/v1/test(call)', { 'i': i } ) == { 'value': i }
+
+  asyncio.run( main() )
+  assert [ request[ 1:3 ] for request in server.request_list ] == [ ( { 'i': i }, 'token1' ) for i in range( 3 ) ]
+  assert len( set( [ request[3] for request in server.request_list ] ) ) == 1  # all on the same connection
+
+
+def test_stale_connection( client, server ):
+  server.call_list = [ ( '/api/v1/test(call)', ( 200, i ) ) for i in range( 2 ) ]
+  server.drop = True
+
+  async def main():
+    assert await client._request( '/api/v1/test(call)', {} ) == 0
+    await asyncio.sleep( 0.1 )
+    assert await client._request( '/api/v1/test(call)', {} ) == 1  # the connection was closed while idle, a new one is made
+
+  asyncio.run( main() )
+  assert server.request_list[0][3] != server.request_list[1][3]
+  assert client.retry_counter.value_map == {}
+
+
+def test_response_errors( client, server ):
+  server.call_list = [ ( '/api/v1/test(call)', response ) for response in ( ( 404, None ), ( 400, 'bad' ), ( 400, { 'message': 'bad' } ), ( 401, None ), ( 500, { 'message': 'oops' } ), ( 200, b'not json' ), ( 200, None ) ) ]
+
+  async def main():
+    for error in ( NotFound, InvalidRequest, InvalidRequest, InvalidSession, ServerError, ResponseError ):
+      with pytest.raises( error ):
+        await client._request( '/api/v1/test(call)', {}, retry_count=2 )
+
+    assert await client._request( '/api/v1/test(call)', {} ) is None
+
+  asyncio.run( main() )
+  assert len( set( [ request[3] for request in server.request_list ] ) ) == 1  # errors don't cost the connection
+  assert client.retry_counter.value_map == {}
+
+
+def test_retry_connection_failed( monkeypatch, caplog ):
+  client = _client( monkeypatch, _deadHost() )
+  caplog.set_level( logging.DEBUG )
+
+  async def main():
+    with pytest.raises( ConnectionFailed ):
+      await client._request( '/api/v1/test(call)', {}, retry_count=4 )
+
+  asyncio.run( main() )
+  client.close()
+  assert client.retry_counter.value_map == { ( 'test(call)', ): 4 }
+  assert client.error_counter.value_map == { ( 'test(call)', 'ConnectionFailed' ): 5 }
+  delay_list = [ record.getMessage().rsplit( '"', 2 )[1] for record in caplog.records if 'retrying in' in record.getMessage() ]
+  assert delay_list == [ '0.01', '0.02', '0.04', '0.04' ]  # doubling up to RETRY_DELAY_MAX
+
+
+def test_retry_timeout( client, server ):
+  server.call_list = [ ( '/api/v1/test(call)', ( 200, i ) ) for i in range( 4 ) ]
+
+  async def main():
+    server.slow_count = 1
+    with pytest.raises( Timeout ):
+      await client._request( '/api/v1/test(call)', {}, timeout=0.1 )
+
+    assert await client._request( '/api/v1/test(call)', {}, timeout=0.1 ) == 1
+
+    server.slow_count = 1
+    assert await client._request( '/api/v1/test(call)', {}, retry_count=3, timeout=0.1 ) == 3  # 2 was answered after the timeout
+    await asyncio.sleep( 0.3 )  # the slow answers are done before the server is closed
+
+  asyncio.run( main() )
+  assert client.retry_counter.value_map == { ( 'test(call)', ): 1 }
+
+
+def test_stop_event( monkeypatch ):
+  client = _client( monkeypatch, _deadHost() )
+
+  async def main():
+    client.stop_event.set()
+    with pytest.raises( ConnectionFailed ):
+      await client._request( '/api/v1/test(call)', {}, retry_count=10 )  # not retried once stopping
+    assert client.retry_counter.value_map == {}
+
+    client.stop_event.clear()
+    contractor.RETRY_DELAY_MIN = 30
+    task = asyncio.create_task( client._request( '/api/v1/test(call)', {}, retry_count=10 ) )
+    await asyncio.sleep( 0.2 )
+    assert not task.done()  # waiting to retry
+    start = time.monotonic()
+    client.stop_event.set()
+    with pytest.raises( ConnectionFailed ):
+      await task
+    assert time.monotonic() - start < 1  # the wait was cut short
+
+  asyncio.run( main() )
+  client.close()
+  assert client.retry_counter.value_map == { ( 'test(call)', ): 1 }
+
+
+def test_relogin( client, server ):
+  server.call_list = [ ( '/api/v1/SubContractor/DHCPd(getDynamicPools)', ( 401, None ) ) ] * 2 + [ ( '/api/v1/SubContractor/DHCPd(getDynamicPools)', ( 200, [] ) ) ] * 2
+
+  async def main():
+    return await asyncio.gather( client.getDHCPdDynamidPools(), client.getDHCPdDynamidPools() )
+
+  assert asyncio.run( main() ) == [ [], [] ]
+  assert FakeCInP.login_count == 2  # the first login and one re-login for both
+  assert client.token == 'token2'
+  assert [ request[2] for request in server.request_list ] == [ 'token1', 'token1', 'token2', 'token2' ]
+
+
+@pytest.mark.parametrize( 'response', [ ( 404, None ), ( 400, 'not supported' ) ] )
+def test_static_pool_changes_fallback( client, server, response ):
+  changes = { 'revision': 2, 'full': False, 'entry_map': {}, 'removed_list': [] }
+  server.call_list = [ ( '/api/v1/SubContractor/DHCPd(getStaticPoolChanges)', ( 200, changes ) ), ( '/api/v1/SubContractor/DHCPd(getStaticPoolChanges)', response ) ]
+
+  async def main():
+    assert await client.getDHCPdStaticPoolChanges( 1 ) == changes
+    assert client.static_pool_revisions is True
+    assert await client.getDHCPdStaticPoolChanges( 2 ) is None
+    assert client.static_pool_revisions is False
+    assert await client.getDHCPdStaticPoolChanges( 2 ) is None  # does not ask again
+
+  asyncio.run( main() )
+  assert len( server.request_list ) == 2
+
+
+def test_long_poll_timeout( client, server, monkeypatch ):
+  monkeypatch.setattr( contractor, 'LONG_POLL_MARGIN', 0.1 )
+  server.call_list = [ ( '/api/v1/SubContractor/Dispatch(getJobs)', ( 200, [] ) ) ] * 3
+
+  async def main():
+    server.slow_count = 2
+    with pytest.raises( Timeout ):
+      await client.getJobs( 1, wait=0.1 )  # 0.3 seconds is longer than wait + margin, not retried
+
+    assert await client.getJobs( 1, wait=0.25 ) == []  # the margin is on top of wait
+    assert await client.getJobs( 1 ) == []
+    await asyncio.sleep( 0.3 )
+
+  asyncio.run( main() )
+  assert [ request[1].get( 'wait' ) for request in server.request_list ] == [ 0.1, 0.25, None ]
+  assert client.retry_counter.value_map == {}
+  assert client.long_poll is True
+
+
+def _submit( client, error_job_id=None ):  # the results of four jobs, the way the waiting JobWorkers send them
+  results = ResultCoalescer( client, window=0.1 )
+
+  async def main():
+    return await asyncio.gather( results.jobResults( 1, { 'a': 1 }, 'c1' ), results.jobError( 2, 'failed', 'c2' ), results.jobResults( 3, { 'a': 3 }, 'c3' ),
+                                 results.jobResults( 4, { 'a': 4 }, 'c4' ), return_exceptions=True )
+
+  return asyncio.run( main() )
+
+
+def test_submit_results_bulk( client, server ):
+  server.call_list = [ ( '/api/v1/SubContractor/Dispatch(jobResultList)', ( 200, { '1': 'Accepted', '2': 'Accepted', '3': 'Error' } ) ) ]  # 4 is missing
+
+  assert _submit( client ) == [ 'Accepted', 'Accepted', 'Error', 'Error' ]
+  assert len( server.request_list ) == 1
+  assert server.request_list[0][1] == { 'result_list': [ { 'job_id': 1, 'cookie': 'c1', 'data': { 'a': 1 } }, { 'job_id': 2, 'cookie': 'c2', 'msg': 'failed' },
+                                                         { 'job_id': 3, 'cookie': 'c3', 'data': { 'a': 3 } }, { 'job_id': 4, 'cookie': 'c4', 'data': { 'a': 4 } } ] }
+  assert client.bulk_results is True
+
+
+def test_submit_results_bulk_error( client, server ):
+  server.call_list = [ ( '/api/v1/SubContractor/Dispatch(jobResultList)', ( 500, { 'message': 'oops' } ) ) ]
+
+  response_list = _submit( client )
+  assert [ type( response ) for response in response_list ] == [ ServerError ] * 4  # every worker gets it, their results stay in the spool
+  assert client.bulk_results is True
+
+
+def _jobResults( data ):
+  if data[ 'job_id' ] == 3:
+    return ( 500, { 'message': 'oops' } )
+
+  return ( 200, 'Accepted' if data[ 'job_id' ] == 1 else 'Error' )
+
+
+@pytest.mark.parametrize( 'response', [ ( 404, None ), ( 400, 'unknown method' ) ] )
+def test_submit_results_fallback( client, server, response ):
+  server.call_list = [ ( '/api/v1/SubContractor/Dispatch(jobResultList)', response ) ]
+  server.call_list += [ ( '/api/v1/SubContractor/Dispatch(jobResults)', _jobResults ) ] * 3 + [ ( '/api/v1/SubContractor/Dispatch(jobError)', ( 200, None ) ) ]
+
+  response_list = _submit( client )
+  assert response_list[ 0:2 ] == [ 'Accepted', 'Accepted' ]  # jobError does not have a response
+  assert isinstance( response_list[2], ServerError )  # only that job failed
+  assert response_list[3] == 'Error'
+  assert client.bulk_results is False
+  assert sorted( [ ( request[0].rsplit( '/', 1 )[1], request[1][ 'job_id' ] ) for request in server.request_list[ 1: ] ] ) == [ ( 'Dispatch(jobError)', 2 ), ( 'Dispatch(jobResults)', 1 ), ( 'Dispatch(jobResults)', 3 ), ( 'Dispatch(jobResults)', 4 ) ]
+
+  # does not try the bulk call again
+  server.call_list = [ ( '/api/v1/SubContractor/Dispatch(jobResults)', _jobResults ) ] * 3 + [ ( '/api/v1/SubContractor/Dispatch(jobError)', ( 200, None ) ) ]
+  assert _submit( client )[ 0:2 ] == [ 'Accepted', 'Accepted' ]
+  assert 'jobResultList' not in server.request_list[ -1 ][0]
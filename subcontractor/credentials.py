@@ -1,6 +1,18 @@
 import json
 import ssl
-from urllib import request
+import base64
+import copy
+import time
+import logging
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import urlsplit, unquote
+from urllib.request import _parse_proxy
+
+from subcontractor.metrics import REGISTRY, Counter
 
 
 VAULT_TIMEOUT = 20
@@ -15,6 +27,35 @@ def getCredentials( value ):
   return _handler.get( value )
 
 
+def findCredentials( value ):  # the credential names in the values of keys with "credentials" in the name, ie: job paramaters
+  result = set()
+  if isinstance( value, list ):
+    for item in value:
+      result |= findCredentials( item )
+
+  elif isinstance( value, dict ):
+    for name, item in value.items():
+      if isinstance( item, str ) and isinstance( name, str ) and 'credentials' in name:
+        result.add( item )
+      else:
+        result |= findCredentials( item )
+
+  return result
+
+
+# starts fetching the credentials in value, ie: a batch of job paramaters, returns the Task, or None if there is
+# nothing to do.  The Task does not raise, anything that fails is fetched again by getCredentials
+def prefetchCredentials( value ):
+  if not isinstance( _handler, CredentialCache ):  # without a cache there is nowhere to keep them
+    return None
+
+  name_list = findCredentials( value )
+  if not name_list:
+    return None
+
+  return asyncio.create_task( _handler.prefetch( name_list ) )
+
+
 def setup( config ):
   global _handler
 
@@ -27,7 +68,12 @@ def setup( config ):
     _handler = HashiCorptVault( config.get( 'credentials', 'host' ),
                                 config.get( 'credentials', 'token' ),
                                 config.get( 'credentials', 'proxy', fallback=None ),
-                                config.getboolean( 'credentials', 'verify_ssl', fallback=True ) )
+                                config.getboolean( 'credentials', 'verify_ssl', fallback=True ),
+                                config.getint( 'credentials', 'pool_size', fallback=4 ) )
+
+    cache_ttl = config.getfloat( 'credentials', 'cache_ttl', fallback=300 )
+    if cache_ttl > 0:
+      _handler = CredentialCache( _handler, cache_ttl, config.getint( 'credentials', 'cache_size', fallback=1000 ), config.getfloat( 'credentials', 'cache_refresh', fallback=0 ) )
 
   else:
     raise ValueError( 'Unknown Credentials type "{0}"'.format( vault_type ) )
@@ -41,33 +87,195 @@ class NullVault():
     return None
 
 
+# keeps a connection to the vault open in each thread that uses it, so the TLS handshake is not done for every lookup,
+# getAsync runs get in the vault's own threads, pool_size of them
 class HashiCorptVault():
-  def __init__( self, host, token, proxy=None, verify_ssl=True ):
+  def __init__( self, host, token, proxy=None, verify_ssl=True, pool_size=4 ):
     super().__init__()
 
     if host[-1] == '/':
       raise ValueError( 'VAULT_HOST must not end with "/"' )
 
     self.host = host
+    self.token = token
+    url = urlsplit( host )
+    self.https = url.scheme == 'https'
+    self.netloc = url.netloc
+    self.base_path = url.path
+    self.proxy = None
+    self.proxy_headers = {}
+    if proxy is not None:  # with or without a scheme, and user:password, like ProxyHandler
+      ( _, user, password, self.proxy ) = _parse_proxy( proxy )
+      if user is not None:
+        self.proxy_headers[ 'Proxy-Authorization' ] = 'Basic {0}'.format( base64.b64encode( '{0}:{1}'.format( unquote( user ), unquote( password or '' ) ).encode() ).decode() )
 
-    handler_list = []
-
-    if proxy is not None:
-      handler_list.append( request.ProxyHandler( { 'http': proxy, 'https': proxy } ) )
+    if not verify_ssl:
+      self.ssl_context = ssl._create_unverified_context()
     else:
-      handler_list.append( request.ProxyHandler( {} ) )
+      self.ssl_context = ssl.create_default_context()
 
-    if not verify_ssl:
-      handler_list.append( request.HTTPSHandler( context=ssl._create_unverified_context() ) )
+    self.local = threading.local()
+    self.executor = ThreadPoolExecutor( max_workers=pool_size, thread_name_prefix='vault' )
+
+  def _connect( self ):
+    if self.https:
+      if self.proxy is not None:
+        connection = HTTPSConnection( self.proxy, timeout=VAULT_TIMEOUT, context=self.ssl_context )
+        connection.set_tunnel( self.netloc, headers=self.proxy_headers )
+      else:
+        connection = HTTPSConnection( self.netloc, timeout=VAULT_TIMEOUT, context=self.ssl_context )
+
+    else:
+      connection = HTTPConnection( self.proxy or self.netloc, timeout=VAULT_TIMEOUT )
 
-    self.opener = request.build_opener( *handler_list )
+    return connection
 
-    self.opener.addheaders = [
-        ( 'X-Vault-Token', token ),
-    ]
+  def _close( self ):
+    self.local.connection.close()
+    self.local.connection = None
 
   def get( self, url ):
-    req = request.Request( '{0}{1}'.format( self.host, url ), method='GET' )
-    resp = self.opener.open( req, timeout=VAULT_TIMEOUT )
+    headers = { 'X-Vault-Token': self.token }
+    if self.https or self.proxy is None:
+      path = '{0}{1}'.format( self.base_path, url )
+    else:  # plain http through the proxy
+      path = '{0}{1}'.format( self.host, url )
+      headers.update( self.proxy_headers )
+
+    for retry in ( True, False ):
+      if getattr( self.local, 'connection', None ) is None:
+        self.local.connection = self._connect()
+
+      try:
+        self.local.connection.request( 'GET', path, headers=headers )
+        resp = self.local.connection.getresponse()
+        body = resp.read()
+      except ( ConnectionError, HTTPException ):  # the vault closed the connection while it was idle, try again with a new one
+        self._close()
+        if retry:
+          continue
+        raise
+      except Exception:
+        self._close()
+        raise
+
+      break
+
+    if resp.will_close:
+      self._close()
+
     # TODO: catch 404, 403, etc
-    return json.loads( resp.read().decode() )[ 'data' ][ 'data' ]
+    if resp.status != 200:
+      raise Exception( 'Vault returned "{0}" for "{1}"'.format( resp.status, url ) )
+
+    return json.loads( body.decode() )[ 'data' ][ 'data' ]
+
+  async def getAsync( self, url ):
+    return await asyncio.get_running_loop().run_in_executor( self.executor, self.get, url )
+
+
+# wraps a vault, keeps what it returns in memory ( never on disk ) for ttl seconds, at most max_size entries, the least
+# recently used are dropped first.  Concurrent gets for the same name that are not cached wait on the same request to
+# the vault.  If refresh is more than 0, a get within refresh seconds of the entry expiring re-fetches it in the
+# background, so the busy entries don't expire.  get is called by the plugins from the executor threads, so this is
+# thread safe, modules running in process pools each have their own cache.
+class CredentialCache():
+  def __init__( self, vault, ttl, max_size=1000, refresh=0 ):
+    super().__init__()
+    self.vault = vault
+    self.ttl = ttl
+    self.max_size = max_size
+    self.refresh = refresh
+    self.lock = threading.Lock()
+    self.entry_map = OrderedDict()  # key is name, value is ( value, expires ), least recently used first
+    self.pending_map = {}  # key is name, value is the Future of the request to the vault
+    self.counter = Counter()  # by result
+    REGISTRY.register( 'credentials_cache_total', 'counter', 'credential lookups, by result', ( 'result', ), lambda: self.counter.value_map )
+
+  def get( self, name ):  # the caller gets it's own copy
+    now = time.monotonic()
+    with self.lock:
+      try:
+        ( value, expires ) = self.entry_map[ name ]
+      except KeyError:
+        expires = None
+
+      if expires is not None and expires > now:
+        self.entry_map.move_to_end( name )
+        self.counter.inc( ( 'hit', ) )
+        if self.refresh > 0 and expires - now < self.refresh and name not in self.pending_map:
+          self.counter.inc( ( 'refresh', ) )
+          future = self.pending_map[ name ] = Future()
+          threading.Thread( target=self._refresh, args=( name, future ), name='credential refresh', daemon=True ).start()
+
+        return copy.deepcopy( value )
+
+      future = self.pending_map.get( name, None )
+      if future is None:
+        self.counter.inc( ( 'miss', ) )
+        future = self.pending_map[ name ] = Future()
+        fetch = True
+      else:
+        self.counter.inc( ( 'wait', ) )
+        fetch = False
+
+    if fetch:
+      self._fetch( name, future )
+
+    return copy.deepcopy( future.result() )
+
+  def _fetch( self, name, future ):
+    try:
+      value = self.vault.get( name )
+    except Exception as e:
+      self._done( name, future, exception=e )
+      return
+
+    self._done( name, future, value )
+
+  def _prefetch( self, name, future ):  # runs in the vault's executor
+    self._fetch( name, future )
+    if future.exception() is not None:
+      logging.warning( 'credentials: unable to prefetch "{0}": {1}'.format( name, future.exception() ) )
+
+  def _done( self, name, future, value=None, exception=None ):  # failures are not cached, the waiting gets get the exception
+    with self.lock:
+      del self.pending_map[ name ]
+      if exception is None:
+        self.entry_map[ name ] = ( value, time.monotonic() + self.ttl )
+        self.entry_map.move_to_end( name )
+        while len( self.entry_map ) > self.max_size:
+          self.entry_map.popitem( last=False )
+
+    if exception is None:
+      future.set_result( value )
+    else:
+      future.set_exception( exception )
+
+  # fetches the names that are not cached, or are due to be refreshed, all at the same time, gets for them while
+  # this is going wait for it.  The fetches are done entirely in the vault's executor, so a get from a coroutine on
+  # the event loop can wait on one without it needing the event loop to finish
+  async def prefetch( self, name_list ):
+    loop = asyncio.get_running_loop()
+    fetch_list = []
+    now = time.monotonic()
+    with self.lock:
+      for name in name_list:
+        try:
+          ( _, expires ) = self.entry_map[ name ]
+        except KeyError:
+          expires = None
+
+        if ( expires is not None and expires - now > self.refresh ) or name in self.pending_map:
+          continue
+
+        self.counter.inc( ( 'prefetch', ) )
+        future = self.pending_map[ name ] = Future()
+        fetch_list.append( loop.run_in_executor( self.vault.executor, self._prefetch, name, future ) )
+
+    await asyncio.gather( *fetch_list )
+
+  def _refresh( self, name, future ):
+    self._fetch( name, future )
+    if future.exception() is not None:  # the cached value is good until it expires
+      logging.warning( 'credentials: unable to refresh "{0}": {1}'.format( name, future.exception() ) )
@@ -9,6 +9,16 @@ import asyncio
 from logging.handlers import SysLogHandler
 from logging import StreamHandler
 
+from subcontractor.metrics import startServer, addEndpoint
+from subcontractor.profiler import Profiler
+
+MAX_PROFILE_SECONDS = 3600  # the longest GET /profile will sample for
+
+
+def _readFile( filename ):
+  with open( filename, 'r' ) as fp:
+    return fp.read()
+
 
 class ColorizerStreamHandler( StreamHandler ):  # ANSI coloring, really should detect if it's an ANSI screen first
   def emit( self, record ):
@@ -30,11 +40,14 @@ class ColorizerStreamHandler( StreamHandler ):  # ANSI coloring, really should d
 
 class Daemon():
   default_config_file = 'config.conf'
+  metrics_port_option = 'port'  # option in the [metrics] section with the port to serve metrics on, the daemons share a config file
 
   def __init__( self, name ):
     super().__init__()
     self.name = name
     self.pid_file = None
+    self.metrics_server = None
+    self.profiler = None
 
   def config( self, config ):  # override
     pass
@@ -49,6 +62,14 @@ class Daemon():
     logging.debug( 'daemon: loading config...' )
     self.config( config )
 
+    # SIGUSR1 or GET /profile?seconds=<seconds> on the metrics port to profile
+    self.profiler = Profiler( self.name, config.get( 'profiler', 'directory', fallback='/tmp' ), config.getfloat( 'profiler', 'seconds', fallback=30 ), slow_callback_duration=config.getfloat( 'profiler', 'slow_callback_duration', fallback=0.1 ) )
+    addEndpoint( '/profile', self._profileEndpoint )
+
+    port = config.getint( 'metrics', self.metrics_port_option, fallback=0 )
+    if port:  # before changing user, it may be a privileged port
+      self.metrics_server = await startServer( config.get( 'metrics', 'listen_address', fallback='127.0.0.1' ), port )
+
     if args.user is not None:
       logging.debug( 'daemon: changing to user "{0}"...'.format( args.user ) )
       self._change_user( args.user )
@@ -57,11 +78,16 @@ class Daemon():
     loop.add_signal_handler( signal.SIGINT, self._sigHandlerStop )
     loop.add_signal_handler( signal.SIGQUIT, self._sigHandlerStop )
     loop.add_signal_handler( signal.SIGTERM, self._sigHandlerStop )
+    loop.add_signal_handler( signal.SIGUSR1, self.profiler.start )
 
     logging.debug( 'daemon: starting main function...' )
     await self.main()
     logging.debug( 'daemon: main completed' )
 
+    if self.metrics_server is not None:
+      self.metrics_server.close()
+      await self.metrics_server.wait_closed()
+
   def run( self ):
     parser = argparse.ArgumentParser( description=self.name )
     parser.add_argument( '-c', '--config', help='location of config file', default=self.default_config_file )
@@ -173,6 +199,21 @@ class Daemon():
     logging.info( 'daemon: got stop signal' )
     self.stop()
 
+  async def _profileEndpoint( self, query_map ):  # returns the collapsed stacks
+    try:
+      seconds = float( query_map[ 'seconds' ][0] )
+    except KeyError:
+      seconds = None
+
+    if seconds is not None and not 0 < seconds <= MAX_PROFILE_SECONDS:  # also catches nan
+      raise ValueError( 'seconds must be more than 0 and at most {0}'.format( MAX_PROFILE_SECONDS ) )
+
+    filename = await self.profiler.profile( seconds )
+    if filename is None:
+      raise ValueError( 'Allready profiling' )
+
+    return await asyncio.get_running_loop().run_in_executor( None, _readFile, filename )
+
   def _daemonize( self ):
     logging.debug( 'daemon: damonizing...' )
     logging.debug( 'daemon: first fork...' )
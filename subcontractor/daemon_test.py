@@ -0,0 +1,22 @@
+import asyncio
+
+import pytest
+
+from subcontractor.daemon import Daemon
+from subcontractor.profiler import Profiler
+
+
+def test_profile_endpoint( tmp_path ):
+  daemon = Daemon( 'test' )
+  daemon.profiler = Profiler( 'test', str( tmp_path ), 30, interval=0.001 )
+
+  async def main():
+    for seconds in ( '0', '-1', 'nan', 'inf', '3601', 'soon' ):
+      with pytest.raises( ValueError ):
+        await daemon._profileEndpoint( { 'seconds': [ seconds ] } )
+
+    assert daemon.profiler.running is False
+    return await daemon._profileEndpoint( { 'seconds': [ '0.1' ] } )
+
+  body = asyncio.run( main() )
+  assert 'MainThread;' in body
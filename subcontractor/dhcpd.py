@@ -1,5 +1,7 @@
 import logging
-import pickle
+import socket
+import asyncio
+import zlib
 
 from pydhcplib.dhcp_network import DhcpServer
 from pydhcplib.dhcp_constants import DhcpOptions
@@ -9,58 +11,102 @@ from pydhcplib.type_strlist import strlist
 from pydhcplib.type_hwmac import hwmac
 from pydhcplib.interface import interface
 
+from subcontractor.pool_set import PoolSet
+from subcontractor.metrics import REGISTRY, Histogram
+from subcontractor.profiler import span
 
-class DHCPd( DhcpServer ):
-  def __init__( self, listen_interface, listen_address, tftp_server ):
+
+# snapshot returns what DHCPd.metrics does, in multi process mode the parent merges the workers'
+def registerMetrics( snapshot ):
+  REGISTRY.register( 'dhcpd_packets_total', 'counter', 'packets recieved, by message type', ( 'type', ), lambda: dict( [ ( ( name, ), count ) for name, count in snapshot()[ 'packets' ].items() ] ) )
+  REGISTRY.register( 'dhcpd_dropped_packets_total', 'counter', 'packets dropped because the queue was full', (), lambda: { (): snapshot()[ 'dropped' ] } )
+  REGISTRY.register( 'dhcpd_queue_depth', 'gauge', 'packets waiting for a worker', (), lambda: { (): snapshot()[ 'queue_depth' ] } )
+  REGISTRY.register( 'dhcpd_reclaimed_leases_total', 'counter', 'expired leases freed', ( 'pool', ), lambda: dict( [ ( ( name, ), count ) for name, count in snapshot()[ 'reclaimed' ].items() ] ) )
+
+  def _response():
+    histogram = Histogram()
+    histogram.merge( snapshot()[ 'response' ] )
+    return { (): histogram }
+
+  REGISTRY.register( 'dhcpd_response_seconds', 'histogram', 'time from recieving a packet to done handling it', (), _response )
+
+
+# process_index and process_count are for when there is more than one process sharing the port, see reuse_port
+class DHCPd( DhcpServer, PoolSet ):
+  def __init__( self, listen_interface, listen_address, tftp_server, worker_count=4, queue_size=256, reuse_port=False, process_index=0, process_count=1 ):
+    self.reuse_port = reuse_port  # EnableReuseaddr is called durring DhcpServer's __init__
     super().__init__( listen_interface, listen_address, 68, 67 )
+    PoolSet.__init__( self )
     iface = interface()
     if listen_interface not in iface.getInterfaceList():
       raise Exception( 'Interface "{0}" not available'.format( listen_interface ) )
 
     self.cont = True
-    self.pool_map = {}
-    self.pool_order = []
+    self.process_index = process_index
+    self.process_count = process_count
+    self.worker_count = worker_count
+    self.queue_size = queue_size
+    self.queue_list = []  # one per worker, only while running
+    self.handled_count = 0
+    self.drop_count = 0
+    self.packet_count_map = { 'discover': 0, 'request': 0, 'decline': 0, 'release': 0 }
+    self.response_histogram = Histogram()
+    registerMetrics( self.metrics )
     self.tftp_server = ipv4( tftp_server ).list()
     self.dhcp_server_ip = ipv4( iface.getAddr( listen_interface ) ).list()
 
-  def setOptions( self, request, reply, item ):
+  # the options that only depend on the pool entry, how the client boots and if it is iPXE, these are built
+  # once per entry and reused for every request from that client until the pool entry changes
+  def _buildOptions( self, item, boot_type, ipxe ):
     address, netmask, gateway, mtu, vlan, dns_server, host_name, domain_name, config_uuid, console, lease_time = item
 
-    parameter_request_list = request.GetOption( 'parameter_request_list' )
-    user_class = strlist( request.GetOption( 'user_class' ) ).str()
-    architecture = request.GetOption( 'client_system' )
-
-    reply.SetOption( 'server_identifier', self.dhcp_server_ip )
-    reply.SetOption( 'ip_address_lease_time', lease_time )
-    reply.SetOption( 'yiaddr', address )
-    reply.SetOption( 'subnet_mask', netmask )
+    option_list = []
+    option_list.append( ( 'ip_address_lease_time', lease_time ) )
+    option_list.append( ( 'yiaddr', address ) )
+    option_list.append( ( 'subnet_mask', netmask ) )
     if gateway:
-      reply.SetOption( 'router', gateway )
+      option_list.append( ( 'router', gateway ) )
 
     if host_name:
-      reply.SetOption( 'host_name', host_name )
+      option_list.append( ( 'host_name', host_name ) )
 
     if domain_name:
-      reply.SetOption( 'domain_name', domain_name )
-      reply.SetOption( 'domain_search', [ domain_name ] )
+      option_list.append( ( 'domain_name', domain_name ) )
+      option_list.append( ( 'domain_search', [ domain_name ] ) )
 
     if dns_server:
-      reply.SetOption( 'domain_name_server', dns_server )
+      option_list.append( ( 'domain_name_server', dns_server ) )
 
     if mtu is not None:
-      reply.SetOption( 'interface_mtu', mtu )
+      option_list.append( ( 'interface_mtu', mtu ) )
 
     if vlan is not None:
-      reply.SetOption( 'vlan', vlan )
+      option_list.append( ( 'vlan', vlan ) )
 
     if config_uuid:
-      reply.SetOption( 'config_file', config_uuid )
+      option_list.append( ( 'config_file', config_uuid ) )
+
+    if ipxe:
+      option_list.append( ( 'ipxe.no-pxedhcp', [ 1 ] ) )  # disable iPXE's waiting on proxy DHCP
+
+    if boot_type is not None:
+      option_list.append( ( 'siaddr', self.tftp_server ) )
+      boot_file = strlist( '{0}.{1}'.format( console, boot_type ) ).list()
+      option_list.append( ( 'file', boot_file + [ 0 ] * ( 128 - len( boot_file  ) ) ) )
 
-    if user_class == 'iPXE':
-      reply.SetOption( 'ipxe.no-pxedhcp', [ 1 ] )  # disable iPXE's waiting on proxy DHCP
+    return option_list
 
+  # templates is the pool's dict for item ( see option_templates ), key is ( boot type, iPXE ), value is the option list,
+  # if None the options are not cached
+  def setOptions( self, request, reply, item, templates=None ):
+    console = item[ 9 ]
+
+    parameter_request_list = request.GetOption( 'parameter_request_list' )
+    user_class = strlist( request.GetOption( 'user_class' ) ).str()
+    architecture = request.GetOption( 'client_system' )
+
+    boot_type = None
     if DhcpOptions[ 'bootfile_name' ] in parameter_request_list and console is not None:
-      reply.SetOption( 'siaddr', self.tftp_server )
       try:
         architecture = int( architecture[0] << 8 ) + int( architecture[1] )
       except IndexError:
@@ -68,15 +114,15 @@ class DHCPd( DhcpServer ):
 
       # see https://www.iana.org/assignments/dhcpv6-parameters/dhcpv6-parameters.xhtml#processor-architecture
       if architecture == 7:  # x64 UEFI
-        boot_file = strlist( '{0}.efi'.format( console ) ).list()
+        boot_type = 'efi'
       # elif architecture == 6: # x86 UEFI
-      #   boot_file = strlist( '{0}.efi'.format( console ) ).list()
+      #   boot_type = 'efi'
       # elif architecture == 10: # ARM 32bit UEFI
-      #   boot_file = strlist( '{0}.efi'.format( console ) ).list()
+      #   boot_type = 'efi'
       # elif architecture == 11: # ARM 64bit UEFI
-      #   boot_file = strlist( '{0}.efi'.format( console ) ).list()
+      #   boot_type = 'efi'
       else:  # 0 = x86 BIOS
-        boot_file = strlist( '{0}.kpxe'.format( console ) ).list()
+        boot_type = 'kpxe'
 
       # match if substring (option vendor-class-identifier, 0, 9) = "PXEClient";
       # next-server 192.168.111.1;
@@ -97,9 +143,88 @@ class DHCPd( DhcpServer ):
       # 00:13 	arm 64 UEFI HTTP
       # (undefined/other) 	Legacy x86 PXE
 
-      reply.SetOption( 'file', boot_file + [ 0 ] * ( 128 - len( boot_file  ) ) )
+    template_key = ( boot_type, user_class == 'iPXE' )
+    option_list = None
+    if templates is not None:
+      option_list = templates.get( template_key, None )
+
+    if option_list is None:
+      option_list = self._buildOptions( item, *template_key )
+      if templates is not None:
+        templates[ template_key ] = option_list
+
+    reply.SetOption( 'server_identifier', self.dhcp_server_ip )
+    for name, value in option_list:
+      reply.SetOption( name, value )
+
+  def EnableReuseaddr( self ):
+    super().EnableReuseaddr()
+    if self.reuse_port:
+      self.dhcp_socket.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+
+  # with more than one process on the port every process gets a copy of the broadcasts, so each only answers the macs
+  # that hash to it.  Relayed packets are unicast to the port, so only one process gets them, that process answers
+  # regardless of the mac.  Unicast renewals that land on the wrong process are dropped, the client then
+  # re-binds with a broadcast, which the right process answers.
+  def _isMine( self, request ):
+    if self.process_count < 2:
+      return True
+
+    if any( request.GetOption( 'giaddr' ) ):
+      return True
+
+    return zlib.crc32( bytes( request.GetHardwareAddress()[ 0:6 ] ) ) % self.process_count == self.process_index
+
+  # the packets are queued by mac, so packets from the same client are handled in order by the same worker,
+  # if not running ( ie: no workers ) the packet is handled right away
+  async def _queue( self, handler, request, message_type ):
+    if not self._isMine( request ):
+      return
+
+    self.packet_count_map[ message_type ] += 1
+
+    loop = asyncio.get_running_loop()
+    if not self.queue_list:
+      received = loop.time()
+      with span( 'dhcpd', message_type ):
+        await handler( request )
+      self.response_histogram.observe( loop.time() - received )
+      return
+
+    queue = self.queue_list[ hash( tuple( request.GetHardwareAddress() ) ) % len( self.queue_list ) ]
+    try:
+      queue.put_nowait( ( handler, request, message_type, loop.time() ) )
+    except asyncio.QueueFull:
+      self.drop_count += 1
+      logging.debug( 'DHCPd: queue full, dropping packet' )
+
+  async def _worker( self, queue ):
+    loop = asyncio.get_running_loop()
+    while True:
+      ( handler, request, message_type, received ) = await queue.get()
+      try:
+        with span( 'dhcpd', message_type ):
+          await handler( request )
+      except Exception:
+        logging.exception( 'DHCPd: Exception handling packet' )
+
+      self.response_histogram.observe( loop.time() - received )
+      self.handled_count += 1
+      queue.task_done()
 
   async def HandleDhcpDiscover( self, request ):
+    await self._queue( self._handleDiscover, request, 'discover' )
+
+  async def HandleDhcpRequest( self, request ):
+    await self._queue( self._handleRequest, request, 'request' )
+
+  async def HandleDhcpDecline( self, request ):
+    await self._queue( self._handleDecline, request, 'decline' )
+
+  async def HandleDhcpRelease( self, request ):
+    await self._queue( self._handleRelease, request, 'release' )
+
+  async def _handleDiscover( self, request ):
     logging.debug( 'DHCPd: Recieved Discover:\n{0}'.format( request.str() ) )
     mac = hwmac( request.GetHardwareAddress() ).str()
     logging.info( 'DHCPd: Recieved Discover from "{0}"'.format( mac ) )
@@ -115,13 +240,13 @@ class DHCPd( DhcpServer ):
 
     reply = DhcpPacket()
     reply.CreateDhcpOfferPacketFrom( request )
-    self.setOptions( request, reply, item )
+    self.setOptions( request, reply, item, self.pool_map[ name ].option_templates( mac, item ) )
 
     logging.info( 'DHCPd: Sending Offer to "{0}"'.format( mac ) )
     logging.debug( 'DHCPd: Sending Offer:\n{0}'.format( reply.str() ) )
     self.SendDhcpPacket( request, reply )
 
-  async def HandleDhcpRequest( self, request ):
+  async def _handleRequest( self, request ):
     logging.debug( 'DHCPd: Received Request:\n{0}'.format( request.str() ) )
     mac = hwmac( request.GetHardwareAddress() ).str()
     logging.info( 'DHCPd: Recieved Request from "{0}"'.format( mac ) )
@@ -137,13 +262,13 @@ class DHCPd( DhcpServer ):
 
     reply = DhcpPacket()
     reply.CreateDhcpAckPacketFrom( request )
-    self.setOptions( request, reply, item )
+    self.setOptions( request, reply, item, self.pool_map[ name ].option_templates( mac, item ) )
 
     logging.info( 'DHCPd: Sending Ack to "{0}"'.format( mac ) )
     logging.debug( 'DHCPd: Sending Ack:\n{0}'.format( reply.str() ) )
     self.SendDhcpPacket( request, reply )
 
-  async def HandleDhcpDecline( self, request ):
+  async def _handleDecline( self, request ):
     logging.debug( 'DHCPd: Revieved Decline:\n{0}'.format( request.str() ) )
     mac = hwmac( request.GetHardwareAddress() ).str()
     logging.info( 'DHCPd: Recieved Decline from "{0}"'.format( mac ) )
@@ -151,7 +276,7 @@ class DHCPd( DhcpServer ):
     for pool in self.pool_map.values():
       await pool.decline( mac )
 
-  async def HandleDhcpRelease( self, request ):
+  async def _handleRelease( self, request ):
     logging.debug( 'DHCPd: Recieved Release:\n{0}'.format( request.str() ) )
     mac = hwmac( request.GetHardwareAddress() ).str()
     logging.info( 'DHCPd: Recieved Release from "{0}"'.format( mac ) )
@@ -159,58 +284,29 @@ class DHCPd( DhcpServer ):
     for pool in self.pool_map.values():
       await pool.release( mac )
 
-  @property
-  def pool_names( self ):
-    return self.pool_map.keys()
-
-  def add_pool( self, pool, name ):
-    self.pool_map[ name ] = pool
-    self.pool_order.append( name )
-
-  def del_pool( self, name ):
-    del self.pool_order[ self.pool_order.index( name ) ]
-    del self.pool_map[ name ]
-
-  def get_pool( self, name ):
-    return self.pool_map[ name ]
-
-  async def cleanup( self ):
-    for pool in self.pool_map.values():
-      await pool.cleanup()
-
-  def save_cache( self, filepath ):
-    cache = {}
-    for name, pool in self.pool_map.items():
-      cache[ name ] = pool.dump_cache()
+  async def run( self ):
+    logging.debug( 'DHCPd: Running with "{0}" workers...'.format( self.worker_count ) )
+    self.queue_list = [ asyncio.Queue( self.queue_size ) for _ in range( self.worker_count ) ]
+    worker_list = [ asyncio.create_task( self._worker( queue ) ) for queue in self.queue_list ]
+    try:
+      while self.cont:
+        await self.GetNextDhcpPacket( timeout=10 )  # the Handle* functions only queue the packet, so this gets back to reading right away
 
-    fp = open( filepath, 'wb' )
-    pickle.dump( cache, fp )
-    fp.close()
+    finally:
+      self.queue_list = []
+      for task in worker_list:
+        task.cancel()
 
-  def load_cache( self, filepath ):
-    fp = open( filepath, 'rb' )
-    cache = pickle.load( fp )
-    fp.close()
+      await asyncio.gather( *worker_list, return_exceptions=True )
 
-    for name in cache:
-      try:
-        self.pool_map[ name ].load_cache( cache[ name ] )
-      except KeyError:
-        pass
-
-  async def run( self ):
-    logging.debug( 'DHCPd: Running...' )
-    while self.cont:
-      await self.GetNextDhcpPacket( timeout=10 )
     logging.debug( 'DHCPd: Done' )
 
   def stop( self ):
     logging.debug( 'DHCPd: Stopping...' )
     self.cont = False
 
-  def summary( self ):
-    result = {}
-    for name, pool in self.pool_map.items():
-      result[ name ] = pool.summary()
+  def stats( self ):
+    return { 'queue_depth': [ queue.qsize() for queue in self.queue_list ], 'handled': self.handled_count, 'dropped': self.drop_count }
 
-    return result
+  def metrics( self ):  # for registerMetrics, only plain types, so it can be sent from a worker process
+    return { 'packets': dict( self.packet_count_map ), 'dropped': self.drop_count, 'queue_depth': sum( [ queue.qsize() for queue in self.queue_list ] ), 'reclaimed': self.reclaim_counts(), 'response': self.response_histogram.state() }
@@ -0,0 +1,146 @@
+import os
+import asyncio
+import importlib.util
+import importlib.machinery
+
+import pytest
+
+pytest.importorskip( 'pydhcplib' )
+pytest.importorskip( 'cinp.client' )  # bin/dhcpd needs it for Contractor
+
+from subcontractor.dhcpd_test import FakeDHCPd, _packet
+from subcontractor.dynamic_pool import DynamicPool
+from subcontractor.static_pool import StaticPool
+from subcontractor.pool_set import PoolSet
+from subcontractor.lease_cache import LeaseCache
+
+BIN_DHCPD = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'bin', 'dhcpd' )
+
+POOL = { 'name': 'pool1', 'gateway': '10.0.0.1', 'netmask': '255.255.255.0', 'dns_server': '10.0.0.1', 'domain_name': 'test.local', 'address_list': [ '10.0.0.10', '10.0.0.11' ] }
+
+
+def _loadModule():
+  loader = importlib.machinery.SourceFileLoader( 'subcontractor_dhcpd_main', BIN_DHCPD )
+  module = importlib.util.module_from_spec( importlib.util.spec_from_loader( loader.name, loader ) )
+  loader.exec_module( module )
+  return module
+
+
+class SendDHCPd( FakeDHCPd ):
+  def __init__( self, *args, **kwargs ):
+    super().__init__( *args, **kwargs )
+    self.sent_list = []
+
+  def SendDhcpPacket( self, request, reply ):
+    self.sent_list.append( reply )
+
+
+class FakeContractor():
+  connect_count = 0
+  close_count = 0
+  reachable = False
+  site = None
+
+  def __init__( self, *args, **kwargs ):
+    FakeContractor.connect_count += 1
+
+  def getSite( self ):
+    if not FakeContractor.reachable:
+      raise ConnectionRefusedError( 'contractor is down' )
+
+    return FakeContractor.site
+
+  def close( self ):
+    FakeContractor.close_count += 1
+
+
+def _main( monkeypatch, cache_file ):
+  module = _loadModule()
+  monkeypatch.setattr( module, 'DHCPd', SendDHCPd )
+  monkeypatch.setattr( module, 'Contractor', FakeContractor )
+  FakeContractor.connect_count = 0
+  FakeContractor.close_count = 0
+  FakeContractor.reachable = False
+  FakeContractor.site = None
+
+  main = module.Main()
+  main.cache_file = cache_file
+  main.site = 'site1'
+  main.host = 'http://contractor'
+  main.proxy = None
+  main.pool_size = 1
+  main.fast_start = True
+  main.static_pool = StaticPool( 3600 )
+  main.dynamic_lease_time = 3600
+  main.dynamic_mtu = None
+  main.dynamic_vlan = None
+  main.dynamic_console = None
+  main.poll_interval = 0.1
+  main.listen_interface = 'lo'
+  main.listen_address = '127.0.0.1'
+  main.tftp_server = '127.0.0.1'
+  main.worker_count = 1
+  main.queue_size = 16
+  main.process_count = 1
+  return main
+
+
+def _address( packet ):
+  return '.'.join( [ str( i ) for i in packet.GetOption( 'yiaddr' ) ] )
+
+
+def test_fast_start( monkeypatch, tmp_path ):
+  cache_file = str( tmp_path / 'leases' )
+
+  async def _save():  # what the last run left in the cache, the pool definition and one lease
+    pools = PoolSet()
+    pools.load_cache( cache_file )
+    await pools.update_dynamic_pools( [ POOL ], lambda: DynamicPool( 3600, None, None, None ) )
+    entry = await pools.get_pool( 'pool1' ).lookup( '02:00:00:00:00:01', True )
+    pools.save_cache()
+    pools.close_cache()
+    return '.'.join( [ str( i ) for i in entry[0] ] )
+
+  leased = asyncio.run( _save() )
+  main = _main( monkeypatch, cache_file )
+
+  async def _test():
+    task = asyncio.create_task( main.main() )
+    while FakeContractor.connect_count < 2:  # contractor is not reachable
+      await asyncio.sleep( 0.01 )
+
+    assert main.contractor is None
+    assert list( main.dhcpd.pool_names ) == [ '__static__', 'pool1' ]
+    assert main.dhcpd.definition_map == { 'pool1': POOL }
+
+    await main.dhcpd._handleDiscover( _packet( 1, 0 ) )  # the client from the cache keeps it's address
+    await main.dhcpd._handleDiscover( _packet( 2, 0 ) )  # a new one gets the other
+    assert [ _address( reply ) for reply in main.dhcpd.sent_list ] == [ leased, ( set( POOL[ 'address_list' ] ) - set( [ leased ] ) ).pop() ]
+
+    main.stop()
+    await asyncio.wait_for( task, 5 )
+
+  asyncio.run( _test() )
+  assert FakeContractor.close_count == FakeContractor.connect_count  # each failed attempt was closed
+
+  cache = LeaseCache( cache_file ).read()
+  assert cache[ '__dynamic_pools__' ] == { 'pool1': POOL }  # still there for the next start
+  assert sorted( [ mac for mac, _ in cache[ 'pool1' ].values() ] ) == [ '02:00:00:00:00:01', '02:00:00:00:00:02' ]
+
+
+def test_connect_closes( monkeypatch, tmp_path ):
+  main = _main( monkeypatch, str( tmp_path / 'leases' ) )
+  with pytest.raises( ConnectionRefusedError ):
+    main._connect()
+  assert FakeContractor.close_count == 1
+
+  FakeContractor.reachable = True
+  with pytest.raises( ValueError ):  # the site does not exist
+    main._connect()
+  assert FakeContractor.close_count == 2
+  assert main.contractor is None
+
+  FakeContractor.site = { 'name': 'site1', 'description': 'Site 1' }
+  main._connect()
+  assert FakeContractor.close_count == 2
+  assert isinstance( main.contractor, FakeContractor )
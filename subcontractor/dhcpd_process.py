@@ -0,0 +1,163 @@
+import logging
+import signal
+import asyncio
+import multiprocessing
+
+from subcontractor.dhcpd import DHCPd, registerMetrics
+from subcontractor.metrics import Histogram
+from subcontractor.static_pool import StaticPool
+
+
+# a forked DHCPd worker process, all the worker processes listen on the same port ( SO_REUSEPORT ) and share the
+# dynamic leases through the LeaseTable new_pool was created with.  The parent talks to contractor and sends the
+# pools down the pipe, ( 'dynamic', <dynamic pool list> ), ( 'static', <static entry map> ), ( 'static_cache', <static pool mac_map> )
+# for before contractor is reachable, and None to stop.  The worker sends back ( 'metrics', <DHCPd.metrics()> ) after
+# each dynamic pool update, so the parent's metrics lag the workers' by up to a poll interval
+class DHCPdProcess():
+  def __init__( self, index, count, dhcpd_paramaters, static_lease_time, new_pool, profiler=None ):
+    super().__init__()
+    self.index = index
+    self.count = count
+    self.dhcpd_paramaters = dhcpd_paramaters  # ( listen_interface, listen_address, tftp_server, worker_count, queue_size )
+    self.static_lease_time = static_lease_time
+    self.new_pool = new_pool
+    self.profiler = profiler
+    self.process = None
+    self.conn = None
+    self.metrics = None  # the last metrics the worker sent, they start over when the worker is restarted
+
+  def start( self ):
+    context = multiprocessing.get_context( 'fork' )  # fork, so the LeaseTable's mmap and lock are shared
+    ( self.conn, child_conn ) = context.Pipe()
+    self.process = context.Process( target=_run, args=( self, child_conn ), name='dhcpd-{0}'.format( self.index ), daemon=True )
+    self.process.start()
+    child_conn.close()
+    self.metrics = None
+    logging.info( 'DHCPd: started worker process "{0}" pid "{1}"'.format( self.index, self.process.pid ) )
+
+  @property
+  def alive( self ):
+    return self.process is not None and self.process.is_alive()
+
+  def send( self, message ):
+    try:
+      self.conn.send( message )
+    except OSError:  # it died, the parent will restart it
+      logging.warning( 'DHCPd: unable to send to worker process "{0}"'.format( self.index ) )
+
+  def poll( self ):  # read what the worker has sent back
+    try:
+      while self.conn.poll():
+        ( kind, value ) = self.conn.recv()
+        if kind == 'metrics':
+          self.metrics = value
+
+    except ( EOFError, OSError ):  # it died, the parent will restart it
+      pass
+
+  def stop( self, timeout=10 ):
+    if self.process is None:
+      return
+
+    self.send( None )
+    self.process.join( timeout )
+    if self.process.is_alive():
+      logging.warning( 'DHCPd: worker process "{0}" did not stop, terminating'.format( self.index ) )
+      self.process.terminate()
+      self.process.join()
+
+    self.conn.close()
+    self.process = None
+
+
+def _run( worker, conn ):
+  signal.set_wakeup_fd( -1 )  # that belongs to the parent's event loop
+  for signum in ( signal.SIGINT, signal.SIGQUIT, signal.SIGTERM, signal.SIGUSR1 ):  # the parent tells us when to stop
+    signal.signal( signum, signal.SIG_IGN )
+
+  asyncio.run( _main( worker, conn ) )
+
+
+async def _main( worker, conn ):
+  dhcpd = DHCPd( *worker.dhcpd_paramaters, reuse_port=True, process_index=worker.index, process_count=worker.count )
+  static_pool = StaticPool( worker.static_lease_time )
+  dhcpd.add_pool( static_pool, '__static__' )
+
+  queue = asyncio.Queue()
+
+  def _recv():
+    try:
+      queue.put_nowait( conn.recv() )
+    except EOFError:  # the parent is gone
+      loop.remove_reader( conn.fileno() )
+      queue.put_nowait( None )
+
+  loop = asyncio.get_running_loop()
+  loop.add_reader( conn.fileno(), _recv )
+  if worker.profiler is not None:  # SIGUSR1 to the worker's pid to profile it
+    loop.add_signal_handler( signal.SIGUSR1, worker.profiler.start )
+
+  dhcp_server_task = asyncio.create_task( dhcpd.run() )
+  while not dhcp_server_task.done():
+    message_task = asyncio.create_task( queue.get() )
+    await asyncio.wait( [ message_task, dhcp_server_task ], return_when=asyncio.FIRST_COMPLETED )
+    if not message_task.done():
+      message_task.cancel()
+      break
+
+    message = message_task.result()
+    if message is None:
+      break
+
+    ( kind, value ) = message
+    try:
+      if kind == 'dynamic':
+        await dhcpd.update_dynamic_pools( value, worker.new_pool )
+        await dhcpd.cleanup()
+        logging.debug( 'DHCPd: worker "{0}" Stats: {1}'.format( worker.index, dhcpd.stats() ) )
+        conn.send( ( 'metrics', dhcpd.metrics() ) )
+
+      elif kind == 'static':
+        static_pool.update( value )
+
+      elif kind == 'static_cache':
+        static_pool.load_cache( value )
+
+    except Exception:
+      logging.exception( 'DHCPd: worker "{0}" exception updating pools'.format( worker.index ) )
+
+  dhcpd.stop()
+  dhcp_server_task.cancel()
+  try:
+    await dhcp_server_task
+  except asyncio.CancelledError:
+    pass
+  except Exception:
+    logging.exception( 'DHCPd: worker "{0}" DHCP server exception'.format( worker.index ) )
+
+  loop.remove_reader( conn.fileno() )
+  conn.close()
+
+
+# the workers' metrics added together, in the form of DHCPd.metrics
+def mergeMetrics( worker_list ):
+  result = { 'packets': {}, 'dropped': 0, 'queue_depth': 0, 'reclaimed': {} }
+  histogram = Histogram()
+  for worker in worker_list:
+    if worker.metrics is None:
+      continue
+
+    for name in ( 'packets', 'reclaimed' ):
+      for key, count in worker.metrics[ name ].items():
+        result[ name ][ key ] = result[ name ].get( key, 0 ) + count
+
+    result[ 'dropped' ] += worker.metrics[ 'dropped' ]
+    result[ 'queue_depth' ] += worker.metrics[ 'queue_depth' ]
+    histogram.merge( worker.metrics[ 'response' ] )
+
+  result[ 'response' ] = histogram.state()
+  return result
+
+
+def registerWorkerMetrics( worker_list ):
+  registerMetrics( lambda: mergeMetrics( worker_list ) )
@@ -0,0 +1,184 @@
+import random
+import asyncio
+
+import pytest
+
+pytest.importorskip( 'pydhcplib' )
+
+from pydhcplib.dhcp_packet import DhcpPacket
+from pydhcplib.type_strlist import strlist
+
+from subcontractor.dhcpd import DHCPd
+from subcontractor.static_pool import StaticPool
+
+
+class FakeDHCPd( DHCPd ):
+  # pydhcplib's DhcpServer sets up it's socket with these, the queue does not need one
+  def CreateSocket( self ):
+    pass
+
+  def BindToAddress( self ):
+    pass
+
+  def EnableBroadcast( self ):
+    pass
+
+  def EnableReuseaddr( self ):
+    pass
+
+  async def GetNextDhcpPacket( self, timeout=None ):
+    await asyncio.sleep( 0.01 )
+
+
+def _packet( mac, sequence ):
+  packet = DhcpPacket()
+  packet.SetOption( 'hlen', [ 6 ] )
+  packet.SetOption( 'chaddr', [ 2, 0, 0, 0, 0, mac ] + [ 0 ] * 10 )
+  packet.sequence = ( mac, sequence )
+  return packet
+
+
+async def _waitHandled( dhcpd, count ):
+  while dhcpd.handled_count < count:
+    await asyncio.sleep( 0.01 )
+
+
+def test_queue_not_running():
+  dhcpd = FakeDHCPd( 'lo', '127.0.0.1', '127.0.0.1' )
+  handled_list = []
+
+  async def handler( request ):
+    await asyncio.sleep( 0 )
+    handled_list.append( request.sequence )
+
+  async def main():
+    await dhcpd._queue( handler, _packet( 1, 0 ), 'discover' )
+    assert handled_list == [ ( 1, 0 ) ]  # handled before _queue returned
+    await dhcpd._queue( handler, _packet( 1, 1 ), 'request' )
+    assert handled_list == [ ( 1, 0 ), ( 1, 1 ) ]
+
+  asyncio.run( main() )
+  assert dhcpd.packet_count_map == { 'discover': 1, 'request': 1, 'decline': 0, 'release': 0 }
+  assert dhcpd.response_histogram.count == 2
+  assert dhcpd.stats() == { 'queue_depth': [], 'handled': 0, 'dropped': 0 }
+
+
+def test_queue_mac_order():
+  dhcpd = FakeDHCPd( 'lo', '127.0.0.1', '127.0.0.1', worker_count=4 )
+  handled_list = []
+
+  async def handler( request ):
+    await asyncio.sleep( random.random() * 0.01 )
+    handled_list.append( request.sequence )
+
+  async def main():
+    task = asyncio.create_task( dhcpd.run() )
+    await asyncio.sleep( 0 )
+    for sequence in range( 10 ):
+      for mac in range( 8 ):
+        await dhcpd._queue( handler, _packet( mac, sequence ), 'request' )
+
+    await asyncio.wait_for( _waitHandled( dhcpd, 80 ), 5 )
+    dhcpd.stop()
+    await asyncio.wait_for( task, 1 )
+
+  asyncio.run( main() )
+  assert len( handled_list ) == 80
+  for mac in range( 8 ):
+    assert [ sequence for ( i, sequence ) in handled_list if i == mac ] == list( range( 10 ) )
+
+  assert dhcpd.queue_list == []
+  assert dhcpd.response_histogram.count == 80
+
+
+def test_queue_full():
+  dhcpd = FakeDHCPd( 'lo', '127.0.0.1', '127.0.0.1', worker_count=1, queue_size=2 )
+  release_event = asyncio.Event()
+  handled_list = []
+
+  async def handler( request ):
+    await release_event.wait()
+    handled_list.append( request.sequence )
+
+  async def main():
+    task = asyncio.create_task( dhcpd.run() )
+    await asyncio.sleep( 0 )
+    for sequence in range( 4 ):  # the worker does not get to run in between
+      await dhcpd._queue( handler, _packet( 1, sequence ), 'discover' )
+
+    assert dhcpd.stats() == { 'queue_depth': [ 2 ], 'handled': 0, 'dropped': 2 }
+    metrics = dhcpd.metrics()
+    assert metrics[ 'queue_depth' ] == 2
+    assert metrics[ 'dropped' ] == 2
+    assert metrics[ 'packets' ][ 'discover' ] == 4
+
+    release_event.set()
+    await asyncio.wait_for( _waitHandled( dhcpd, 2 ), 5 )
+    assert dhcpd.metrics()[ 'queue_depth' ] == 0
+    dhcpd.stop()
+    await asyncio.wait_for( task, 1 )
+
+  asyncio.run( main() )
+  assert handled_list == [ ( 1, 0 ), ( 1, 1 ) ]
+
+
+ENTRY_MAP = {
+              '02:00:00:00:00:01': { 'ip_address': '10.0.0.10', 'netmask': '255.255.255.0', 'gateway': '10.0.0.1', 'dns_server': '10.0.0.1', 'host_name': 'first', 'domain_name': 'test.local', 'console': 'console' },
+              '02:00:00:00:00:02': { 'ip_address': '10.0.0.11', 'netmask': '255.255.255.0', 'gateway': None, 'dns_server': '10.0.0.1', 'host_name': 'second', 'domain_name': 'test.local', 'mtu': 9000, 'vlan': 10 },
+            }
+
+
+def _request( parameter_request_list, architecture, user_class ):
+  request = DhcpPacket()
+  request.SetOption( 'parameter_request_list', parameter_request_list )
+  request.SetOption( 'client_system', architecture )
+  if user_class:
+    request.SetOption( 'user_class', strlist( user_class ).list() )
+
+  return request
+
+
+# ( parameter request list, client_system, user_class, boot type if there is a console )
+REQUEST_LIST = [
+                 ( [ 1, 3, 6, 67 ], [ 0, 0 ], None, 'kpxe' ),  # BIOS
+                 ( [ 1, 3, 6, 67 ], [ 0, 7 ], None, 'efi' ),  # x64 UEFI
+                 ( [ 1, 3, 6, 67 ], [ 0, 7 ], 'iPXE', 'efi' ),
+                 ( [ 1, 3, 6, 67 ], [], 'iPXE', 'kpxe' ),
+                 ( [ 1, 3, 6 ], [ 0, 7 ], None, None ),  # did not ask for bootfile_name
+                 ( [ 1, 3, 6 ], [ 0, 0 ], 'iPXE', None ),
+               ]
+
+
+def test_set_options_templates():
+  dhcpd = FakeDHCPd( 'lo', '127.0.0.1', '127.0.0.2' )
+  pool = StaticPool( 3600 )
+  pool.update( ENTRY_MAP )
+
+  for mac, console in ( ( '02:00:00:00:00:01', True ), ( '02:00:00:00:00:02', False ) ):
+    item = pool.mac_map[ mac ]
+    for parameter_request_list, architecture, user_class, boot_type in REQUEST_LIST:
+      if not console:
+        boot_type = None
+
+      key = ( boot_type, user_class == 'iPXE' )
+      plain = DhcpPacket()
+      dhcpd.setOptions( _request( parameter_request_list, architecture, user_class ), plain, item )  # not cached
+
+      templates = pool.option_templates( mac, item )
+      for _ in range( 2 ):  # built, then from the template
+        reply = DhcpPacket()
+        dhcpd.setOptions( _request( parameter_request_list, architecture, user_class ), reply, item, templates )
+        assert reply.str() == plain.str()
+
+      assert list( templates ).count( key ) == 1
+      assert templates[ key ] == dhcpd._buildOptions( item, *key )
+      assert ( ( 'ipxe.no-pxedhcp', [ 1 ] ) in templates[ key ] ) is ( user_class == 'iPXE' )
+
+      if boot_type is None:
+        assert not any( reply.GetOption( 'siaddr' ) )
+        assert not any( reply.GetOption( 'file' ) )
+      else:
+        assert reply.GetOption( 'siaddr' ) == [ 127, 0, 0, 2 ]
+        assert strlist( reply.GetOption( 'file' ) ).str().rstrip( '\x00' ) == 'console.{0}'.format( boot_type )
+
+    assert len( pool.option_templates( mac, item ) ) == ( 6 if console else 2 )  # one per key, without a console the boot type does not matter
@@ -1,16 +1,28 @@
 from datetime import datetime, timedelta, UTC
 from asyncio import Semaphore
+from collections import deque
+import heapq
 
 from pydhcplib.type_ipv4 import ipv4
 from pydhcplib.type_strlist import strlist
 
 
 class DynamicPool():
-  def __init__( self, lease_time, mtu, vlan, console ):  # lease_time in seconds
+  def __init__( self, lease_time, mtu, vlan, console, lease_table=None ):  # lease_time in seconds
     super().__init__()
 
     self.address_map = {}  # key is address, value is mac
     self.expires_map = {}  # key is address, value is expires datetime
+    self.mac_map = {}  # key is mac, value is address, reverse of address_map
+    self.free_list = deque()  # addresses that are free, or were, entries are checked against address_map when they are used
+    self.expires_heap = []  # ( expires, address ), entries that no longer match expires_map are stale and skipped
+    self.entry_map = {}  # key is address, value is the entry returned by lookup, so the same entry object is returned while nothing changes
+    self.template_map = {}  # key is address, value is ( entry, DHCPd's option templates for it ), see option_templates
+    self.dirty_set = set()  # addresses changed since the last dump_changes
+    self.paramaters = None  # the last paramaters and address_list from update_paramaters, to skip the update when nothing changed
+    self.address_list = None
+    self.lease_table = lease_table  # when shared with other processes, see LeaseTable, the local maps are then a cache of the table
+    self.reclaim_count = 0  # expired leases freed
     self.mtu = mtu
     self.vlan = vlan
     self.console = console
@@ -20,53 +32,169 @@ class DynamicPool():
     self.address_map_lock = Semaphore()
 
   async def update_paramaters( self, gateway, netmask, dns_server, domain_name, address_list ):
-    self.netmask = ipv4( netmask ).list()
-    self.gateway = ipv4( gateway ).list() if gateway is not None else None
-    self.domain_name = strlist( domain_name ).list()
-    self.dns_server = ipv4( dns_server ).list()
+    paramaters = ( gateway, netmask, dns_server, domain_name )
+    if paramaters != self.paramaters:  # only re-encode if something changed
+      self.netmask = ipv4( netmask ).list()
+      self.gateway = ipv4( gateway ).list() if gateway is not None else None
+      self.domain_name = strlist( domain_name ).list()
+      self.dns_server = ipv4( dns_server ).list()
+      self.entry_map = {}
+      self.template_map = {}
+      self.paramaters = paramaters
 
-    await self._update_address_list( address_list )
+    if address_list != self.address_list:
+      await self._update_address_list( address_list )
+      self.address_list = list( address_list )
 
   async def lookup( self, mac, assign ):
     address = None
+    now = datetime.now( UTC )
     async with self.address_map_lock:
-      for key, value in self.address_map.items():
-        if value == mac:
-          address = key
-          break
+      address = self.mac_map.get( mac, None )
 
-      if address is None and assign is True:
-        for key, value in self.address_map.items():
-          if value is None:
-            address = key
-            self.address_map[ address ] = mac
-            break
+      if self.lease_table is not None:
+        address = self._table_lookup( mac, address, assign, now )
 
-    if address is None:
-      return None
+      elif address is None and assign is True:
+        self._reclaim( now )  # so expired leases are available right away, not at the next cleanup
+        address = self._allocate()
+        if address is not None:
+          self.address_map[ address ] = mac
+          self.mac_map[ mac ] = address
 
-    self.expires_map[ address ] = self.lease_delta + datetime.now( UTC )
+      if address is None:
+        return None
+
+      expires = self.lease_delta + now
+      self.expires_map[ address ] = expires
+      self.dirty_set.add( address )
+      heapq.heappush( self.expires_heap, ( expires, address ) )  # the previous entry for this address is now stale
+
+    try:
+      return self.entry_map[ address ]
+    except KeyError:
+      pass
 
     host_name = 'dynamic_{0}'.format( address )
-    return ( ipv4( address ).list(), self.netmask, self.gateway, self.mtu, self.vlan, self.dns_server, strlist( host_name ).list(), self.domain_name, None, self.console, self.lease_time )
+    entry = ( ipv4( address ).list(), self.netmask, self.gateway, self.mtu, self.vlan, self.dns_server, strlist( host_name ).list(), self.domain_name, None, self.console, self.lease_time )
+    self.entry_map[ address ] = entry
+    return entry
 
   async def release( self, mac ):
-    address = None
     async with self.address_map_lock:
-      for key, value in self.address_map.items():
-        if value == mac:
-          address = key
-          break
+      address = self.mac_map.pop( mac, None )
+      if address is None:
+        return
 
-    if address is None:
-      return
-
-    async with self.address_map_lock:
-      self.address_map[ address ] = None
-      self.expires_map[ address ] = None
+      self._free( address )
+      if self.lease_table is not None:
+        with self.lease_table.lock:
+          self.lease_table.clear( address, mac )
 
     return
 
+  # call with address_map_lock held, checks the local lease against the lease table, allocates from the table, and
+  # records the lease in the table, returns the address
+  def _table_lookup( self, mac, address, assign, now ):
+    timestamp = now.timestamp()
+    with self.lease_table.lock:
+      if address is not None:
+        ( owner, expires ) = self.lease_table.get( address, timestamp )
+        if owner is not None and owner != mac:  # our lease lapsed and another process handed it out
+          self._adopt( address, owner, expires )
+          address = None
+
+      if address is None and assign is True:
+        self._reclaim( now )
+        address = self._table_allocate( timestamp )
+        if address is None:  # we may not know about addresses the other processes have released
+          self._sync_from_table( timestamp )
+          address = self._table_allocate( timestamp )
+
+        if address is not None:
+          self.address_map[ address ] = mac
+          self.mac_map[ mac ] = address
+
+      if address is not None:
+        self.lease_table.set( address, mac, timestamp + self.lease_delta.total_seconds() )
+
+    return address
+
+  # call with address_map_lock and the lease table lock held, allocate an address that is free in the table too
+  def _table_allocate( self, timestamp ):
+    while True:
+      address = self._allocate()
+      if address is None:
+        return None
+
+      ( owner, expires ) = self.lease_table.get( address, timestamp )
+      if owner is None:
+        return address
+
+      self._adopt( address, owner, expires )  # handed out by another process
+
+  # call with address_map_lock held, record a lease from another process
+  def _adopt( self, address, mac, expires ):
+    old_mac = self.address_map.get( address, None )
+    if old_mac is not None and self.mac_map.get( old_mac ) == address:
+      del self.mac_map[ old_mac ]
+
+    expires = datetime.fromtimestamp( expires, UTC )
+    self.address_map[ address ] = mac
+    self.mac_map[ mac ] = address
+    self.expires_map[ address ] = expires
+    self.dirty_set.add( address )
+    heapq.heappush( self.expires_heap, ( expires, address ) )
+
+  # call with address_map_lock and the lease table lock held, replace the local leases with the table's
+  def _sync_from_table( self, timestamp ):
+    for address in self.address_map:
+      ( mac, expires ) = self.lease_table.get( address, timestamp )
+      expires = datetime.fromtimestamp( expires, UTC ) if mac is not None else None
+      if mac != self.address_map[ address ] or expires != self.expires_map[ address ]:
+        self.address_map[ address ] = mac
+        self.expires_map[ address ] = expires
+        self.dirty_set.add( address )
+
+    self._build_index()
+    self._build_heap()
+
+  # call with address_map_lock held
+  def _allocate( self ):
+    while self.free_list:
+      address = self.free_list.popleft()
+      if address in self.address_map and self.address_map[ address ] is None:  # skip stale entries, removed or allready re-used
+        return address
+
+    return None
+
+  # call with address_map_lock held, frees the addresses whose lease has expired
+  def _reclaim( self, now ):
+    while self.expires_heap and self.expires_heap[0][0] < now:
+      ( expires, address ) = heapq.heappop( self.expires_heap )
+      if self.expires_map.get( address, None ) != expires:  # renewed, released or removed since
+        continue
+
+      mac = self.address_map[ address ]
+      if mac is not None and self.mac_map.get( mac ) == address:
+        del self.mac_map[ mac ]
+      self._free( address )
+      self.reclaim_count += 1
+
+    if len( self.expires_heap ) > len( self.address_map ) * 4 + 100:  # to many stale entries from renewals
+      self._build_heap()
+
+  def _build_heap( self ):
+    self.expires_heap = [ ( expires, address ) for address, expires in self.expires_map.items() if expires is not None ]
+    heapq.heapify( self.expires_heap )
+
+  # call with address_map_lock held
+  def _free( self, address ):
+    self.address_map[ address ] = None
+    self.expires_map[ address ] = None
+    self.dirty_set.add( address )
+    self.free_list.append( address )
+
   async def decline( self, mac ):
     await self.release( mac )
 
@@ -80,32 +208,55 @@ class DynamicPool():
       for address in add_list:
         self.address_map[ address ] = None
         self.expires_map[ address ] = None
+        self.free_list.append( address )
 
+      self.dirty_set |= add_list | remove_list
       for address in remove_list:
+        self.entry_map.pop( address, None )
+        self.template_map.pop( address, None )
         try:
           del self.expires_map[ address ]
         except KeyError:
           pass
 
         try:
-          del self.address_map[ address ]
+          mac = self.address_map.pop( address )
         except KeyError:
-          pass
+          continue
+
+        if mac is not None and self.mac_map.get( mac ) == address:
+          del self.mac_map[ mac ]
 
   async def cleanup( self ):
     async with self.address_map_lock:
-      address_list = set( self.address_map.keys() )
+      now = datetime.now( UTC )
+      if self.lease_table is not None:  # pick up what the other processes have done
+        with self.lease_table.lock:
+          self._sync_from_table( now.timestamp() )
 
-      # make sure there are no mac nor expires for addresses that do not exist
-      for item in set( self.expires_map.keys() ) - address_list:
-        del self.expires_map[ item ]
+      self._reclaim( now )
 
-      # look for expires values that are in the past
-      now = datetime.now( UTC )
-      for address in self.expires_map.keys():
-        if self.expires_map[ address ] is not None and self.expires_map[ address ] < now:
-          self.expires_map[ address ] = None
-          self.address_map[ address ] = None
+  # a dict for DHCPd to keep the options it built for item, the entry lookup just returned for mac, in.  The entries
+  # are by address, so it is kept as long as the address's entry is, None if mac does not have an address
+  def option_templates( self, mac, item ):
+    address = self.mac_map.get( mac, None )
+    if address is None:
+      return None
+
+    try:
+      ( cached_item, templates ) = self.template_map[ address ]
+    except KeyError:
+      cached_item = None
+
+    if cached_item is not item:
+      templates = {}
+      self.template_map[ address ] = ( item, templates )
+
+    return templates
+
+  def counts( self ):
+    leased = sum( [ 1 for mac in self.address_map.values() if mac is not None ] )
+    return { 'leased': leased, 'free': len( self.address_map ) - leased }
 
   def summary( self ):
     result = {}
@@ -114,11 +265,44 @@ class DynamicPool():
 
     return result
 
-  def dump_cache( self ):
-    return ( self.address_map, self.expires_map )
+  def _dump_lease( self, address ):
+    try:
+      mac = self.address_map[ address ]
+    except KeyError:  # removed
+      return None
+
+    expires = self.expires_map.get( address, None )
+    return [ mac, expires.timestamp() if expires is not None else None ]
 
+  # returns { address: [ mac, expires ] } for the addresses that changed since the last call, None for removed addresses
+  def dump_changes( self ):
+    result = { address: self._dump_lease( address ) for address in self.dirty_set }
+    self.dirty_set = set()
+    return result
+
+  # cache is { address: [ mac, expires ] }, expires is seconds since epoch
   def load_cache( self, cache ):
     if self.address_map:
       raise Exception( 'allready loaded, can not restore cache' )
 
-    ( self.address_map, self.expires_map ) = cache
+    for address, ( mac, expires ) in cache.items():
+      self.address_map[ address ] = mac
+      self.expires_map[ address ] = datetime.fromtimestamp( expires, UTC ) if mac is not None and expires is not None else None
+
+    if self.lease_table is not None:
+      with self.lease_table.lock:
+        for address, ( mac, expires ) in cache.items():
+          if mac is not None and expires is not None:
+            self.lease_table.set( address, mac, expires )
+
+    self._build_index()
+    self._build_heap()
+
+  def _build_index( self ):
+    self.mac_map = {}
+    self.free_list = deque()
+    for address, mac in self.address_map.items():
+      if mac is None:
+        self.free_list.append( address )
+      else:
+        self.mac_map[ mac ] = address
@@ -0,0 +1,248 @@
+import random
+import asyncio
+from datetime import datetime, timedelta, UTC
+
+import pytest
+
+pytest.importorskip( 'pydhcplib' )
+
+from subcontractor.dynamic_pool import DynamicPool
+from subcontractor.lease_table import LeaseTable
+
+MAC_LIST = [ '02:00:00:00:00:{0:02x}'.format( i ) for i in range( 1, 10 ) ]
+
+
+async def _pool( address_list, lease_table=None ):
+  pool = DynamicPool( 3600, 1500, 0, None, lease_table )
+  await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', address_list )
+  return pool
+
+
+async def _address( pool, mac, assign=True ):
+  entry = await pool.lookup( mac, assign )
+  if entry is None:
+    return None
+
+  return '.'.join( [ str( i ) for i in entry[0] ] )
+
+
+def test_allocate():
+  async def main():
+    pool = await _pool( [ '10.0.0.10', '10.0.0.11', '10.0.0.12' ] )
+    assert pool.counts() == { 'leased': 0, 'free': 3 }
+    assert await _address( pool, MAC_LIST[0], False ) is None
+
+    address_list = [ await _address( pool, mac ) for mac in MAC_LIST[ :3 ] ]
+    assert sorted( address_list ) == [ '10.0.0.10', '10.0.0.11', '10.0.0.12' ]
+    assert pool.counts() == { 'leased': 3, 'free': 0 }
+    assert await _address( pool, MAC_LIST[3] ) is None  # full
+
+    assert await _address( pool, MAC_LIST[0] ) == address_list[0]  # renewal keeps the address
+    assert await pool.lookup( MAC_LIST[0], False ) is await pool.lookup( MAC_LIST[0], False )  # same entry while nothing changes
+
+  asyncio.run( main() )
+
+
+def test_release():
+  async def main():
+    pool = await _pool( [ '10.0.0.10', '10.0.0.11' ] )
+    first = await _address( pool, MAC_LIST[0] )
+    second = await _address( pool, MAC_LIST[1] )
+    assert await _address( pool, MAC_LIST[2] ) is None
+
+    await pool.release( MAC_LIST[0] )
+    await pool.release( MAC_LIST[5] )  # not leased
+    assert pool.counts() == { 'leased': 1, 'free': 1 }
+    assert await _address( pool, MAC_LIST[0], False ) is None
+    assert await _address( pool, MAC_LIST[2] ) == first
+    assert await _address( pool, MAC_LIST[1], False ) == second
+    assert await _address( pool, MAC_LIST[3] ) is None
+
+    await pool.decline( MAC_LIST[2] )
+    assert await _address( pool, MAC_LIST[3] ) == first
+
+  asyncio.run( main() )
+
+
+def test_update_address_list():
+  async def main():
+    pool = await _pool( [ '10.0.0.10', '10.0.0.11' ] )
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10' ] )
+    assert len( pool.free_list ) == 2  # 10.0.0.11 is now stale
+    assert await _address( pool, MAC_LIST[0] ) == '10.0.0.10'
+    assert await _address( pool, MAC_LIST[1] ) is None  # the stale entry is skipped
+    assert len( pool.free_list ) == 0
+
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10', '10.0.0.11' ] )
+    assert await _address( pool, MAC_LIST[1] ) == '10.0.0.11'
+
+    # removed while it was free, added back, it is in the free list twice
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10', '10.0.0.11', '10.0.0.12' ] )
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10', '10.0.0.11' ] )
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10', '10.0.0.11', '10.0.0.12' ] )
+    assert list( pool.free_list ) == [ '10.0.0.12', '10.0.0.12' ]
+    assert await _address( pool, MAC_LIST[2] ) == '10.0.0.12'
+    assert await _address( pool, MAC_LIST[3] ) is None  # the second entry is allready in use
+    assert pool.counts() == { 'leased': 3, 'free': 0 }
+
+    # removing a leased address drops the lease
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10', '10.0.0.12' ] )
+    assert await _address( pool, MAC_LIST[1], False ) is None
+    assert pool.dump_changes()[ '10.0.0.11' ] is None
+    assert pool.counts() == { 'leased': 2, 'free': 0 }
+
+  asyncio.run( main() )
+
+
+def test_load_cache():
+  expires = ( datetime.now( UTC ) + timedelta( hours=1 ) ).timestamp()
+
+  async def main():
+    pool = DynamicPool( 3600, 1500, 0, None )
+    pool.load_cache( { '10.0.0.10': [ MAC_LIST[0], expires ], '10.0.0.11': [ None, None ], '10.0.0.12': [ MAC_LIST[1], expires ] } )
+    assert pool.mac_map == { MAC_LIST[0]: '10.0.0.10', MAC_LIST[1]: '10.0.0.12' }
+    assert list( pool.free_list ) == [ '10.0.0.11' ]
+    with pytest.raises( Exception ):
+      pool.load_cache( {} )
+
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ '10.0.0.10', '10.0.0.11', '10.0.0.12' ] )
+    assert pool.counts() == { 'leased': 2, 'free': 1 }
+    assert await _address( pool, MAC_LIST[0], False ) == '10.0.0.10'
+    assert await _address( pool, MAC_LIST[2] ) == '10.0.0.11'
+    assert await _address( pool, MAC_LIST[3] ) is None
+
+  asyncio.run( main() )
+
+
+def test_reclaim():
+  async def main():
+    pool = await _pool( [ '10.0.0.10', '10.0.0.11' ] )
+    first = await _address( pool, MAC_LIST[0] )
+    second = await _address( pool, MAC_LIST[1] )
+
+    lease_delta = pool.lease_delta
+    pool.lease_delta = timedelta( seconds=-10 )
+    await pool.lookup( MAC_LIST[0], True )  # renewed allready expired
+    pool.lease_delta = lease_delta
+    assert await _address( pool, MAC_LIST[2] ) == first  # reclaimed by the allocate
+    assert pool.reclaim_count == 1
+    assert await _address( pool, MAC_LIST[0], False ) is None
+
+    # the expired entry in the heap is stale once the lease is renewed
+    pool.lease_delta = timedelta( seconds=-10 )
+    await pool.lookup( MAC_LIST[1], True )
+    pool.lease_delta = lease_delta
+    await pool.lookup( MAC_LIST[1], True )
+    assert await _address( pool, MAC_LIST[3] ) is None
+    assert pool.reclaim_count == 1
+    assert await _address( pool, MAC_LIST[1], False ) == second
+
+    # and when the address is removed
+    pool.lease_delta = timedelta( seconds=-10 )
+    await pool.lookup( MAC_LIST[1], True )
+    pool.lease_delta = lease_delta
+    await pool.update_paramaters( '10.0.0.1', '255.255.255.0', '10.0.0.1', 'test.local', [ first ] )
+    assert await _address( pool, MAC_LIST[3] ) is None
+    assert pool.reclaim_count == 1
+    assert min( pool.expires_heap )[0] > datetime.now( UTC )  # the expired ones were popped
+    assert await _address( pool, MAC_LIST[2], False ) == first
+
+  asyncio.run( main() )
+
+
+def test_build_heap():
+  async def main():
+    pool = await _pool( [ '10.0.0.10', '10.0.0.11' ] )
+    first = await _address( pool, MAC_LIST[0] )
+    await pool.lookup( MAC_LIST[1], True )
+    for _ in range( 110 ):  # each renewal leaves a stale entry
+      await pool.lookup( MAC_LIST[0], True )
+
+    assert len( pool.expires_heap ) == 112
+    await pool.cleanup()
+    assert sorted( pool.expires_heap ) == sorted( [ ( expires, address ) for address, expires in pool.expires_map.items() ] )
+    assert pool.reclaim_count == 0
+
+    pool.expires_heap = []
+    pool._build_heap()
+    assert len( pool.expires_heap ) == 2
+    await pool.release( MAC_LIST[1] )
+    pool._build_heap()
+    assert pool.expires_heap == [ ( pool.expires_map[ first ], first ) ]
+
+  asyncio.run( main() )
+
+
+def _table_leases( table, address_list ):  # { address: mac } of the current leases in the table
+  now = datetime.now( UTC ).timestamp()
+  return dict( [ ( address, table.get( address, now )[0] ) for address in address_list ] )
+
+
+@pytest.mark.parametrize( 'seed', range( 5 ) )
+def test_shared_table( seed ):  # two DHCPd processes, each mac is served by one of them
+  rng = random.Random( seed )
+  address_list = [ '10.0.0.{0}'.format( i ) for i in range( 10, 16 ) ]
+
+  async def main():
+    table = LeaseTable( 64 )
+    pool_list = [ await _pool( address_list, table ), await _pool( address_list, table ) ]
+    leased_map = {}  # mac -> address
+    for _ in range( 200 ):
+      i = rng.randrange( len( MAC_LIST ) )
+      mac = MAC_LIST[ i ]
+      pool = pool_list[ i % 2 ]
+      action = rng.random()
+      if action < 0.7:
+        address = await _address( pool, mac )
+        if address is None:
+          assert len( leased_map ) - ( mac in leased_map ) == len( address_list )  # only when they are all taken
+          leased_map.pop( mac, None )
+        else:
+          leased_map[ mac ] = address
+      else:
+        await pool.release( mac )
+        leased_map.pop( mac, None )
+
+      assert len( set( leased_map.values() ) ) == len( leased_map )  # never the same address for two macs
+      assert _table_leases( table, address_list ) == dict( [ ( address, None ) for address in address_list ], **dict( [ ( address, mac ) for mac, address in leased_map.items() ] ) )
+
+    for pool in pool_list:
+      await pool.cleanup()
+      assert pool.summary() == _table_leases( table, address_list )  # cleanup brings the local leases in line with the table
+      assert pool.counts() == { 'leased': len( leased_map ), 'free': len( address_list ) - len( leased_map ) }
+      for i, mac in enumerate( MAC_LIST ):
+        if i % 2 == pool_list.index( pool ):
+          assert await _address( pool, mac, False ) == leased_map.get( mac )
+
+  asyncio.run( main() )
+
+
+def test_shared_table_expired():
+  async def main():
+    table = LeaseTable( 64 )
+    first = await _pool( [ '10.0.0.10' ], table )
+    second = await _pool( [ '10.0.0.10' ], table )
+
+    lease_delta = first.lease_delta
+    first.lease_delta = timedelta( seconds=-10 )
+    assert await _address( first, MAC_LIST[0] ) == '10.0.0.10'  # allready expired
+    first.lease_delta = lease_delta
+    assert await _address( second, MAC_LIST[1] ) == '10.0.0.10'  # the expired lease is taken over
+    assert _table_leases( table, [ '10.0.0.10' ] ) == { '10.0.0.10': MAC_LIST[1] }
+
+    # first still thinks MAC_LIST[0] has it, the renewal finds the other process's lease and adopts it
+    assert first.mac_map[ MAC_LIST[0] ] == '10.0.0.10'
+    assert await _address( first, MAC_LIST[0] ) is None
+    assert first.summary() == { '10.0.0.10': MAC_LIST[1] }
+    assert MAC_LIST[0] not in first.mac_map
+    assert first.dump_changes()[ '10.0.0.10' ][0] == MAC_LIST[1]
+    assert _table_leases( table, [ '10.0.0.10' ] ) == { '10.0.0.10': MAC_LIST[1] }
+
+    # released by second, first finds out at it's next cleanup
+    await second.release( MAC_LIST[1] )
+    assert first.summary() == { '10.0.0.10': MAC_LIST[1] }
+    await first.cleanup()
+    assert first.summary() == { '10.0.0.10': None }
+    assert await _address( first, MAC_LIST[0] ) == '10.0.0.10'
+
+  asyncio.run( main() )
@@ -1,111 +1,442 @@
+import json
 import logging
 import hashlib
-import copy
+import signal
 import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from importlib import import_module
 
+from subcontractor.results import ResultCoalescer, ResultSpool
+from subcontractor.metrics import REGISTRY, Histogram, Counter
+from subcontractor.profiler import span
+from subcontractor.credentials import prefetchCredentials
 
+EXECUTOR_TYPES = ( 'thread', 'process' )
+
+_process_module_map = {}
+
+
+HIDDEN_NAME_LIST = ( 'password', 'token', 'secret' )  # this should match contractor/Records/lib.py - prepConfig
+
+
+# builds the hidden copy in one pass, only the dicts and lists are copied, everything else is shared with the original
 def _hideify_internal( salt, value_map ):
   if isinstance( value_map, list ):
-    iter = enumerate( value_map )
-  elif isinstance( value_map, dict ):
-    iter = value_map.items()
-  else:
-    return value_map
+    return [ _hideify_internal( salt, value ) for value in value_map ]
 
-  for name, value in iter:
-    if isinstance( value, ( dict, list ) ):
-      value_map[ name ] = _hideify_internal( salt, copy.copy( value_map[ name ] ) )
+  if not isinstance( value_map, dict ):
+    return value_map
 
-    elif isinstance( value, str ) and isinstance( name, str ) and any( [ i in name for i in ( 'password', 'token', 'secret' ) ] ):  # this should match contractor/Records/lib.py - prepConfig
-      try:
-        value_map[ name ] = salt + ':' + hashlib.sha256( ( salt + ':' + value ).encode() ).hexdigest()
-      except KeyError:
-        pass
+  result = {}
+  for name, value in value_map.items():
+    if isinstance( value, str ) and isinstance( name, str ) and any( [ i in name for i in HIDDEN_NAME_LIST ] ):
+      result[ name ] = salt + ':' + hashlib.sha256( ( salt + ':' + value ).encode() ).hexdigest()
+    else:
+      result[ name ] = _hideify_internal( salt, value )
 
-  return value_map
+  return result
 
 
 def _hideify( paramaters ):
   salt = 'salt'  # TODO: get a random something, or does it matter if/how often this changes?
 
-  return _hideify_internal( salt, copy.copy( paramaters ) )
+  return _hideify_internal( salt, paramaters )
+
+
+# for logging, pass as a logging argument ( not with .format() ) so the hidden copy is only
+# made if the record is actually emitted, and then only once
+class _Hidden():
+  __slots__ = ( 'value', 'hidden', 'done' )
+
+  def __init__( self, value ):
+    self.value = value
+    self.hidden = None
+    self.done = False
+
+  def __str__( self ):
+    if not self.done:
+      self.hidden = _hideify( self.value )
+      self.done = True
+
+    return str( self.hidden )
+
+
+def _process_init( path ):  # runs once in each worker process of a 'process' module
+  signal.signal( signal.SIGINT, signal.SIG_IGN )  # the parent handles the stop signals and shuts the pool down
+  module = import_module( path )
+  _process_module_map[ path ] = module.MODULE_FUNCTIONS
+
+
+def _process_ping():
+  return True
+
+
+def _process_call( path, function_name, paramaters ):
+  result = _process_module_map[ path ][ function_name ]( paramaters )
+  if asyncio.iscoroutine( result ):
+    result = asyncio.run( result )
+
+  return result
+
+
+class _AbandonedPool():  # a process pool with a hung call, the processes are terminated once the other calls in it are done
+  def __init__( self, module_name, process_list, future_list ):
+    super().__init__()
+    self.module_name = module_name
+    self.process_list = process_list
+    self.lock = threading.Lock()  # the done callbacks are called from the pool's management thread
+    self.pending_set = set( future_list )
+    self.hung_set = set()
+    self.terminated = False
+    for future in future_list:
+      future.add_done_callback( self._done )
+
+  def hang( self, future ):
+    with self.lock:
+      self.hung_set.add( future )
+      self._check()
+
+  def _done( self, future ):
+    with self.lock:
+      self.pending_set.discard( future )
+      self._check()
+
+  def _check( self ):
+    if self.hung_set and not self.pending_set - self.hung_set:
+      self.terminate()
+
+  def terminate( self ):
+    if self.terminated:
+      return
+
+    self.terminated = True
+    for process in self.process_list:
+      if process.is_alive():
+        logging.warning( 'handler: terminating worker process "{0}" of module "{1}"'.format( process.pid, self.module_name ) )
+        process.terminate()
 
 
 class JobWorker():
-  def __init__( self, contractor, cookie, job_id, function, paramaters, semaphore ):
+  def __init__( self, contractor, cookie, job_id, function, paramaters, semaphore, get_executor, spool, timeout=None, on_abandon=None, ready=None, shared=None, leader=True, on_slot=None ):
     super().__init__()
     self.contractor = contractor
     self.cookie = cookie
     self.job_id = job_id
     self.function = function
     self.paramaters = paramaters
+    self.hidden_paramaters = _Hidden( paramaters )
     self.semaphore = semaphore
+    self.get_executor = get_executor  # the module's executor can be replaced while we wait on the semaphore, so get it when we need it
+    self.executor = None
+    self.future = None  # the concurrent Future of the blocking call
+    self.spool = spool
+    self.timeout = timeout  # in seconds, None for no timeout
+    self.on_abandon = on_abandon  # called with the executor and the future when a call in it times out, the call can not be stopped, so the executor should not be used anymore
+    self.ready = ready  # Task to wait for before starting, ie: prefetching the credentials
+    self.shared = shared  # Future of ( data, msg ) shared by the jobs with the same idempotent function and paramaters
+    self.leader = leader  # if this job runs the function for the others, otherwise it reports what the leader got
+    self.on_slot = on_slot  # called with ( old slot, new slot ) when slot changes
+    self.slot = None  # queued while waiting for the semaphore, running while holding it, otherwise None
+    self.duration = None  # seconds the function ran, once it has
+    self.status = None  # done, error or timeout
+
+  def setSlot( self, slot ):
+    if slot != self.slot and self.on_slot is not None:
+      self.on_slot( self.slot, slot )
+
+    self.slot = slot
+
+  async def _call( self ):
+    if asyncio.iscoroutinefunction( self.function ):
+      return await self.function( self.paramaters )
+
+    # plugin functions are blocking, run them in the module's pool so the event loop (and the other jobs) keep going
+    self.executor = self.get_executor()
+    self.future = self.executor.submit( self.function, self.paramaters )
+    return await asyncio.wrap_future( self.future )
+
+  async def _report( self, entry ):
+    self.spool.append( entry )  # on disk before we try to send it, so a restart does not loose it
+    try:
+      if 'msg' in entry:
+        response = await self.contractor.jobError( self.job_id, entry[ 'msg' ], self.cookie )
+      else:
+        response = await self.contractor.jobResults( self.job_id, entry[ 'data' ], self.cookie )
+    except Exception as e:
+      logging.warning( 'handler: unable to send results for job "{0}" ("{1}"), leaving it in the spool'.format( self.job_id, e ) )
+      self.spool.release( self.job_id )
+      return
+
+    logging.info( 'handler: job "{0}" complete, contractor said "{1}"'.format( self.job_id, response ) )
+    if response == 'Error':
+      logging.debug( 'handler: Contractor said it had an error, leaving it in the spool' )
+      self.spool.release( self.job_id )
+      return
+
+    self.spool.complete( self.job_id )
+    if response != 'Accepted':
+      raise Exception( 'Unknown jobResults response "{0}"'.format( response ) )
 
   async def run( self ):
+    if self.ready is not None:
+      await asyncio.wait( [ self.ready ] )  # not awaited directly, so cancelling this job does not cancel it for the others
+
+    if not self.leader:
+      await asyncio.wait( [ self.shared ] )
+      if not self.shared.cancelled():
+        logging.debug( 'handler: job "{0}" is using the results of an identical job'.format( self.job_id ) )
+        ( data, msg ) = self.shared.result()
+        self.status = 'coalesced'
+        await self._finish( data, msg )
+        return
+
+      self.shared = None  # the leader was cancelled, run it ourselves
+      self.setSlot( 'queued' )
+
+    try:
+      ( data, msg ) = await self._run()
+    except BaseException:  # including being cancelled, the others run it themselves
+      if self.shared is not None:
+        self.shared.cancel()
+      raise
+
+    if self.shared is not None:
+      self.shared.set_result( ( data, msg ) )
+
+    await self._finish( data, msg )
+
+  async def _run( self ):  # returns ( data, msg ), msg is None if there was not an error
     logging.debug( 'handler: acquring lock for "{0}"...'.format( self.job_id ) )
+    data = None
+    msg = None
+    loop = asyncio.get_running_loop()
     async with self.semaphore:
-      logging.debug( 'handler: starting job "{0}" with "{1}"'.format( self.function, _hideify( self.paramaters ) ) )
+      self.setSlot( 'running' )
+      logging.debug( 'handler: starting job "%s" with "%s"', self.function, self.hidden_paramaters )
+      start = loop.time()
+      status = 'done'
       try:
-        data = self.function( self.paramaters )
+        with span( 'job', self.function ):
+          data = await asyncio.wait_for( self._call(), self.timeout )  # coroutine functions are cancelled, blocking calls are left to finish on their own
+      except asyncio.TimeoutError:
+        logging.error( 'handler: function "{0}" for job "{1}" did not complete in "{2}" seconds, abandoning'.format( self.function, self.job_id, self.timeout ) )
+        if self.on_abandon is not None and not asyncio.iscoroutinefunction( self.function ):
+          self.on_abandon( self.executor, self.future )
+        msg = 'Timeout, did not complete in "{0}" seconds'.format( self.timeout )
+        status = 'timeout'
       except Exception as e:
-        logging.exception( 'handler: Exception with function "{0}" paramaters "{1}"'.format( self.function, _hideify( self.paramaters ) ) )
-        self.contractor.jobError( self.job_id, 'Unhandled Exception "{0}"({1})'.format( e, type( e ).__name__ ), self.cookie )
-        return
+        logging.exception( 'handler: Exception with function "%s" paramaters "%s"', self.function, self.hidden_paramaters )
+        msg = 'Unhandled Exception "{0}"({1})'.format( e, type( e ).__name__ )
+        status = 'error'
 
+      self.duration = loop.time() - start
+      self.status = status
+
+    self.setSlot( None )
     logging.debug( 'handler: lock for "{0}" released'.format( self.job_id ) )
+    return ( data, msg )
+
+  async def _finish( self, data, msg ):
+    if msg is not None:
+      await self._report( { 'job_id': self.job_id, 'cookie': self.cookie, 'msg': msg } )
+      return
 
     if not isinstance( data, dict ):
+      self.status = 'error'
       logging.error( 'handler: result from function was not a dict, got "{0}"({1})'.format( str( data )[ 0:50 ], type( data ).__name__ ) )
-      self.contractor.jobError( self.job_id, 'result was not a dict, got "{0}"({1})'.format( data, type( data ).__name__ ), self.cookie )
-
-    logging.debug( 'handler: results of "{0}" with "{1}" is "{2}"'.format( self.function, _hideify( self.paramaters ), data ) )
-    response = 'Error'
-    while response == 'Error':
-      response = self.contractor.jobResults( self.job_id, data, self.cookie )  # this is after releasing the semaphore so we are not holding things up if sending the results requires retries
-      logging.info( 'handler: job "{0}" complete, contractor said "{1}"'.format( self.job_id, response ) )
-      if response == 'Accepted':
-        break
-
-      if response != 'Error':
-        raise Exception( 'Unknown jobResults response "{0}"'.format( response ) )
+      await self._report( { 'job_id': self.job_id, 'cookie': self.cookie, 'msg': 'result was not a dict, got "{0}"({1})'.format( data, type( data ).__name__ ) } )
+      return
 
-      logging.debug( 'handler: Contractor said it had an error, sleeping before trying again...' )
-      asyncio.sleep( 60 )
+    logging.debug( 'handler: results of "%s" with "%s" is "%s"', self.function, self.hidden_paramaters, data )
+    await self._report( { 'job_id': self.job_id, 'cookie': self.cookie, 'data': data } )  # this is after releasing the semaphore so we are not holding things up if sending the results is slow
 
 
 class Handler():
-  def __init__( self, contractor ):
+  def __init__( self, contractor, spool_file=None ):
     super().__init__()
     self.contractor = contractor
+    self.results = ResultCoalescer( contractor )
+    self.spool = ResultSpool( spool_file )
+    self.spool.load()
     self.max_concurent_jobs = 0  # there is not a semaphore to inforce this, this is used to limit the number of jobs being requested
     self.job_delay = 5
     self.module_map = {}
     self.semaphore_map = {}
-    self.task_list = []
+    self.executor_map = {}
+    self.limit_map = {}
+    self.path_map = {}  # key is module path, value is module name
+    self.executor_factory_map = {}
+    self.abandoned_map = {}  # key is a replaced process pool executor, value is it's _AbandonedPool
+    self.job_timeout = None
+    self.timeout_map = {}  # key is ( module name, function name ), function name None for the whole module
+    self.queued_map = {}  # jobs waiting for a slot, by module, coalesced jobs don't need one
+    self.running_map = {}  # jobs holding a slot, by module, reporting the results is after the slot is released
+    self.task_map = {}  # key is job_id, tasks remove themselves when done
+    self.idle_event = asyncio.Event()  # set when there are no tasks
+    self.idle_event.set()
+    self.slot_event = asyncio.Event()  # set when a job releases it's slot or finishes, so the main loop can ask for more right away
+    self.duration_map = {}  # key is module name, value is a Histogram of how long the jobs ran
+    self.idempotent_set = set()  # ( module name, function name ) of the functions with idempotent set
+    self.idempotent_window = 5  # seconds an idempotent function's result is used for identical jobs after it finishes
+    self.shared_map = {}  # key is ( module name, function name, paramaters as json ), value is the JobWorker.shared Future
+    self.job_counter = Counter()  # by ( module name, status )
+
+    REGISTRY.register( 'subcontractor_jobs_running', 'gauge', 'jobs running', ( 'module', ), lambda: dict( [ ( ( name, ), self.running_map[ name ] ) for name in self.module_map ] ) )
+    REGISTRY.register( 'subcontractor_jobs_queued', 'gauge', 'jobs waiting for a slot', ( 'module', ), lambda: dict( [ ( ( name, ), self.queued_map[ name ] ) for name in self.module_map ] ) )
+    REGISTRY.register( 'subcontractor_job_duration_seconds', 'histogram', 'how long the jobs ran', ( 'module', ), lambda: dict( [ ( ( name, ), histogram ) for name, histogram in self.duration_map.items() ] ) )
+    REGISTRY.register( 'subcontractor_jobs_total', 'counter', 'finished jobs', ( 'module', 'status' ), lambda: self.job_counter.value_map )
+    REGISTRY.register( 'subcontractor_result_spool_entries', 'gauge', 'results contractor has not accepted yet', (), lambda: { (): len( self.spool.entry_map ) } )
 
   @property
   def empty_slots( self ):
-    return self.max_concurent_jobs - len( self.task_list )
+    in_use = sum( self.queued_map.values() ) + sum( self.running_map.values() )
+    return min( self.max_concurent_jobs - in_use, sum( self.module_slots.values() ) )
 
   @property
   def module_list( self ):
     return list( self.module_map.keys() )
 
-  def registerModule( self, path, limit ):
+  @property
+  def module_slots( self ):
+    return dict( [ ( module_name, max( 0, self.limit_map[ module_name ] - self.queued_map[ module_name ] - self.running_map[ module_name ] ) ) for module_name in self.module_map ] )
+
+  @property
+  def available_module_list( self ):  # modules that can start a job right now, no point in asking for jobs that would just wait on the semaphore
+    return [ module_name for module_name, slots in self.module_slots.items() if slots > 0 ]
+
+  def registerModule( self, path, limit, executor='thread' ):
+    if executor not in EXECUTOR_TYPES:
+      raise ValueError( 'Unknown executor type "{0}"'.format( executor ) )
+
     module = import_module( path )
 
-    logging.info( 'handler: registering module "{0}" with limit "{1}"...'.format( module.MODULE_NAME, limit ) )
-    self.module_map[ module.MODULE_NAME ] = module.MODULE_FUNCTIONS
+    logging.info( 'handler: registering module "{0}" with limit "{1}" and executor "{2}"...'.format( module.MODULE_NAME, limit, executor ) )
     self.semaphore_map[ module.MODULE_NAME ] = asyncio.Semaphore( limit )
+    self.limit_map[ module.MODULE_NAME ] = limit
+    self.queued_map[ module.MODULE_NAME ] = 0
+    self.running_map[ module.MODULE_NAME ] = 0
+    self.duration_map[ module.MODULE_NAME ] = Histogram()
+
+    self.path_map[ path ] = module.MODULE_NAME
+
+    # functions that only read, and give the same result for the same paramaters, ie: getting the power state, can set
+    # <function>.idempotent = True, identical jobs for them then share one call, see addJobs
+    for name, function in module.MODULE_FUNCTIONS.items():
+      if getattr( function, 'idempotent', False ):
+        self.idempotent_set.add( ( module.MODULE_NAME, name ) )
+
+    if executor == 'process':
+      # the function is looked up by name in the worker process, only the paramaters and the result cross the process boundary
+      self.module_map[ module.MODULE_NAME ] = dict( [ ( name, partial( _process_call, path, name ) ) for name in module.MODULE_FUNCTIONS ] )
+      self.executor_factory_map[ module.MODULE_NAME ] = partial( ProcessPoolExecutor, max_workers=limit, initializer=_process_init, initargs=( path, ) )
+
+    else:
+      self.module_map[ module.MODULE_NAME ] = module.MODULE_FUNCTIONS
+      self.executor_factory_map[ module.MODULE_NAME ] = partial( ThreadPoolExecutor, max_workers=limit, thread_name_prefix=module.MODULE_NAME )
+
+    self._newExecutor( module.MODULE_NAME )
+
+  def _newExecutor( self, module_name ):
+    executor = self.executor_factory_map[ module_name ]()
+    if isinstance( executor, ProcessPoolExecutor ):
+      for _ in range( self.limit_map[ module_name ] ):  # warm up the workers now, so the import cost is not paid by the first jobs
+        executor.submit( _process_ping )
+
+    self.executor_map[ module_name ] = executor
+
+  def _abandonExecutor( self, module_name, executor, future ):
+    if self.executor_map.get( module_name ) is not executor:  # allready replaced, another hung call in the same pool
+      if executor in self.abandoned_map:
+        self.abandoned_map[ executor ].hang( future )
+      return
+
+    # the timed out call is still using one of the executor's workers, replace the executor so the module keeps it's full capacity.
+    # threads can't be stopped, the old thread pool finishes what it is running and then goes away.  The processes of a process
+    # pool are terminated, otherwise a hung call keeps it's process forever, that waits until the other jobs allready in the pool
+    # are done, so they are not failed with BrokenProcessPool
+    logging.warning( 'handler: replacing executor for module "{0}"'.format( module_name ) )
+    self._newExecutor( module_name )
+    process_list = list( ( getattr( executor, '_processes', None ) or {} ).values() )  # shutdown clears _processes
+    future_list = [ item.future for item in list( ( getattr( executor, '_pending_work_items', None ) or {} ).values() ) ]
+    executor.shutdown( wait=False )
+    if not process_list:
+      return
+
+    self.abandoned_map = dict( [ ( key, value ) for key, value in self.abandoned_map.items() if not value.terminated ] )
+    abandoned = self.abandoned_map[ executor ] = _AbandonedPool( module_name, process_list, future_list )
+    abandoned.hang( future )
+
+  # name is the module path as used in the [modules] config, or the module path and the function name seperated by ".",
+  # timeout is in seconds, None or 0 for no timeout ( overriding job_timeout )
+  def setTimeout( self, name, timeout ):
+    if timeout is not None and timeout < 0:
+      raise TypeError( 'timeout is invalid' )
+
+    timeout = timeout or None
+
+    try:
+      module_name = self.path_map[ name ]
+      function_name = None
+    except KeyError:
+      ( path, _, function_name ) = name.rpartition( '.' )
+      try:
+        module_name = self.path_map[ path ]
+      except KeyError:
+        raise ValueError( 'Unknown module "{0}"'.format( name ) )
+
+      try:  # config file keys are lower cased
+        function_name = [ i for i in self.module_map[ module_name ] if i.lower() == function_name.lower() ][0]
+      except IndexError:
+        raise ValueError( 'Unknown function "{0}" in module "{1}"'.format( function_name, path ) )
+
+    logging.info( 'handler: setting timeout for "{0}" "{1}" to "{2}"'.format( module_name, function_name, timeout ) )
+    self.timeout_map[ ( module_name, function_name ) ] = timeout
+
+  def getTimeout( self, module_name, function_name ):
+    try:
+      return self.timeout_map[ ( module_name, function_name ) ]
+    except KeyError:
+      pass
+
+    return self.timeout_map.get( ( module_name, None ), self.job_timeout )
 
-  def setLimits( self, job_delay=None, max_concurent_jobs=None ):
+  def setLimits( self, job_delay=None, max_concurent_jobs=None, result_window=None, result_batch_size=None, job_timeout=None, idempotent_window=None ):
     if max_concurent_jobs is not None and ( max_concurent_jobs < 0 or max_concurent_jobs > 100 ):
       raise TypeError( 'max_concurent_jobs is invalid' )
 
     if job_delay is not None and ( job_delay < 0 or job_delay > 60 ):
       raise TypeError( 'job_delay is invalid' )
 
+    if job_timeout is not None and job_timeout < 0:
+      raise TypeError( 'job_timeout is invalid' )
+
+    if result_window is not None and ( result_window < 0 or result_window > 10 ):
+      raise TypeError( 'result_window is invalid' )
+
+    if result_batch_size is not None and ( result_batch_size < 1 or result_batch_size > 100 ):
+      raise TypeError( 'result_batch_size is invalid' )
+
+    if result_window is not None:
+      logging.info( 'handler: setting result_window to "{0}"'.format( result_window ) )
+      self.results.window = result_window
+
+    if result_batch_size is not None:
+      logging.info( 'handler: setting result_batch_size to "{0}"'.format( result_batch_size ) )
+      self.results.max_size = result_batch_size
+
+    if idempotent_window is not None and ( idempotent_window < 0 or idempotent_window > 300 ):
+      raise TypeError( 'idempotent_window is invalid' )
+
+    if idempotent_window is not None:
+      logging.info( 'handler: setting idempotent_window to "{0}"'.format( idempotent_window ) )
+      self.idempotent_window = idempotent_window
+
+    if job_timeout is not None:
+      logging.info( 'handler: setting job_timeout to "{0}"'.format( job_timeout ) )
+      self.job_timeout = job_timeout or None  # 0 is no timeout
+
     if job_delay is not None:
       logging.info( 'handler: setting job_delay to "{0}"'.format( job_delay ) )
       self.job_delay = job_delay
@@ -115,7 +446,11 @@ class Handler():
       self.max_concurent_jobs = max_concurent_jobs
 
   def addJobs( self, job_list ):
-    logging.debug( 'handler: adding more jobs "{0}"....'.format( _hideify( job_list ) ) )
+    logging.debug( 'handler: adding more jobs "%s"....', _Hidden( job_list ) )
+
+    # the vault lookups for the whole batch at once, instead of one after another as each job gets to them, modules
+    # in process pools have their own credential cache, so this does not help them
+    ready = prefetchCredentials( [ job[ 'paramaters' ] for job in job_list ] )
 
     for job in job_list:
       try:
@@ -130,21 +465,98 @@ class Handler():
         logging.error( 'handler: Unable to find function "{0}" in module "{1}", job dropped.'.format( job[ 'function' ], job[ 'module' ] ) )
         continue
 
-      worker = JobWorker( self.contractor, job[ 'cookie' ], job[ 'job_id' ], function, job[ 'paramaters' ], semaphore )
-      self.task_list.append( asyncio.create_task( worker.run() ) )
+      if job[ 'job_id' ] in self.task_map:
+        logging.warning( 'handler: job "{0}" is allready running, ignoring.'.format( job[ 'job_id' ] ) )
+        continue
+
+      ( shared, leader ) = self._share( job )
+      worker = JobWorker( self.results, job[ 'cookie' ], job[ 'job_id' ], function, job[ 'paramaters' ], semaphore, partial( self.executor_map.get, job[ 'module' ] ), self.spool,
+                          self.getTimeout( job[ 'module' ], job[ 'function' ] ), partial( self._abandonExecutor, job[ 'module' ] ), ready, shared, leader,
+                          partial( self._slotChange, job[ 'module' ] ) )
+      if leader:  # counted now, so the slot is not asked for again while the job is waiting on ready
+        worker.setSlot( 'queued' )
+      task = asyncio.create_task( worker.run() )
+      task.add_done_callback( partial( self._taskDone, job[ 'module' ], job[ 'job_id' ], worker ) )
+      self.task_map[ job[ 'job_id' ] ] = task
+      self.idle_event.clear()
+
+  # returns ( shared, leader ) for JobWorker, jobs for idempotent functions with the same paramaters as one that is
+  # running, or finished in the last idempotent_window seconds, get the Future of that one and are not the leader
+  def _share( self, job ):
+    if ( job[ 'module' ], job[ 'function' ] ) not in self.idempotent_set:
+      return ( None, True )
+
+    try:
+      key = ( job[ 'module' ], job[ 'function' ], json.dumps( job[ 'paramaters' ], sort_keys=True ) )
+    except TypeError:
+      return ( None, True )
+
+    shared = self.shared_map.get( key, None )
+    if shared is not None and not shared.cancelled():
+      return ( shared, False )
+
+    shared = self.shared_map[ key ] = asyncio.get_running_loop().create_future()
+    shared.add_done_callback( partial( self._sharedDone, key ) )
+    return ( shared, True )
+
+  def _sharedDone( self, key, shared ):
+    asyncio.get_running_loop().call_later( self.idempotent_window, self._unshare, key, shared )
+
+  def _unshare( self, key, shared ):
+    if self.shared_map.get( key, None ) is shared:
+      del self.shared_map[ key ]
+
+  def _slotChange( self, module_name, old, new ):
+    slot_map = { 'queued': self.queued_map, 'running': self.running_map }
+    if old is not None:
+      slot_map[ old ][ module_name ] -= 1
+
+    if new is not None:
+      slot_map[ new ][ module_name ] += 1
+    else:
+      self.slot_event.set()
+
+  def _taskDone( self, module_name, job_id, worker, task ):
+    logging.debug( 'handler: task for job "{0}" is done.'.format( job_id ) )
+    del self.task_map[ job_id ]
+    worker.setSlot( None )  # if it was cancelled before releasing it
+    if worker.duration is not None:
+      self.duration_map[ module_name ].observe( worker.duration )
+    if worker.status is not None:
+      self.job_counter.inc( ( module_name, worker.status ) )
+    if not task.cancelled() and task.exception() is not None:
+      logging.error( 'handler: job "{0}" failed: "{1}"'.format( job_id, task.exception() ) )
+
+    self.slot_event.set()
+    if not self.task_map:
+      self.idle_event.set()
 
   def checkTasks( self ):
-    logging.debug( 'handler: curenly have {0} tasks'.format( len( self.task_list ) ) )
-    for i in range( len( self.task_list ) - 1, -1, -1 ):
-      if self.task_list[ i ].done:
-        logging.debug( 'handler: task "{0}" is done.'.format( i ) )
-        del self.task_list[ i ]
+    logging.debug( 'handler: curenly have {0} tasks'.format( len( self.task_map ) ) )
+
+  async def wait( self, timeout=None ):  # timeout in seconds, after which the remaining jobs are cancelled
+    try:
+      await asyncio.wait_for( self.idle_event.wait(), timeout )
+    except asyncio.TimeoutError:
+      task_list = list( self.task_map.values() )
+      logging.warning( 'handler: "{0}" jobs still running after "{1}" seconds, cancelling them'.format( len( task_list ), timeout ) )
+      for task in task_list:
+        task.cancel()
+
+      await asyncio.gather( *task_list, return_exceptions=True )
+
+  async def drain( self ):  # replays the results in the spool, run as a task for the life of the handler
+    await self.spool.drain( self.results )
+
+  def shutdown( self ):
+    self.spool.close()
+    for module_name, executor in self.executor_map.items():
+      logging.debug( 'handler: shutting down executor for module "{0}"'.format( module_name ) )
+      executor.shutdown( wait=False )
 
-  async def wait( self ):
-    while self.task_list:
-      await asyncio.sleep( 2 )
-      self.checkTasks()
+    for abandoned in self.abandoned_map.values():  # the jobs are done or cancelled, the hung calls would hold up exiting
+      abandoned.terminate()
 
   def logStatus( self ):
     for module_name in self.module_map:
-      logging.info( 'handler: module "{0}": {1} slots aviable'.format( module_name, self.semaphore_map[ module_name ]._value ) )
+      logging.debug( 'handler: module "{0}": {1} of {2} slots aviable'.format( module_name, self.module_slots[ module_name ], self.limit_map[ module_name ] ) )
@@ -1,5 +1,40 @@
+import os
 import re
-from subcontractor.handler import _hideify
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from subcontractor.handler import _hideify, _Hidden, JobWorker, Handler
+from subcontractor.results import ResultSpool
+
+# this test file doubles as a plugin module for the Handler tests
+MODULE_NAME = 'test'
+
+
+def _pid( paramaters ):
+  time.sleep( paramaters.get( 'delay', 0 ) )
+  return { 'pid': os.getpid(), 'value': paramaters[ 'value' ] * 2 }
+
+
+def _hang( paramaters ):
+  time.sleep( paramaters[ 'delay' ] )
+  return {}
+
+
+_count_list = []
+
+
+def _count( paramaters ):
+  _count_list.append( paramaters[ 'target' ] )
+  time.sleep( 0.1 )
+  return { 'target': paramaters[ 'target' ], 'count': len( _count_list ) }
+
+
+_count.idempotent = True
+
+
+MODULE_FUNCTIONS = { 'pid': _pid, 'hang': _hang, 'count': _count }
 
 
 def test_hideify():
@@ -43,3 +78,288 @@ def test_hideify():
   paramaters = [ { 'a': 'b', 'c': 'd' }, { 'z': 'x', 'y': 43 }, [ { 'sdf': 'sdf', 'bob': [ 1, 23, 3, 4, { 'token': 'hi' } ] } ] ]
   assert _hideify( paramaters ) == [ { 'a': 'b', 'c': 'd' }, { 'z': 'x', 'y': 43 }, [ { 'sdf': 'sdf', 'bob': [ 1, 23, 3, 4, { 'token': 'salt:4925ec767f025a510a1b549340f21f139573007c80b1a8f137ecfa9f4d43b305' } ] } ] ]
   assert paramaters == [ { 'a': 'b', 'c': 'd' }, { 'z': 'x', 'y': 43 }, [ { 'sdf': 'sdf', 'bob': [ 1, 23, 3, 4, { 'token': 'hi' } ] } ] ]
+
+
+def test_hidden():
+  paramaters = { 'a': [ { 'password': 'my secret' } ] }
+  hidden = _Hidden( paramaters )
+  assert hidden.done is False  # nothing is done until it is needed
+  assert str( hidden ) == str( { 'a': [ { 'password': 'salt:488c46661db89a7f78d82aefb033d59b665b21e86a199a3569cb471368f40799' } ] } )
+  assert hidden.done is True
+  result = hidden.hidden
+  str( hidden )
+  assert hidden.hidden is result
+  assert paramaters == { 'a': [ { 'password': 'my secret' } ] }
+
+
+class FakeContractor():
+  def __init__( self ):
+    self.result_map = {}
+    self.error_map = {}
+
+  async def jobResults( self, job_id, data, cookie ):
+    self.result_map[ job_id ] = data
+    return 'Accepted'
+
+  async def jobError( self, job_id, msg, cookie ):
+    self.error_map[ job_id ] = msg
+
+  async def submitResults( self, entry_list ):
+    response_list = []
+    for entry in entry_list:
+      if 'msg' in entry:
+        await self.jobError( entry[ 'job_id' ], entry[ 'msg' ], entry[ 'cookie' ] )
+        response_list.append( 'Accepted' )
+      else:
+        response_list.append( await self.jobResults( entry[ 'job_id' ], entry[ 'data' ], entry[ 'cookie' ] ) )
+
+    return response_list
+
+
+def test_jobworker_executor():
+  contractor = FakeContractor()
+  spool = ResultSpool()
+
+  def blocking( paramaters ):
+    time.sleep( 0.2 )
+    return { 'thread': threading.current_thread().name }
+
+  async def native( paramaters ):
+    return { 'value': paramaters[ 'value' ] }
+
+  async def main():
+    semaphore = asyncio.Semaphore( 2 )
+    executor = ThreadPoolExecutor( max_workers=2, thread_name_prefix='test' )
+    start = time.monotonic()
+    await asyncio.gather( JobWorker( contractor, 'c', 1, blocking, {}, semaphore, lambda: executor, spool ).run(),
+                          JobWorker( contractor, 'c', 2, blocking, {}, semaphore, lambda: executor, spool ).run(),
+                          JobWorker( contractor, 'c', 3, native, { 'value': 5 }, semaphore, lambda: executor, spool ).run() )
+    executor.shutdown()
+    return time.monotonic() - start
+
+  elapsed = asyncio.run( main() )
+  assert elapsed < 0.35  # the two blocking calls ran at the same time
+  assert contractor.result_map[ 1 ][ 'thread' ].startswith( 'test' )
+  assert contractor.result_map[ 2 ][ 'thread' ].startswith( 'test' )
+  assert contractor.result_map[ 3 ] == { 'value': 5 }
+  assert contractor.error_map == {}
+  assert spool.entry_map == {}
+
+
+def test_handler_process_executor():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 2, 'process' )
+    handler.addJobs( [ { 'module': 'test', 'function': 'pid', 'cookie': 'c', 'job_id': 1, 'paramaters': { 'value': 4 } } ] )
+    await handler.wait()
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert contractor.result_map[ 1 ][ 'value' ] == 8
+  assert contractor.result_map[ 1 ][ 'pid' ] != os.getpid()
+
+
+def test_handler_module_slots():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10 )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 2 )
+    assert handler.module_slots == { 'test': 2 }
+    assert handler.empty_slots == 2  # capped by the module limit, not max_concurent_jobs
+    handler.addJobs( [ { 'module': 'test', 'function': 'pid', 'cookie': 'c', 'job_id': i, 'paramaters': { 'value': i } } for i in range( 3 ) ] )
+    assert handler.module_slots == { 'test': 0 }
+    assert handler.available_module_list == []
+    assert handler.empty_slots == 0
+    await handler.wait()
+    assert handler.module_slots == { 'test': 2 }
+    assert handler.available_module_list == [ 'test' ]
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert sorted( contractor.result_map.keys() ) == [ 0, 1, 2 ]
+
+
+class SlowContractor( FakeContractor ):
+  def __init__( self ):
+    super().__init__()
+    self.release_event = asyncio.Event()
+
+  async def jobResults( self, job_id, data, cookie ):
+    await self.release_event.wait()
+    return await super().jobResults( job_id, data, cookie )
+
+
+def test_handler_slots_released():
+  contractor = SlowContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10, result_window=0 )
+  _count_list.clear()
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 3 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'count', 'cookie': 'c', 'job_id': i, 'paramaters': { 'target': 'a' } } for i in range( 3 ) ] )
+    assert handler.module_slots == { 'test': 2 }  # the coalesced jobs don't take a slot
+    assert handler.queued_map == { 'test': 1 }
+    await asyncio.sleep( 0.05 )
+    assert handler.running_map == { 'test': 1 }
+    assert handler.queued_map == { 'test': 0 }
+
+    handler.slot_event.clear()
+    await asyncio.sleep( 0.2 )
+    assert len( handler.task_map ) == 3  # still reporting
+    assert handler.module_slots == { 'test': 3 }
+    assert handler.empty_slots == 3
+    assert handler.slot_event.is_set()
+
+    contractor.release_event.set()
+    await asyncio.wait_for( handler.wait(), 1 )
+    assert handler.module_slots == { 'test': 3 }
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert _count_list == [ 'a' ]
+  assert sorted( contractor.result_map ) == [ 0, 1, 2 ]
+
+
+def test_handler_slots_cancelled():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10 )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 1 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'hang', 'cookie': 'c', 'job_id': i, 'paramaters': { 'delay': 0.2 } } for i in range( 2 ) ] )
+    await asyncio.sleep( 0.05 )
+    assert ( handler.running_map, handler.queued_map ) == ( { 'test': 1 }, { 'test': 1 } )
+    await handler.wait( 0.01 )  # cancels them, one waiting on the semaphore
+    assert ( handler.running_map, handler.queued_map ) == ( { 'test': 0 }, { 'test': 0 } )
+    assert handler.module_slots == { 'test': 1 }
+    handler.shutdown()
+
+  asyncio.run( main() )
+
+
+def test_handler_task_tracking():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10 )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 5 )
+    await asyncio.wait_for( handler.wait(), 1 )  # nothing to wait on
+    handler.addJobs( [ { 'module': 'test', 'function': 'pid', 'cookie': 'c', 'job_id': i, 'paramaters': { 'value': i } } for i in ( 1, 2, 2 ) ] )
+    assert sorted( handler.task_map.keys() ) == [ 1, 2 ]  # the duplicate is dropped
+    assert handler.empty_slots == 3
+    await asyncio.wait_for( handler.wait(), 1 )
+    assert handler.task_map == {}
+    assert handler.empty_slots == 5
+    assert handler.slot_event.is_set()
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert contractor.result_map[ 2 ][ 'value' ] == 4
+
+
+def test_handler_timeout():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10 )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 1 )
+    handler.setTimeout( 'subcontractor.handler_test.hang', 0.2 )
+    assert handler.getTimeout( 'test', 'hang' ) == 0.2
+    assert handler.getTimeout( 'test', 'pid' ) is None
+    executor = handler.executor_map[ 'test' ]
+    handler.addJobs( [ { 'module': 'test', 'function': 'hang', 'cookie': 'c', 'job_id': 1, 'paramaters': { 'delay': 1 } },
+                       { 'module': 'test', 'function': 'pid', 'cookie': 'c', 'job_id': 2, 'paramaters': { 'value': 1 } } ] )
+    await asyncio.wait_for( handler.wait(), 0.8 )  # the second job did not wait for the hung one
+    assert handler.executor_map[ 'test' ] is not executor
+
+    handler.addJobs( [ { 'module': 'test', 'function': 'hang', 'cookie': 'c', 'job_id': 3, 'paramaters': { 'delay': 0.1 } } ] )
+    await asyncio.wait_for( handler.wait(), 1 )
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert contractor.error_map[ 1 ].startswith( 'Timeout' )
+  assert contractor.result_map[ 2 ][ 'value' ] == 2
+  assert contractor.result_map[ 3 ] == {}
+
+
+def test_handler_process_timeout():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10, job_timeout=60 )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 2, 'process' )
+    handler.setTimeout( 'subcontractor.handler_test', 0.5 )
+    handler.setTimeout( 'subcontractor.handler_test.pid', 0 )
+    assert handler.getTimeout( 'test', 'hang' ) == 0.5
+    assert handler.getTimeout( 'test', 'pid' ) is None  # 0 is no timeout, not job_timeout
+    executor = handler.executor_map[ 'test' ]
+    await asyncio.wrap_future( executor.submit( _pid, { 'value': 0 } ) )  # the workers are up
+    process_list = list( executor._processes.values() )
+    handler.addJobs( [ { 'module': 'test', 'function': 'hang', 'cookie': 'c', 'job_id': 1, 'paramaters': { 'delay': 30 } },
+                       { 'module': 'test', 'function': 'pid', 'cookie': 'c', 'job_id': 2, 'paramaters': { 'delay': 1.5, 'value': 1 } } ] )
+    await asyncio.sleep( 1 )
+    assert handler.executor_map[ 'test' ] is not executor
+    assert [ process.is_alive() for process in process_list ] == [ True, True ]  # the hung one waits for job 2
+
+    await asyncio.wait_for( handler.wait(), 5 )
+    for process in process_list:
+      process.join( 5 )
+      assert not process.is_alive()
+
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert contractor.error_map[ 1 ].startswith( 'Timeout' )
+  assert contractor.result_map[ 2 ][ 'value' ] == 2  # not failed with BrokenProcessPool
+
+
+def test_handler_wait_deadline():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10 )
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 1 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'hang', 'cookie': 'c', 'job_id': 1, 'paramaters': { 'delay': 0.5 } } ] )
+    await handler.wait( 0.1 )
+    assert handler.task_map == {}
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert contractor.result_map == {}
+
+
+def test_handler_idempotent():
+  contractor = FakeContractor()
+  handler = Handler( contractor )
+  handler.setLimits( max_concurent_jobs=10, result_window=0, idempotent_window=0.2 )
+  _count_list.clear()
+
+  async def main():
+    handler.registerModule( 'subcontractor.handler_test', 5 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'count', 'cookie': 'c', 'job_id': i, 'paramaters': { 'target': target } } for i, target in ( ( 1, 'a' ), ( 2, 'a' ), ( 3, 'b' ) ) ] )
+    await asyncio.sleep( 0.05 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'count', 'cookie': 'c', 'job_id': 4, 'paramaters': { 'target': 'a' } } ] )  # while 1 is running
+    await asyncio.wait_for( handler.wait(), 1 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'count', 'cookie': 'c', 'job_id': 5, 'paramaters': { 'target': 'a' } } ] )  # within the window
+    await asyncio.wait_for( handler.wait(), 1 )
+    await asyncio.sleep( 0.3 )
+    handler.addJobs( [ { 'module': 'test', 'function': 'count', 'cookie': 'c', 'job_id': 6, 'paramaters': { 'target': 'a' } } ] )
+    await asyncio.wait_for( handler.wait(), 1 )
+    assert handler.job_counter.value_map == { ( 'test', 'done' ): 3, ( 'test', 'coalesced' ): 3 }
+    handler.shutdown()
+
+  asyncio.run( main() )
+  assert sorted( _count_list ) == [ 'a', 'a', 'b' ]
+  assert [ contractor.result_map[ i ][ 'target' ] for i in range( 1, 7 ) ] == [ 'a', 'a', 'b', 'a', 'a', 'a' ]
+  assert contractor.result_map[ 1 ] == contractor.result_map[ 5 ]
+  assert contractor.result_map[ 6 ] != contractor.result_map[ 1 ]
@@ -0,0 +1,139 @@
+import os
+import json
+import pickle
+import logging
+
+CACHE_VERSION = 1
+CACHE_COMPACT_SIZE = 1048576  # bytes, don't bother re-writing the file until it is at least this big
+
+
+# the DHCPd leases, so they survive a restart.  The first line is { "version": <version> }, then one json object
+# per line, either { "pool": <name>, "changes": { <key>: <value> } } or { "pool": <name>, "removed": true }, the pools
+# decide what the keys and values are, a value of null removes the key.  Each save only appends what changed, and is
+# fsync'd, once the file is more than twice the size of the current state it is re-written ( temp file and rename ).
+# A partial last line from a crash is skipped.
+class LeaseCache():
+  def __init__( self, filename ):
+    super().__init__()
+    self.filename = filename
+    self.pool_map = {}  # key is pool name, value is { key: value }, as of the last save
+    self.snapshot_size = 0
+    self.fp = None
+
+  # read the file without changing it, returns { pool name: { key: value } }
+  def read( self ):
+    self.pool_map = {}
+    try:
+      fp = open( self.filename, 'rb' )
+    except FileNotFoundError:
+      return self.pool_map
+
+    try:
+      header = json.loads( fp.readline() )
+      version = header[ 'version' ]
+    except ( ValueError, KeyError, TypeError ):
+      fp.seek( 0 )
+      self._readPickle( fp )
+      fp.close()
+      return self.pool_map
+
+    if version != CACHE_VERSION:
+      logging.warning( 'DHCPd: lease cache "{0}" is version "{1}", expected "{2}", ignoring'.format( self.filename, version, CACHE_VERSION ) )
+      fp.close()
+      return self.pool_map
+
+    for line in fp:
+      try:
+        record = json.loads( line )
+      except ValueError:
+        logging.warning( 'DHCPd: skipping invalid lease cache line "{0}"'.format( line[ 0:50 ] ) )
+        continue
+
+      self._apply( record )
+
+    fp.close()
+    return self.pool_map
+
+  def _readPickle( self, fp ):  # from before the cache was a journal
+    try:
+      cache = pickle.load( fp )
+    except Exception:
+      logging.warning( 'DHCPd: unable to read lease cache "{0}", ignoring'.format( self.filename ) )
+      return
+
+    logging.info( 'DHCPd: converting old lease cache "{0}"'.format( self.filename ) )
+    for name, pool in cache.items():
+      if name == '__static__':
+        self.pool_map[ name ] = { mac: list( entry ) for mac, entry in pool.items() }
+      else:
+        ( address_map, expires_map ) = pool
+        self.pool_map[ name ] = { address: [ mac, expires_map[ address ].timestamp() if expires_map.get( address ) is not None else None ] for address, mac in address_map.items() }
+
+  def _apply( self, record ):
+    name = record[ 'pool' ]
+    if record.get( 'removed', False ):
+      self.pool_map.pop( name, None )
+      return
+
+    pool = self.pool_map.setdefault( name, {} )
+    for key, value in record[ 'changes' ].items():
+      if value is None:
+        pool.pop( key, None )
+      else:
+        pool[ key ] = value
+
+  # read the file and re-write it with just the current state, ready for save
+  def load( self ):
+    self.read()
+    logging.info( 'DHCPd: loaded "{0}" pools from the lease cache'.format( len( self.pool_map ) ) )
+    self.compact()
+    return self.pool_map
+
+  def compact( self ):
+    if self.fp is not None:
+      self.fp.close()
+
+    tmp_filename = '{0}.tmp'.format( self.filename )
+    fp = open( tmp_filename, 'w' )
+    fp.write( json.dumps( { 'version': CACHE_VERSION } ) + '\n' )
+    for name, pool in self.pool_map.items():
+      fp.write( json.dumps( { 'pool': name, 'changes': pool } ) + '\n' )
+    fp.flush()
+    os.fsync( fp.fileno() )
+    self.snapshot_size = fp.tell()
+    fp.close()
+    os.rename( tmp_filename, self.filename )
+
+    self.fp = open( self.filename, 'a' )
+
+  # change_map is { pool name: { key: value } } of what changed since the last save, pools not in name_list are removed
+  def save( self, change_map, name_list ):
+    if self.fp is None:
+      self.compact()
+
+    record_list = []
+    for name in set( self.pool_map.keys() ) - set( name_list ):
+      record_list.append( { 'pool': name, 'removed': True } )
+
+    for name, changes in change_map.items():
+      if changes:
+        record_list.append( { 'pool': name, 'changes': changes } )
+
+    for record in record_list:
+      self._apply( record )
+
+    if not record_list:
+      return
+
+    for record in record_list:
+      self.fp.write( json.dumps( record ) + '\n' )
+    self.fp.flush()
+    os.fsync( self.fp.fileno() )
+
+    if self.fp.tell() > max( self.snapshot_size * 2, CACHE_COMPACT_SIZE ):
+      self.compact()
+
+  def close( self ):
+    if self.fp is not None:
+      self.fp.close()
+      self.fp = None
@@ -0,0 +1,46 @@
+import pickle
+from datetime import datetime, UTC
+
+from subcontractor import lease_cache
+from subcontractor.lease_cache import LeaseCache
+
+
+def test_lease_cache( tmp_path, monkeypatch ):
+  filename = str( tmp_path / 'dhcpd.cache' )
+  cache = LeaseCache( filename )
+  assert cache.load() == {}
+
+  cache.save( { 'pool1': { '10.0.0.1': [ 'aa', 1000 ], '10.0.0.2': [ None, None ] } }, [ 'pool1' ] )
+  cache.save( { 'pool1': { '10.0.0.2': [ 'bb', 2000 ] }, '__static__': { 'cc': [ [ 10, 0, 0, 3 ] ] } }, [ 'pool1', '__static__' ] )
+  cache.save( { 'pool1': { '10.0.0.1': None } }, [ 'pool1', '__static__' ] )
+  cache.close()
+
+  fp = open( filename, 'a' )
+  fp.write( '{"pool": "pool1", "chan' )  # crashed mid write
+  fp.close()
+
+  expected = { 'pool1': { '10.0.0.2': [ 'bb', 2000 ] }, '__static__': { 'cc': [ [ 10, 0, 0, 3 ] ] } }
+  cache = LeaseCache( filename )
+  assert cache.load() == expected
+  assert len( open( filename ).readlines() ) == 3  # re-written with just the current state
+
+  monkeypatch.setattr( lease_cache, 'CACHE_COMPACT_SIZE', 0 )
+  cache.save( { 'pool1': { '10.0.0.2': [ 'bb', 3000 ] } }, [ 'pool1' ] )  # removes __static__
+  cache.save( { 'pool1': { '10.0.0.2': [ 'bb', 4000 ] } }, [ 'pool1' ] )
+  cache.close()
+  assert len( open( filename ).readlines() ) == 2
+  assert LeaseCache( filename ).read() == { 'pool1': { '10.0.0.2': [ 'bb', 4000 ] } }
+
+  open( filename, 'w' ).write( '{"version": 99}\n' )
+  assert LeaseCache( filename ).read() == {}
+
+
+def test_lease_cache_pickle( tmp_path ):
+  filename = str( tmp_path / 'dhcpd.cache' )
+  expires = datetime.fromtimestamp( 1000, UTC )
+  fp = open( filename, 'wb' )
+  pickle.dump( { '__static__': { 'cc': ( [ 10, 0, 0, 3 ], None ) }, 'pool1': ( { '10.0.0.1': 'aa', '10.0.0.2': None }, { '10.0.0.1': expires, '10.0.0.2': None } ) }, fp )
+  fp.close()
+
+  assert LeaseCache( filename ).load() == { '__static__': { 'cc': [ [ 10, 0, 0, 3 ], None ] }, 'pool1': { '10.0.0.1': [ 'aa', 1000 ], '10.0.0.2': [ None, None ] } }
+  assert LeaseCache( filename ).read()[ 'pool1' ][ '10.0.0.1' ] == [ 'aa', 1000 ]
@@ -0,0 +1,72 @@
+import mmap
+import struct
+import ipaddress
+import multiprocessing
+from functools import lru_cache
+
+# address, mac, expires ( seconds since epoch ), address 0 is an empty slot, mac all 0 is a free address
+RECORD = struct.Struct( '!I6s2xd' )
+NO_MAC = bytes( 6 )
+
+
+@lru_cache( maxsize=65536 )
+def _addressKey( address ):
+  return int( ipaddress.IPv4Address( address ) )
+
+
+@lru_cache( maxsize=65536 )
+def _macToBytes( mac ):
+  return bytes.fromhex( mac.replace( ':', '' ) )
+
+
+def _bytesToMac( value ):
+  return ':'.join( [ '{0:02x}'.format( i ) for i in value ] )
+
+
+# fixed size table of dynamic leases in anonymous shared memory, created before forking the DHCPd worker processes
+# so they all see the same leases.  Keyed by address with open addressing, slots are never removed, a released
+# address just has it's mac cleared, so size needs to be larger than the number of dynamic addresses
+class LeaseTable():
+  def __init__( self, size=65536 ):
+    super().__init__()
+    self.size = size
+    self.mmap = mmap.mmap( -1, size * RECORD.size, flags=mmap.MAP_SHARED )
+    self.lock = multiprocessing.get_context( 'fork' ).Lock()  # hold while doing a read, decide, write
+
+  def _slot( self, address, create ):
+    key = _addressKey( address )
+    slot = key % self.size
+    for _ in range( self.size ):
+      ( slot_key, mac, expires ) = RECORD.unpack_from( self.mmap, slot * RECORD.size )
+      if slot_key == key:
+        return ( slot, mac, expires )
+
+      if slot_key == 0:
+        if not create:
+          return ( None, NO_MAC, 0 )
+
+        RECORD.pack_into( self.mmap, slot * RECORD.size, key, NO_MAC, 0 )
+        return ( slot, NO_MAC, 0 )
+
+      slot = ( slot + 1 ) % self.size
+
+    raise Exception( 'Lease Table is full' )
+
+  # returns ( mac, expires ), mac is None if the address is free or the lease has expired as of now
+  def get( self, address, now ):
+    ( _, mac, expires ) = self._slot( address, False )
+    if mac == NO_MAC or expires < now:
+      return ( None, None )
+
+    return ( _bytesToMac( mac ), expires )
+
+  def set( self, address, mac, expires ):
+    ( slot, _, _ ) = self._slot( address, True )
+    RECORD.pack_into( self.mmap, slot * RECORD.size, _addressKey( address ), _macToBytes( mac ), expires )
+
+  def clear( self, address, mac ):  # only if it is still leased to mac
+    ( slot, current, _ ) = self._slot( address, False )
+    if slot is None or current != _macToBytes( mac ):
+      return
+
+    RECORD.pack_into( self.mmap, slot * RECORD.size, _addressKey( address ), NO_MAC, 0 )
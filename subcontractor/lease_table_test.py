@@ -0,0 +1,28 @@
+import multiprocessing
+
+from subcontractor.lease_table import LeaseTable
+
+
+def _child( table ):
+  with table.lock:
+    table.set( '10.0.0.2', '02:00:00:00:00:02', 2000 )
+
+
+def test_lease_table():
+  table = LeaseTable( 16 )
+  assert table.get( '10.0.0.1', 1000 ) == ( None, None )
+
+  table.set( '10.0.0.1', '02:00:00:00:00:01', 2000 )
+  assert table.get( '10.0.0.1', 1000 ) == ( '02:00:00:00:00:01', 2000 )
+  assert table.get( '10.0.0.1', 3000 ) == ( None, None )  # expired
+  assert table.get( '10.0.0.17', 1000 ) == ( None, None )  # same slot, different address
+
+  table.clear( '10.0.0.1', '02:00:00:00:00:99' )  # not the current lease
+  assert table.get( '10.0.0.1', 1000 ) == ( '02:00:00:00:00:01', 2000 )
+  table.clear( '10.0.0.1', '02:00:00:00:00:01' )
+  assert table.get( '10.0.0.1', 1000 ) == ( None, None )
+
+  process = multiprocessing.get_context( 'fork' ).Process( target=_child, args=( table, ) )
+  process.start()
+  process.join()
+  assert table.get( '10.0.0.2', 1000 ) == ( '02:00:00:00:00:02', 2000 )
@@ -0,0 +1,100 @@
+import os
+import asyncio
+import importlib.util
+import importlib.machinery
+
+import pytest
+
+pytest.importorskip( 'cinp.client' )  # bin/subcontractor needs it for Contractor
+
+from cinp.client import Timeout
+
+BIN_SUBCONTRACTOR = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), 'bin', 'subcontractor' )
+
+
+def _loadMain():
+  loader = importlib.machinery.SourceFileLoader( 'subcontractor_main', BIN_SUBCONTRACTOR )
+  module = importlib.util.module_from_spec( importlib.util.spec_from_loader( loader.name, loader ) )
+  loader.exec_module( module )
+  return module.Main
+
+
+class FakeContractor():
+  def __init__( self, job_list ):
+    self.job_list = job_list
+    self.long_poll = False
+    self.get_count = 0
+    self.fail = False
+    self.result_map = {}
+
+  async def getJobs( self, max_jobs, wait=0, module_list=None ):  # like contractor, it can hand out more for a module than it has slots
+    self.get_count += 1
+    if self.fail:
+      raise Timeout()
+
+    job_list = self.job_list
+    self.job_list = []
+    return job_list
+
+  async def submitResults( self, entry_list ):
+    for entry in entry_list:
+      self.result_map[ entry[ 'job_id' ] ] = entry
+
+    return [ 'Accepted' ] * len( entry_list )
+
+  def close( self ):
+    pass
+
+
+def _main( job_list, poll_interval=10 ):
+  from subcontractor.handler import Handler
+
+  contractor = FakeContractor( job_list )
+  main = _loadMain()()
+  main.contractor = contractor
+  main.poll_interval = poll_interval
+  main.max_job_request_size = 5
+  main.long_poll = 0
+  main.shutdown_timeout = 1
+  main.handler = Handler( contractor )
+  main.handler.setLimits( job_delay=0, max_concurent_jobs=10, result_window=0 )
+  return main
+
+
+def test_main_loop_module_full():
+  main = _main( [ { 'module': 'test', 'function': 'hang', 'cookie': 'c', 'job_id': i, 'paramaters': { 'delay': 0.2 } } for i in range( 3 ) ] )
+  iteration_list = []
+  main.handler.checkTasks = lambda: iteration_list.append( 1 )
+
+  async def _test():
+    main.handler.registerModule( 'subcontractor.handler_test', 1 )
+    task = asyncio.create_task( main.main() )
+    await asyncio.sleep( 0.5 )  # the first job is done, the module is still full with the other two
+    iteration_count = len( iteration_list )
+    await asyncio.sleep( 0.5 )
+    main.stop()
+    await task
+    return iteration_count
+
+  assert asyncio.run( _test() ) < 10  # not spinning while the module is full
+  assert len( iteration_list ) < 20
+  assert sorted( main.contractor.result_map.keys() ) == [ 0, 1, 2 ]
+
+
+def test_main_loop_contractor_error():
+  main = _main( [ { 'module': 'test', 'function': 'pid', 'cookie': 'c', 'job_id': 1, 'paramaters': { 'value': 1 } } ], poll_interval=0.1 )
+  main.contractor.fail = True
+
+  async def _test():
+    main.handler.registerModule( 'subcontractor.handler_test', 1 )
+    task = asyncio.create_task( main.main() )
+    await asyncio.sleep( 0.3 )
+    assert not task.done()  # still running
+    main.contractor.fail = False
+    await asyncio.sleep( 0.3 )
+    main.stop()
+    await task
+
+  asyncio.run( _test() )
+  assert main.contractor.get_count > 2
+  assert list( main.contractor.result_map.keys() ) == [ 1 ]
@@ -0,0 +1,148 @@
+import logging
+import asyncio
+from bisect import bisect_left
+from urllib.parse import urlsplit, parse_qs
+
+# seconds
+DEFAULT_BUCKETS = ( 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600 )
+
+
+# the components keep their own counts in plain attributes and Histograms, which cost next to nothing to update,
+# and register a callback here, the callbacks are only called when the metrics are asked for
+class Histogram():
+  __slots__ = ( 'bucket_list', 'count_list', 'sum', 'count' )
+
+  def __init__( self, bucket_list=DEFAULT_BUCKETS ):
+    super().__init__()
+    self.bucket_list = bucket_list
+    self.count_list = [ 0 ] * ( len( bucket_list ) + 1 )  # the last is for over the largest bucket
+    self.sum = 0.0
+    self.count = 0
+
+  def observe( self, value ):
+    self.count_list[ bisect_left( self.bucket_list, value ) ] += 1
+    self.sum += value
+    self.count += 1
+
+  def state( self ):  # something that can be sent to another process and merged
+    return ( list( self.count_list ), self.sum, self.count )
+
+  def merge( self, state ):
+    ( count_list, total, count ) = state
+    for i in range( len( self.count_list ) ):
+      self.count_list[ i ] += count_list[ i ]
+    self.sum += total
+    self.count += count
+
+
+class Counter():  # counts by label values
+  __slots__ = ( 'value_map', )
+
+  def __init__( self ):
+    super().__init__()
+    self.value_map = {}  # key is a tuple of the label values
+
+  def inc( self, label_values, value=1 ):
+    self.value_map[ label_values ] = self.value_map.get( label_values, 0 ) + value
+
+
+def _labels( label_names, label_values, extra=None ):
+  pair_list = [ '{0}="{1}"'.format( name, str( value ).replace( '\\', '\\\\' ).replace( '"', '\\"' ) ) for name, value in zip( label_names, label_values ) ]
+  if extra is not None:
+    pair_list.append( extra )
+
+  if not pair_list:
+    return ''
+
+  return '{' + ','.join( pair_list ) + '}'
+
+
+class Registry():
+  def __init__( self ):
+    super().__init__()
+    self.metric_map = {}  # key is name, value is ( type, help, label names, callback )
+
+  # metric_type is counter, gauge or histogram, callback returns { label values tuple: value }, value is a Histogram for
+  # histograms, registering the same name again replaces it
+  def register( self, name, metric_type, help, label_names, callback ):
+    self.metric_map[ name ] = ( metric_type, help, tuple( label_names ), callback )
+
+  def unregister( self, name ):
+    self.metric_map.pop( name, None )
+
+  def render( self ):  # in the prometheus text format
+    line_list = []
+    for name, ( metric_type, help, label_names, callback ) in sorted( self.metric_map.items() ):
+      try:
+        value_map = callback()
+      except Exception:
+        logging.exception( 'metrics: exception getting "{0}"'.format( name ) )
+        continue
+
+      line_list.append( '# HELP {0} {1}'.format( name, help ) )
+      line_list.append( '# TYPE {0} {1}'.format( name, metric_type ) )
+      for label_values, value in sorted( value_map.items() ):
+        if metric_type != 'histogram':
+          line_list.append( '{0}{1} {2}'.format( name, _labels( label_names, label_values ), value ) )
+          continue
+
+        total = 0
+        for bucket, count in zip( value.bucket_list + ( '+Inf', ), value.count_list ):
+          total += count
+          line_list.append( '{0}_bucket{1} {2}'.format( name, _labels( label_names, label_values, 'le="{0}"'.format( bucket ) ), total ) )
+        line_list.append( '{0}_sum{1} {2}'.format( name, _labels( label_names, label_values ), value.sum ) )
+        line_list.append( '{0}_count{1} {2}'.format( name, _labels( label_names, label_values ), value.count ) )
+
+    return '\n'.join( line_list ) + '\n'
+
+
+REGISTRY = Registry()
+ENDPOINT_MAP = {}  # other paths to serve, key is the path, value is an async function that takes the query paramaters ( as from parse_qs ) and returns the body
+
+
+def addEndpoint( path, handler ):
+  ENDPOINT_MAP[ path ] = handler
+
+
+# a minimal HTTP server, GET /metrics returns REGISTRY.render(), plus ENDPOINT_MAP
+async def _request( reader, writer ):
+  try:
+    request_line = await asyncio.wait_for( reader.readline(), 10 )
+    while ( await asyncio.wait_for( reader.readline(), 10 ) ) not in ( b'\r\n', b'\n', b'' ):  # skip the headers
+      pass
+
+    try:
+      ( method, url, _ ) = request_line.decode().split( ' ', 2 )
+      url = urlsplit( url )
+    except ValueError:
+      method = url = None
+
+    status = '200 OK'
+    if method != 'GET':
+      status = '404 Not Found'
+      body = b'Not Found\n'
+    elif url.path in ( '/', '/metrics' ):
+      body = REGISTRY.render().encode()
+    elif url.path in ENDPOINT_MAP:
+      try:
+        body = ( await ENDPOINT_MAP[ url.path ]( parse_qs( url.query ) ) ).encode()
+      except ValueError as e:
+        status = '400 Bad Request'
+        body = '{0}\n'.format( e ).encode()
+    else:
+      status = '404 Not Found'
+      body = b'Not Found\n'
+
+    writer.write( 'HTTP/1.0 {0}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {1}\r\nConnection: close\r\n\r\n'.format( status, len( body ) ).encode() + body )
+    await writer.drain()
+
+  except ( asyncio.TimeoutError, ConnectionError ):
+    pass
+
+  finally:
+    writer.close()
+
+
+async def startServer( address, port ):
+  logging.info( 'metrics: listening on "{0}:{1}"'.format( address, port ) )
+  return await asyncio.start_server( _request, address, port )
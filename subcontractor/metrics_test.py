@@ -0,0 +1,60 @@
+import asyncio
+
+from subcontractor.metrics import Registry, Histogram, Counter, REGISTRY, startServer
+
+
+def test_render():
+  histogram = Histogram( ( 0.1, 1 ) )
+  histogram.observe( 0.05 )
+  histogram.observe( 0.5 )
+  histogram.observe( 5 )
+  other = Histogram( ( 0.1, 1 ) )
+  other.merge( histogram.state() )
+  assert other.count_list == [ 1, 1, 1 ]
+
+  counter = Counter()
+  counter.inc( ( 'ssh', 'done' ) )
+  counter.inc( ( 'ssh', 'done' ), 2 )
+
+  registry = Registry()
+  registry.register( 'jobs_total', 'counter', 'jobs', ( 'module', 'status' ), lambda: counter.value_map )
+  registry.register( 'duration_seconds', 'histogram', 'duration', ( 'module', ), lambda: { ( 'ssh', ): other } )
+  registry.register( 'broken', 'gauge', 'raises', (), lambda: 1 / 0 )
+  assert registry.render().splitlines() == [
+                                              '# HELP duration_seconds duration',
+                                              '# TYPE duration_seconds histogram',
+                                              'duration_seconds_bucket{module="ssh",le="0.1"} 1',
+                                              'duration_seconds_bucket{module="ssh",le="1"} 2',
+                                              'duration_seconds_bucket{module="ssh",le="+Inf"} 3',
+                                              'duration_seconds_sum{module="ssh"} 5.55',
+                                              'duration_seconds_count{module="ssh"} 3',
+                                              '# HELP jobs_total jobs',
+                                              '# TYPE jobs_total counter',
+                                              'jobs_total{module="ssh",status="done"} 3'
+                                            ]
+
+
+def test_server():
+  async def _test():
+    REGISTRY.register( 'test_value', 'gauge', 'test', (), lambda: { (): 42 } )
+    server = await startServer( '127.0.0.1', 0 )
+    port = server.sockets[0].getsockname()[1]
+    try:
+      result = {}
+      for path in ( '/metrics', '/other' ):
+        ( reader, writer ) = await asyncio.open_connection( '127.0.0.1', port )
+        writer.write( 'GET {0} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format( path ).encode() )
+        result[ path ] = await reader.read()
+        writer.close()
+
+    finally:
+      REGISTRY.unregister( 'test_value' )
+      server.close()
+      await server.wait_closed()
+
+    return result
+
+  result = asyncio.run( _test() )
+  assert result[ '/metrics' ].startswith( b'HTTP/1.0 200 OK' )
+  assert b'\ntest_value 42\n' in result[ '/metrics' ]
+  assert result[ '/other' ].startswith( b'HTTP/1.0 404' )
@@ -0,0 +1,117 @@
+from subcontractor.lease_cache import LeaseCache
+from subcontractor.metrics import REGISTRY
+
+
+# the named pools, searched in the order they were added, used by DHCPd, and by the parent process in
+# multi process mode which does not answer DHCP itself, just keeps the pools up to date and saves the cache
+class PoolSet():
+  def __init__( self ):
+    super().__init__()
+    self.pool_map = {}
+    self.pool_order = []
+    self.lease_cache = None
+    self.cache_map = {}  # leases from the cache for pools that have not been added yet
+    self.definition_map = {}  # key is dynamic pool name, value is the pool as contractor sent it, cached so the pools can be restored without contractor
+    self.definition_dirty_set = set()
+    REGISTRY.register( 'dhcpd_pool_addresses', 'gauge', 'addresses in each pool, by state', ( 'pool', 'state' ), self.pool_counts )
+
+  @property
+  def pool_names( self ):
+    return self.pool_map.keys()
+
+  def add_pool( self, pool, name ):  # pool should be empty, if the cache has leases for it they are loaded
+    cache = self.cache_map.pop( name, None )
+    if cache is not None:
+      pool.load_cache( cache )
+
+    self.pool_map[ name ] = pool
+    self.pool_order.append( name )
+
+  def del_pool( self, name ):
+    del self.pool_order[ self.pool_order.index( name ) ]
+    del self.pool_map[ name ]
+
+  def get_pool( self, name ):
+    return self.pool_map[ name ]
+
+  # dynamic_pool_list is as returned by contractor, new_pool returns a new empty DynamicPool,
+  # pools not in dynamic_pool_list are removed, static pools are left alone
+  async def update_dynamic_pools( self, dynamic_pool_list, new_pool ):
+    pool_names = [ '__static__' ]
+    for dynamic_pool in dynamic_pool_list:
+      name = dynamic_pool[ 'name' ]
+      pool_names.append( name )
+      if self.definition_map.get( name, None ) != dynamic_pool:
+        self.definition_map[ name ] = dynamic_pool
+        self.definition_dirty_set.add( name )
+
+      if name not in self.pool_map:
+        pool = new_pool()
+        self.add_pool( pool, name )  # before the addresses are set, so the cached leases are kept
+        await pool.update_paramaters( dynamic_pool[ 'gateway' ], dynamic_pool[ 'netmask' ], dynamic_pool[ 'dns_server' ], dynamic_pool[ 'domain_name' ], dynamic_pool[ 'address_list' ] )
+
+      else:
+        await self.pool_map[ name ].update_paramaters( dynamic_pool[ 'gateway' ], dynamic_pool[ 'netmask' ], dynamic_pool[ 'dns_server' ], dynamic_pool[ 'domain_name' ], dynamic_pool[ 'address_list' ] )
+
+    for name in set( self.pool_map.keys() ) - set( pool_names ):
+      self.del_pool( name )
+      self.definition_map.pop( name, None )
+      self.definition_dirty_set.add( name )
+
+  @property
+  def dynamic_pool_list( self ):
+    return list( self.definition_map.values() )
+
+  # re-create the dynamic pools as contractor last sent them, from the cache, call after load_cache
+  async def restore_dynamic_pools( self, new_pool ):
+    definition_map = self.cache_map.pop( '__dynamic_pools__', {} )
+    await self.update_dynamic_pools( list( definition_map.values() ), new_pool )
+    self.definition_dirty_set = set()  # the cache allready has them
+
+  async def cleanup( self ):
+    for pool in self.pool_map.values():
+      await pool.cleanup()
+
+  # pools allready added get their leases now, the rest when they are added
+  def load_cache( self, filepath ):
+    self.lease_cache = LeaseCache( filepath )
+    self.cache_map = dict( self.lease_cache.load() )
+    for name, pool in self.pool_map.items():
+      cache = self.cache_map.pop( name, None )
+      if cache is not None:
+        pool.load_cache( cache )
+
+  def save_cache( self ):  # only writes the leases that changed since the last save
+    if self.lease_cache is None:
+      return
+
+    change_map = {}
+    for name, pool in self.pool_map.items():
+      change_map[ name ] = pool.dump_changes()
+
+    change_map[ '__dynamic_pools__' ] = { name: self.definition_map.get( name, None ) for name in self.definition_dirty_set }
+    self.definition_dirty_set = set()
+
+    self.lease_cache.save( change_map, list( self.pool_map.keys() ) + list( self.cache_map.keys() ) + [ '__dynamic_pools__' ] )
+
+  def close_cache( self ):
+    if self.lease_cache is not None:
+      self.lease_cache.close()
+
+  def summary( self ):
+    result = {}
+    for name, pool in self.pool_map.items():
+      result[ name ] = pool.summary()
+
+    return result
+
+  def pool_counts( self ):  # { ( pool name, state ): count }
+    result = {}
+    for name, pool in self.pool_map.items():
+      for state, count in pool.counts().items():
+        result[ ( name, state ) ] = count
+
+    return result
+
+  def reclaim_counts( self ):
+    return dict( [ ( name, pool.reclaim_count ) for name, pool in self.pool_map.items() ] )
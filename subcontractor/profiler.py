@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import logging
+import asyncio
+import threading
+from datetime import datetime
+from contextlib import nullcontext
+
+from subcontractor.metrics import Histogram
+
+_span_map = None  # while profiling, key is span name, value is a Histogram of how long it took
+_NULL_SPAN = nullcontext()
+
+
+def _spanName( part ):
+  qualname = getattr( part, '__qualname__', None )
+  if qualname is None:
+    return str( part )
+
+  return '{0}.{1}'.format( part.__module__, qualname )
+
+
+class _Span():
+  __slots__ = ( 'name_parts', 'start' )
+
+  def __init__( self, name_parts ):
+    self.name_parts = name_parts
+    self.start = None
+
+  def __enter__( self ):
+    self.start = time.perf_counter()
+
+  def __exit__( self, exc_type, exc_value, traceback ):
+    elapsed = time.perf_counter() - self.start
+    if _span_map is None:  # profiling ended while we were in the span
+      return
+
+    name = '.'.join( [ _spanName( part ) for part in self.name_parts ] )
+    try:
+      _span_map[ name ].observe( elapsed )
+    except KeyError:
+      histogram = _span_map[ name ] = Histogram()
+      histogram.observe( elapsed )
+
+
+# times the with block while profiling, the name is the parts joined with "."s, functions and classes are by their
+# module and name, the name is only worked out while profiling, so when not profiling this is a check and a nullcontext, ie:
+#   with span( 'contractor', method ):
+def span( *name_parts ):
+  if _span_map is None:
+    return _NULL_SPAN
+
+  return _Span( name_parts )
+
+
+class _SlowCallbackHandler( logging.Handler ):  # collects asyncio's "Executing <Handle ...> took 0.123 seconds"
+  def __init__( self ):
+    super().__init__()
+    self.message_list = []
+
+  def emit( self, record ):
+    if isinstance( record.msg, str ) and record.msg.startswith( 'Executing' ):
+      self.message_list.append( record.getMessage() )
+
+
+# samples the stacks of all the threads for a while, and writes them as collapsed stacks, one per line
+# "thread;outer function;...;inner function count", which flamegraph.pl and speedscope take. While
+# sampling the event loop is put in debug mode to log the slow callbacks, and the spans are timed, those
+# go in a report next to the stacks.  Nothing is done until profile is called.
+class Profiler():
+  def __init__( self, name, directory, seconds=30, interval=0.005, slow_callback_duration=0.1 ):
+    super().__init__()
+    self.name = name
+    self.directory = directory
+    self.seconds = seconds
+    self.interval = interval
+    self.slow_callback_duration = slow_callback_duration
+    self.running = False
+    self.task = None
+
+  def _sample( self, stop_event, stack_map ):
+    ident = threading.get_ident()
+    while not stop_event.wait( self.interval ):
+      name_map = dict( [ ( thread.ident, thread.name ) for thread in threading.enumerate() ] )
+      for thread_id, frame in sys._current_frames().items():
+        if thread_id == ident:
+          continue
+
+        frame_list = []
+        while frame is not None:
+          frame_list.append( '{0}:{1}'.format( os.path.basename( frame.f_code.co_filename ), frame.f_code.co_name ) )
+          frame = frame.f_back
+
+        frame_list.append( name_map.get( thread_id, str( thread_id ) ) )
+        key = ';'.join( reversed( frame_list ) )
+        stack_map[ key ] = stack_map.get( key, 0 ) + 1
+
+  # returns the filename of the collapsed stacks, the report is the same name ending in .txt, None if allready running
+  async def profile( self, seconds=None ):
+    global _span_map
+
+    if self.running:
+      logging.warning( 'profiler: allready running' )
+      return None
+
+    if seconds is None:
+      seconds = self.seconds
+
+    logging.info( 'profiler: profiling for "{0}" seconds...'.format( seconds ) )
+    self.running = True
+    loop = asyncio.get_running_loop()
+    debug = loop.get_debug()
+    slow_callback_duration = loop.slow_callback_duration
+    slow_handler = _SlowCallbackHandler()
+    logging.getLogger( 'asyncio' ).addHandler( slow_handler )
+    loop.slow_callback_duration = self.slow_callback_duration
+    loop.set_debug( True )
+
+    stack_map = {}
+    span_map = _span_map = {}
+    stop_event = threading.Event()
+    thread = threading.Thread( target=self._sample, args=( stop_event, stack_map ), name='profiler', daemon=True )
+    thread.start()
+    try:
+      await asyncio.sleep( seconds )
+
+    finally:
+      stop_event.set()
+      await loop.run_in_executor( None, thread.join )
+      _span_map = None
+      loop.set_debug( debug )
+      loop.slow_callback_duration = slow_callback_duration
+      logging.getLogger( 'asyncio' ).removeHandler( slow_handler )
+      self.running = False
+
+    filename = os.path.join( self.directory, '{0}-{1}-{2}'.format( self.name, os.getpid(), datetime.now().strftime( '%Y%m%d-%H%M%S' ) ) )
+    fp = open( filename + '.collapsed', 'w' )
+    for key, count in sorted( stack_map.items() ):
+      fp.write( '{0} {1}\n'.format( key, count ) )
+    fp.close()
+
+    fp = open( filename + '.txt', 'w' )
+    fp.write( '{0} samples over {1} seconds\n\n'.format( sum( stack_map.values() ), seconds ) )
+    fp.write( 'spans ( count, total, mean, largest bucket ):\n' )
+    for name, histogram in sorted( span_map.items(), key=lambda item: item[1].sum, reverse=True ):
+      fp.write( '  {0}: {1} {2:.6f}s {3:.6f}s {4}\n'.format( name, histogram.count, histogram.sum, histogram.sum / histogram.count, _maxBucket( histogram ) ) )
+
+    fp.write( '\ncallbacks that took more than {0} seconds:\n'.format( self.slow_callback_duration ) )
+    for message in slow_handler.message_list:
+      fp.write( '  {0}\n'.format( message ) )
+    fp.close()
+
+    logging.info( 'profiler: wrote "{0}.collapsed" and "{0}.txt"'.format( filename ) )
+    return filename + '.collapsed'
+
+  def start( self ):  # for signal handlers, profiles in the background
+    self.task = asyncio.get_running_loop().create_task( self.profile() )
+    self.task.add_done_callback( _profileDone )
+
+
+def _maxBucket( histogram ):  # the upper bound of the largest bucket with something in it
+  for i in range( len( histogram.count_list ) - 1, -1, -1 ):
+    if histogram.count_list[ i ]:
+      return '<={0}s'.format( histogram.bucket_list[ i ] ) if i < len( histogram.bucket_list ) else '>{0}s'.format( histogram.bucket_list[ -1 ] )
+
+  return '-'
+
+
+def _profileDone( task ):
+  if not task.cancelled() and task.exception() is not None:
+    logging.error( 'profiler: exception profiling: {0}'.format( task.exception() ) )
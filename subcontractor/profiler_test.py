@@ -0,0 +1,28 @@
+import time
+import asyncio
+
+from subcontractor.profiler import Profiler, span
+
+
+def test_profiler( tmp_path ):
+  assert span( 'test' ) is span( 'other' )  # not profiling, nothing to do
+
+  async def _test():
+    profiler = Profiler( 'test', str( tmp_path ), 0.5, interval=0.001, slow_callback_duration=0.05 )
+
+    async def _busy():
+      await asyncio.sleep( 0.1 )
+      with span( 'test', _busy ):
+        time.sleep( 0.1 )  # blocks the event loop
+
+    busy_task = asyncio.create_task( _busy() )
+    filename = await profiler.profile()
+    await busy_task
+    return filename
+
+  filename = asyncio.run( _test() )
+  stack_list = open( filename ).read().splitlines()
+  assert any( [ line.startswith( 'MainThread;' ) and 'profiler_test.py:_busy' in line for line in stack_list ] )
+  report = open( filename[ :-len( '.collapsed' ) ] + '.txt' ).read()
+  assert 'test.subcontractor.profiler_test.test_profiler.<locals>._test.<locals>._busy: 1 ' in report
+  assert 'took' in report  # the slow callback
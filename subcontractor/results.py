@@ -0,0 +1,213 @@
+import os
+import json
+import logging
+import asyncio
+
+SPOOL_COMPACT_SIZE = 1000
+
+
+# collects job results and errors for window seconds, or until max_size are waiting, and
+# sends them to contractor in one request.  Has the same jobResults/jobError interface as
+# Contractor, each caller gets back contractor's response for it's own job
+class ResultCoalescer():
+  def __init__( self, contractor, window=0.5, max_size=20 ):
+    super().__init__()
+    self.contractor = contractor
+    self.window = window
+    self.max_size = max_size
+    self.pending_list = []
+    self.flush_handle = None
+    self.send_task_set = set()
+
+  async def jobResults( self, job_id, data, cookie ):
+    return await self._submit( { 'job_id': job_id, 'cookie': cookie, 'data': data } )
+
+  async def jobError( self, job_id, msg, cookie ):
+    return await self._submit( { 'job_id': job_id, 'cookie': cookie, 'msg': msg } )
+
+  async def _submit( self, entry ):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    self.pending_list.append( ( entry, future ) )
+
+    if len( self.pending_list ) >= self.max_size or self.window <= 0:
+      self.flush()
+    elif self.flush_handle is None:
+      self.flush_handle = loop.call_later( self.window, self.flush )
+
+    return await future
+
+  def flush( self ):
+    if self.flush_handle is not None:
+      self.flush_handle.cancel()
+      self.flush_handle = None
+
+    if not self.pending_list:
+      return
+
+    batch = self.pending_list
+    self.pending_list = []
+
+    task = asyncio.get_running_loop().create_task( self._send( batch ) )
+    self.send_task_set.add( task )
+    task.add_done_callback( self.send_task_set.discard )
+
+  async def _send( self, batch ):
+    logging.debug( 'results: sending "{0}" results'.format( len( batch ) ) )
+    try:
+      response_list = await self.contractor.submitResults( [ entry for entry, _ in batch ] )
+    except Exception as e:
+      for _, future in batch:
+        if not future.done():
+          future.set_exception( e )
+      return
+
+    for ( _, future ), response in zip( batch, response_list ):
+      if future.done():  # the waiting worker went away
+        continue
+
+      if isinstance( response, Exception ):
+        future.set_exception( response )
+      else:
+        future.set_result( response )
+
+
+# append only record of the job results/errors that contractor has not accepted yet, one json
+# object per line, either the entry ( job_id, cookie and data or msg ) or { "job_id": .., "done": true }
+# the entry is fsync'd before it is sent, the done is not, a lost done just means the result is sent again.
+# with filename None the spool is only kept in memory
+class ResultSpool():
+  def __init__( self, filename=None ):
+    super().__init__()
+    self.filename = filename
+    self.entry_map = {}  # key is job_id, value is the entry
+    self.inflight_set = set()  # job_ids a JobWorker is still trying to send
+    self.line_count = 0
+    self.fp = None
+    self.event = asyncio.Event()
+
+  def load( self ):
+    if self.filename is None:
+      return
+
+    try:
+      fp = open( self.filename, 'r' )
+    except FileNotFoundError:
+      fp = None
+
+    if fp is not None:
+      for line in fp:
+        try:
+          record = json.loads( line )
+        except ValueError:  # partial last line from a crash
+          logging.warning( 'results: skipping invalid spool line "{0}"'.format( line[ 0:50 ] ) )
+          continue
+
+        if record.get( 'done', False ):
+          self.entry_map.pop( record[ 'job_id' ], None )
+        else:
+          self.entry_map[ record[ 'job_id' ] ] = record
+
+      fp.close()
+
+    logging.info( 'results: loaded "{0}" unsent results from the spool'.format( len( self.entry_map ) ) )
+    self.compact()
+    if self.entry_map:
+      self.event.set()
+
+  def compact( self ):
+    if self.filename is None:
+      return
+
+    if self.fp is not None:
+      self.fp.close()
+
+    tmp_filename = '{0}.tmp'.format( self.filename )
+    fp = open( tmp_filename, 'w' )
+    for entry in self.entry_map.values():
+      fp.write( json.dumps( entry ) + '\n' )
+    fp.flush()
+    os.fsync( fp.fileno() )
+    fp.close()
+    os.rename( tmp_filename, self.filename )
+
+    self.line_count = len( self.entry_map )
+    self.fp = open( self.filename, 'a' )
+
+  def _write( self, record, sync ):
+    if self.fp is None:
+      return
+
+    self.fp.write( json.dumps( record ) + '\n' )
+    self.fp.flush()
+    if sync:
+      os.fsync( self.fp.fileno() )
+
+    self.line_count += 1
+    if self.line_count > SPOOL_COMPACT_SIZE and self.line_count > len( self.entry_map ) * 2:
+      self.compact()
+
+  def append( self, entry ):
+    self.entry_map[ entry[ 'job_id' ] ] = entry
+    self.inflight_set.add( entry[ 'job_id' ] )
+    self._write( entry, True )
+
+  def complete( self, job_id ):
+    self.inflight_set.discard( job_id )
+    if self.entry_map.pop( job_id, None ) is not None:
+      self._write( { 'job_id': job_id, 'done': True }, False )
+
+  def release( self, job_id ):  # the JobWorker gave up, leave it to the drainer
+    self.inflight_set.discard( job_id )
+    self.event.set()
+
+  def kick( self ):
+    if self.pending:
+      self.event.set()
+
+  @property
+  def pending( self ):
+    return [ entry for job_id, entry in self.entry_map.items() if job_id not in self.inflight_set ]
+
+  async def drain( self, results, retry_delay=10, retry_delay_max=300 ):
+    delay = retry_delay
+    while True:
+      await self.event.wait()
+      self.event.clear()
+
+      entry_list = self.pending
+      if not entry_list:
+        continue
+
+      logging.info( 'results: replaying "{0}" results from the spool'.format( len( entry_list ) ) )
+      for entry in entry_list:
+        self.inflight_set.add( entry[ 'job_id' ] )
+
+      response_list = await asyncio.gather( *[ results.jobError( entry[ 'job_id' ], entry[ 'msg' ], entry[ 'cookie' ] ) if 'msg' in entry else results.jobResults( entry[ 'job_id' ], entry[ 'data' ], entry[ 'cookie' ] ) for entry in entry_list ], return_exceptions=True )
+
+      failed = False
+      for entry, response in zip( entry_list, response_list ):
+        if isinstance( response, Exception ) or response == 'Error':
+          logging.debug( 'results: job "{0}" not accepted ("{1}"), keeping it in the spool'.format( entry[ 'job_id' ], response ) )
+          self.inflight_set.discard( entry[ 'job_id' ] )
+          failed = True
+          continue
+
+        logging.info( 'results: spooled job "{0}" sent, contractor said "{1}"'.format( entry[ 'job_id' ], response ) )
+        self.complete( entry[ 'job_id' ] )
+
+      if not failed:
+        delay = retry_delay
+        continue
+
+      try:  # a kick() (ie: contractor is reachable again) cuts the wait short
+        await asyncio.wait_for( self.event.wait(), delay )
+      except asyncio.TimeoutError:
+        self.event.set()
+
+      delay = min( delay * 2, retry_delay_max )
+
+  def close( self ):
+    if self.fp is not None:
+      self.fp.close()
+      self.fp = None
@@ -0,0 +1,110 @@
+import asyncio
+
+from subcontractor.results import ResultCoalescer, ResultSpool
+
+
+class FakeContractor():
+  def __init__( self ):
+    self.batch_list = []
+
+  async def submitResults( self, entry_list ):
+    self.batch_list.append( entry_list )
+    response_list = []
+    for entry in entry_list:
+      if entry[ 'job_id' ] == 'bad':
+        response_list.append( ValueError( 'bad job' ) )
+      elif 'msg' in entry:
+        response_list.append( 'Accepted' )
+      else:
+        response_list.append( 'Accepted' if entry[ 'data' ] else 'Error' )
+
+    return response_list
+
+
+def test_coalescer_window():
+  contractor = FakeContractor()
+  coalescer = ResultCoalescer( contractor, window=0.1, max_size=10 )
+
+  async def main():
+    return await asyncio.gather( coalescer.jobResults( 1, { 'a': 1 }, 'c1' ),
+                                 coalescer.jobResults( 2, {}, 'c2' ),
+                                 coalescer.jobError( 3, 'oops', 'c3' ),
+                                 coalescer.jobResults( 'bad', { 'a': 1 }, 'c4' ),
+                                 return_exceptions=True )
+
+  response_list = asyncio.run( main() )
+  assert response_list[ 0:3 ] == [ 'Accepted', 'Error', 'Accepted' ]
+  assert isinstance( response_list[ 3 ], ValueError )
+  assert len( contractor.batch_list ) == 1
+  assert contractor.batch_list[ 0 ][ 2 ] == { 'job_id': 3, 'cookie': 'c3', 'msg': 'oops' }
+
+
+def test_coalescer_max_size():
+  contractor = FakeContractor()
+  coalescer = ResultCoalescer( contractor, window=10, max_size=2 )
+
+  async def main():
+    return await asyncio.wait_for( asyncio.gather( *[ coalescer.jobResults( i, { 'a': i }, 'c' ) for i in range( 4 ) ] ), 1 )
+
+  assert asyncio.run( main() ) == [ 'Accepted' ] * 4
+  assert [ len( batch ) for batch in contractor.batch_list ] == [ 2, 2 ]
+
+
+class FlakyResults():
+  def __init__( self ):
+    self.up = False
+    self.sent_list = []
+
+  async def jobResults( self, job_id, data, cookie ):
+    if not self.up:
+      raise ConnectionError( 'contractor is down' )
+
+    self.sent_list.append( job_id )
+    return 'Accepted'
+
+  async def jobError( self, job_id, msg, cookie ):
+    return await self.jobResults( job_id, None, cookie )
+
+
+def test_spool( tmp_path ):
+  filename = str( tmp_path / 'results.spool' )
+
+  spool = ResultSpool( filename )
+  spool.load()
+  spool.append( { 'job_id': 1, 'cookie': 'c1', 'data': { 'a': 1 } } )
+  spool.append( { 'job_id': 2, 'cookie': 'c2', 'msg': 'oops' } )
+  spool.append( { 'job_id': 3, 'cookie': 'c3', 'data': {} } )
+  spool.complete( 3 )
+  spool.release( 1 )
+  assert [ entry[ 'job_id' ] for entry in spool.pending ] == [ 1 ]  # 2 is still owned by it's worker
+  spool.close()
+
+  with open( filename, 'a' ) as fp:
+    fp.write( '{"job_id": 4, "coo' )  # crashed mid write
+
+  spool = ResultSpool( filename )
+  spool.load()
+  assert spool.entry_map == { 1: { 'job_id': 1, 'cookie': 'c1', 'data': { 'a': 1 } }, 2: { 'job_id': 2, 'cookie': 'c2', 'msg': 'oops' } }
+  assert open( filename ).read().count( '\n' ) == 2  # compacted
+
+  results = FlakyResults()
+
+  async def main():
+    task = asyncio.create_task( spool.drain( results, retry_delay=0.05 ) )
+    await asyncio.sleep( 0.1 )
+    assert results.sent_list == []
+    results.up = True
+    spool.kick()
+    for _ in range( 20 ):
+      await asyncio.sleep( 0.05 )
+      if not spool.entry_map:
+        break
+    task.cancel()
+
+  asyncio.run( main() )
+  assert sorted( results.sent_list ) == [ 1, 2 ]
+  spool.close()
+
+  spool = ResultSpool( filename )
+  spool.load()
+  assert spool.entry_map == {}
@@ -14,7 +14,11 @@ class StaticPool():
   def __init__( self, lease_time ):
     super().__init__()
     self.mac_map = {}
+    self.source_map = {}  # key is mac, value is the entry as contractor sent it, so unchanged entries are not re-encoded
+    self.dirty_set = set()  # macs changed since the last dump_changes
+    self.template_map = {}  # key is mac, value is ( entry, DHCPd's option templates for it ), see option_templates
     self.lease_time = ipv4( lease_time ).list()
+    self.reclaim_count = 0  # static entries don't expire, for the same stats as DynamicPool
 
   async def lookup( self, mac, assign ):
     try:
@@ -30,6 +34,9 @@ class StaticPool():
 
   # set address to None to remove entry
   def update_entry( self, mac, address=None, netmask=None, gateway=None, mtu=None, vlan=None, dns_server=None, host_name=None, domain_name=None, config_uuid=None, console=None ):
+    self.source_map.pop( mac, None )
+    self.template_map.pop( mac, None )
+    self.dirty_set.add( mac )
     if address is None:
       try:
         del self.mac_map[ mac ]
@@ -50,30 +57,78 @@ class StaticPool():
                             console,
                             self.lease_time )
 
-  # update everything, if it's not in this list, it will get removed
+  def _set( self, key, value ):
+    if self.source_map.get( key, None ) == value and key in self.mac_map:
+      return False
+
+    gateway = value.get( 'gateway', 0 )
+    if gateway is None:
+      gateway = 0
+    self.mac_map[ key ] = ( ipv4( value.get( 'ip_address', 0 ) ).list(),
+                            ipv4( value.get( 'netmask', 0 ) ).list(),
+                            ipv4( gateway ).list(),
+                            _16intToList( value.get( 'mtu', None ) ),
+                            _16intToList( value.get( 'vlan', None ) ),
+                            ipv4( value.get( 'dns_server', 0 ) ).list(),
+                            strlist( value.get( 'host_name', '' ) ).list(),
+                            strlist( value.get( 'domain_name', '' ) ).list(),
+                            strlist( value.get( 'config_uuid', '' ) ).list(),
+                            value.get( 'console', None ),
+                            self.lease_time )
+    self.source_map[ key ] = value
+    self.template_map.pop( key, None )
+    self.dirty_set.add( key )
+    return True
+
+  def _remove( self, key ):
+    self.mac_map.pop( key, None )
+    self.source_map.pop( key, None )
+    self.template_map.pop( key, None )
+    self.dirty_set.add( key )
+
+  # update everything, if it's not in this list, it will get removed, only changed entries are re-encoded
   def update( self, entry_map ):
+    change_count = 0
+    for key, value in entry_map.items():
+      if self._set( key, value ):
+        change_count += 1
+
+    remove_list = self.mac_map.keys() - entry_map.keys()
+    for item in remove_list:
+      self._remove( item )
+
+    return change_count + len( remove_list )
+
+  # apply only the changes, entry_map is the new/changed entries, removed_list the macs that have been removed
+  def update_delta( self, entry_map, removed_list ):
+    for item in removed_list:
+      self._remove( item )
+
     for key, value in entry_map.items():
-      gateway = value.get( 'gateway', 0 )
-      if gateway is None:
-        gateway = 0
-      self.mac_map[ key ] = ( ipv4( value.get( 'ip_address', 0 ) ).list(),
-                              ipv4( value.get( 'netmask', 0 ) ).list(),
-                              ipv4( gateway ).list(),
-                              _16intToList( value.get( 'mtu', None ) ),
-                              _16intToList( value.get( 'vlan', None ) ),
-                              ipv4( value.get( 'dns_server', 0 ) ).list(),
-                              strlist( value.get( 'host_name', '' ) ).list(),
-                              strlist( value.get( 'domain_name', '' ) ).list(),
-                              strlist( value.get( 'config_uuid', '' ) ).list(),
-                              value.get( 'console', None ),
-                              self.lease_time )
-
-    for item in set( self.mac_map.keys() ) - set( entry_map.keys() ):
-      del self.mac_map[ item ]
+      self._set( key, value )
+
+    return len( entry_map ) + len( removed_list )
 
   async def cleanup( self ):
     pass
 
+  # a dict for DHCPd to keep the options it built for item, the entry lookup just returned for mac, in, it goes
+  # when the entry is changed or removed
+  def option_templates( self, mac, item ):
+    try:
+      ( cached_item, templates ) = self.template_map[ mac ]
+    except KeyError:
+      cached_item = None
+
+    if cached_item is not item:
+      templates = {}
+      self.template_map[ mac ] = ( item, templates )
+
+    return templates
+
+  def counts( self ):
+    return { 'static': len( self.mac_map ) }
+
   def summary( self ):
     result = {}
     for mac, details in self.mac_map.items():
@@ -81,11 +136,16 @@ class StaticPool():
 
     return result
 
-  def dump_cache( self ):
-    return self.mac_map
+  # returns { mac: entry } for the macs that changed since the last call, None for removed macs
+  def dump_changes( self ):
+    result = { mac: self.mac_map.get( mac, None ) for mac in self.dirty_set }
+    self.dirty_set = set()
+    return result
 
   def load_cache( self, cache ):
     if self.mac_map:
       raise Exception( 'allready loaded, can not restore cache' )
 
-    self.mac_map = cache
+    self.mac_map = { mac: tuple( entry ) for mac, entry in cache.items() }
+    self.source_map = {}
+    self.template_map = {}
@@ -0,0 +1,89 @@
+import pytest
+
+pytest.importorskip( 'pydhcplib' )
+
+from subcontractor.static_pool import StaticPool
+
+ENTRY_MAP = {
+              '02:00:00:00:00:01': { 'ip_address': '10.0.0.10', 'netmask': '255.255.255.0', 'gateway': '10.0.0.1', 'dns_server': '10.0.0.1', 'host_name': 'first', 'domain_name': 'test.local', 'console': 'console' },
+              '02:00:00:00:00:02': { 'ip_address': '10.0.0.11', 'netmask': '255.255.255.0', 'gateway': None, 'dns_server': '10.0.0.1', 'host_name': 'second', 'domain_name': 'test.local', 'mtu': 9000, 'vlan': 10 },
+            }
+
+
+def test_update():
+  pool = StaticPool( 3600 )
+  assert pool.update( ENTRY_MAP ) == 2
+  assert sorted( pool.dump_changes() ) == [ '02:00:00:00:00:01', '02:00:00:00:00:02' ]
+  assert pool.summary() == { '02:00:00:00:00:01': '10.0.0.10', '02:00:00:00:00:02': '10.0.0.11' }
+  assert pool.mac_map[ '02:00:00:00:00:02' ][ 2 ] == [ 0, 0, 0, 0 ]  # None gateway
+  assert pool.mac_map[ '02:00:00:00:00:02' ][ 3:5 ] == ( [ 0x23, 0x28 ], [ 0, 10 ] )
+  first = pool.mac_map[ '02:00:00:00:00:01' ]
+  second = pool.mac_map[ '02:00:00:00:00:02' ]
+
+  # unchanged entries are kept as is, a copy from contractor is still the same
+  assert pool.update( dict( [ ( mac, dict( entry ) ) for mac, entry in ENTRY_MAP.items() ] ) ) == 0
+  assert pool.dump_changes() == {}
+  assert pool.mac_map[ '02:00:00:00:00:01' ] is first
+
+  entry_map = dict( ENTRY_MAP )
+  entry_map[ '02:00:00:00:00:01' ] = dict( ENTRY_MAP[ '02:00:00:00:00:01' ], ip_address='10.0.0.20' )
+  assert pool.update( entry_map ) == 1
+  assert pool.mac_map[ '02:00:00:00:00:01' ] is not first
+  assert pool.mac_map[ '02:00:00:00:00:01' ][ 0 ] == [ 10, 0, 0, 20 ]
+  assert pool.mac_map[ '02:00:00:00:00:02' ] is second
+  assert list( pool.dump_changes() ) == [ '02:00:00:00:00:01' ]
+
+  # removed
+  assert pool.update( { '02:00:00:00:00:02': ENTRY_MAP[ '02:00:00:00:00:02' ] } ) == 1
+  assert list( pool.mac_map ) == [ '02:00:00:00:00:02' ]
+  assert pool.dump_changes() == { '02:00:00:00:00:01': None }
+  assert pool.update( {} ) == 1
+  assert pool.mac_map == {}
+  assert pool.source_map == {}
+
+
+def test_update_delta():
+  pool = StaticPool( 3600 )
+  pool.update( ENTRY_MAP )
+  pool.dump_changes()
+  second = pool.mac_map[ '02:00:00:00:00:02' ]
+
+  assert pool.update_delta( { '02:00:00:00:00:03': dict( ENTRY_MAP[ '02:00:00:00:00:01' ], ip_address='10.0.0.12' ) }, [ '02:00:00:00:00:01' ] ) == 2
+  assert sorted( pool.mac_map ) == [ '02:00:00:00:00:02', '02:00:00:00:00:03' ]
+  assert pool.mac_map[ '02:00:00:00:00:02' ] is second  # not in the delta, left alone
+  assert pool.dump_changes() == { '02:00:00:00:00:01': None, '02:00:00:00:00:03': pool.mac_map[ '02:00:00:00:00:03' ] }
+
+  assert pool.update_delta( { '02:00:00:00:00:02': dict( ENTRY_MAP[ '02:00:00:00:00:02' ] ) }, [ '02:00:00:00:00:09' ] ) == 2  # unchanged, removing something not there
+  assert pool.mac_map[ '02:00:00:00:00:02' ] is second
+  assert pool.dump_changes() == { '02:00:00:00:00:09': None }
+
+
+def test_option_templates():
+  pool = StaticPool( 3600 )
+  pool.update( ENTRY_MAP )
+  item = pool.mac_map[ '02:00:00:00:00:01' ]
+  templates = pool.option_templates( '02:00:00:00:00:01', item )
+  templates[ 'key' ] = 'value'
+  assert pool.option_templates( '02:00:00:00:00:01', item ) is templates
+
+  pool.update( dict( ENTRY_MAP, **{ '02:00:00:00:00:01': dict( ENTRY_MAP[ '02:00:00:00:00:01' ], host_name='other' ) } ) )
+  assert '02:00:00:00:00:01' not in pool.template_map
+  assert pool.option_templates( '02:00:00:00:00:01', pool.mac_map[ '02:00:00:00:00:01' ] ) == {}
+
+  pool.update_delta( {}, [ '02:00:00:00:00:01' ] )
+  assert pool.template_map == {}
+
+
+def test_load_cache():
+  pool = StaticPool( 3600 )
+  pool.update( ENTRY_MAP )
+  cache = dict( [ ( mac, list( entry ) ) for mac, entry in pool.mac_map.items() ] )
+
+  pool = StaticPool( 3600 )
+  pool.load_cache( cache )
+  assert pool.summary() == { '02:00:00:00:00:01': '10.0.0.10', '02:00:00:00:00:02': '10.0.0.11' }
+  with pytest.raises( Exception ):
+    pool.load_cache( cache )
+
+  assert pool.update( ENTRY_MAP ) == 2  # nothing to compare with from the cache, so re-encoded
+  assert pool.update( ENTRY_MAP ) == 0